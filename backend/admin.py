@@ -0,0 +1,18 @@
+"""
+Authentication for admin endpoints.
+"""
+import hmac
+from fastapi import Header, HTTPException
+from config import ADMIN_CONFIG
+
+
+def require_admin(x_admin_key: str = Header(default=""), authorization: str = Header(default="")):
+    """FastAPI dependency rejecting requests without the configured admin key"""
+    expected = ADMIN_CONFIG["api_key"]
+    if not expected:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled (no admin api_key configured)")
+    provided = x_admin_key
+    if not provided and authorization.lower().startswith("bearer "):
+        provided = authorization[7:]
+    if not hmac.compare_digest(provided.encode("utf-8"), expected.encode("utf-8")):
+        raise HTTPException(status_code=401, detail="Invalid admin key")
@@ -0,0 +1,233 @@
+"""
+Admission control for local inference.
+
+Each model has a bounded budget of admitted work (queued + running), measured in
+megapixels of upload so one 40 MP photo weighs as much as many thumbnails. A
+request that would overflow the budget of any model it needs is rejected at once
+with 429 and a Retry-After estimate, instead of waiting behind an ever-growing
+backlog. Admitted requests then wait for one of the model's concurrency slots
+(ADMISSION_CONFIG["concurrency"] per replica of the model).
+
+There are two lanes. Interactive calls (single images, ensembles) may use the whole
+budget; bulk traffic (video, clients sending X-Priority: bulk) is capped at a share
+of it, and a freed slot always goes to a waiting interactive request first.
+A request whose deadline (see deadlines.py) passes while it waits is dropped with 504.
+"""
+import asyncio
+import collections
+import math
+import threading
+import time
+from fastapi import HTTPException
+from config import ADMISSION_CONFIG
+from deadlines import current_deadline, DeadlineExceeded
+from model_registry import replica_count
+from logging_utils import get_logger
+from metrics import ADMISSION_QUEUE_DEPTH, ADMISSION_ADMITTED, ADMISSION_REJECTIONS, DEADLINE_SKIPS
+
+logger = get_logger("authnet.admission")
+
+LANES = ("interactive", "bulk")
+
+
+def request_lane(headers, default="interactive"):
+    """The lane for a request; clients can only move themselves down to bulk"""
+    return "bulk" if headers.get("x-priority", "").strip().lower() == "bulk" else default
+
+
+def upload_cost(width, height):
+    """Admission cost of an image, in megapixels"""
+    return max(ADMISSION_CONFIG["min_cost_megapixels"], width * height / 1e6)
+
+
+class _ModelQueue:
+    def __init__(self, name):
+        self.name = name
+        # Concurrency slots: the configured concurrency on each of the model's replicas
+        self.slots = ADMISSION_CONFIG["concurrency"] * replica_count(name)
+        self.admitted = dict.fromkeys(LANES, 0.0)
+        self.running = 0
+        self.waiters = {lane: collections.deque() for lane in LANES}
+        # Smoothed seconds per megapixel of admitted work, for the Retry-After estimate
+        self.seconds_per_unit = None
+
+    def total(self):
+        return sum(self.admitted.values())
+
+    def fits(self, cost, lane):
+        total = self.total()
+        if total == 0:
+            # An idle model takes any single request, however large
+            return True
+        if total + cost > ADMISSION_CONFIG["capacity_megapixels"]:
+            return False
+        limit = ADMISSION_CONFIG["capacity_megapixels"] * ADMISSION_CONFIG["bulk_share"]
+        return lane != "bulk" or self.admitted["bulk"] + cost <= limit
+
+    def retry_after(self):
+        """Seconds until the admitted backlog should have drained, bounded by max_retry_after"""
+        if self.seconds_per_unit is None:
+            return 1
+        backlog = self.total() * self.seconds_per_unit / max(1, self.slots)
+        return int(min(ADMISSION_CONFIG["max_retry_after"], max(1, math.ceil(backlog))))
+
+    def observe(self, seconds, cost):
+        per_unit = seconds / cost
+        self.seconds_per_unit = per_unit if self.seconds_per_unit is None else (
+            0.8 * self.seconds_per_unit + 0.2 * per_unit)
+
+    def export(self):
+        for lane in LANES:
+            ADMISSION_QUEUE_DEPTH.set(len(self.waiters[lane]), model=self.name, lane=lane)
+            ADMISSION_ADMITTED.set(round(self.admitted[lane], 3), model=self.name, lane=lane)
+
+
+class Ticket:
+    """An admitted request. release() returns its budget and slots; safe to call from any thread, and more than once"""
+
+    def __init__(self, controller, names, cost, lane):
+        self.controller = controller
+        self.names = names
+        self.cost = cost
+        self.lane = lane
+        self.slots = []
+        self.started = None
+        self._loop = asyncio.get_running_loop()
+        self._released = False
+
+    def release(self):
+        if self._released:
+            return
+        self._released = True
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            self.controller._release(self)
+        else:
+            self._loop.call_soon_threadsafe(self.controller._release, self)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.release()
+
+
+class AdmissionController:
+    """Per-model bounded queues with interactive and bulk lanes; used from the event loop"""
+
+    def __init__(self):
+        self._queues = {}
+        self._lock = threading.Lock()
+
+    def _queue(self, name):
+        with self._lock:
+            queue = self._queues.get(name)
+            if queue is None:
+                queue = self._queues[name] = _ModelQueue(name)
+            return queue
+
+    async def admit(self, names, cost, lane="interactive"):
+        """
+        Reserve `cost` on every model in `names` and wait for a slot on each.
+        Raises HTTPException 429 (with Retry-After) if any of them is full, and
+        DeadlineExceeded if the request's deadline passes before it gets its slots.
+        """
+        deadline = current_deadline()
+        if deadline is not None:
+            deadline.check("queue")
+        names = sorted(set(names))
+        ticket = Ticket(self, names, cost, lane)
+        if not ADMISSION_CONFIG["enabled"] or not names:
+            return ticket
+        queues = [self._queue(name) for name in names]
+        full = [queue for queue in queues if not queue.fits(cost, lane)]
+        if full:
+            retry_after = max(queue.retry_after() for queue in full)
+            for queue in full:
+                ADMISSION_REJECTIONS.inc(model=queue.name, lane=lane)
+            logger.warning("Rejecting request, model queue full",
+                           extra={"models": [queue.name for queue in full], "lane": lane, "cost": round(cost, 3)})
+            raise HTTPException(status_code=429, headers={"Retry-After": str(retry_after)},
+                                detail=f"Model queue full ({', '.join(q.name for q in full)}), retry in {retry_after}s")
+        for queue in queues:
+            queue.admitted[lane] += cost
+            queue.export()
+        try:
+            # Slots are taken in name order so two multi-model requests can't deadlock
+            for queue in queues:
+                await self._acquire_slot(queue, lane, deadline)
+                ticket.slots.append(queue)
+        except asyncio.TimeoutError:
+            ticket.release()
+            DEADLINE_SKIPS.inc(stage="queue", reason="deadline")
+            raise DeadlineExceeded(f"Deadline of {deadline.seconds}s exceeded while queued")
+        except BaseException:
+            ticket.release()
+            raise
+        ticket.started = time.perf_counter()
+        return ticket
+
+    async def _acquire_slot(self, queue, lane, deadline=None):
+        if queue.running < queue.slots and not any(queue.waiters.values()):
+            queue.running += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        queue.waiters[lane].append(waiter)
+        queue.export()
+        timeout = deadline.remaining() if deadline is not None else None
+        try:
+            await asyncio.wait_for(waiter, max(0.0, timeout) if timeout is not None else None)
+        except (asyncio.CancelledError, asyncio.TimeoutError):
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over just as we gave up; pass it on
+                queue.running -= 1
+                self._wake(queue)
+            else:
+                if waiter in queue.waiters[lane]:
+                    queue.waiters[lane].remove(waiter)
+                queue.export()
+            raise
+
+    def _wake(self, queue):
+        """Hand free slots to waiters, interactive lane first"""
+        for lane in LANES:
+            waiters = queue.waiters[lane]
+            while waiters and queue.running < queue.slots:
+                waiter = waiters.popleft()
+                if waiter.done():
+                    continue
+                queue.running += 1
+                waiter.set_result(None)
+        queue.export()
+
+    def _release(self, ticket):
+        elapsed = time.perf_counter() - ticket.started if ticket.started is not None else None
+        for name in ticket.names:
+            queue = self._queue(name)
+            queue.admitted[ticket.lane] = max(0.0, queue.admitted[ticket.lane] - ticket.cost)
+            if elapsed is not None:
+                queue.observe(elapsed, ticket.cost)
+        for queue in ticket.slots:
+            queue.running -= 1
+            self._wake(queue)
+        for name in ticket.names:
+            self._queue(name).export()
+
+    def status(self):
+        """Per-model snapshot for /health"""
+        with self._lock:
+            queues = list(self._queues.values())
+        return {
+            queue.name: {
+                "running": queue.running,
+                "waiting": {lane: len(queue.waiters[lane]) for lane in LANES},
+                "admitted_megapixels": {lane: round(queue.admitted[lane], 3) for lane in LANES}
+            }
+            for queue in queues
+        }
+
+
+admission = AdmissionController()
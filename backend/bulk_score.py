@@ -0,0 +1,422 @@
+#!/usr/bin/env python3
+"""
+Offline bulk scoring of image collections.
+
+Walks directories and zip/tar archives, decodes and preprocesses images in a pool
+of worker threads (or processes) with exactly the preprocessing of the API
+(utilities.preprocess_image), and feeds the loaded models full batches from a
+bounded prefetch queue, so decoding keeps going while a batch is on the models.
+Results go to a columnar file, one row per image:
+
+    path, score_<model>..., fake_votes, verdict, confidence, error
+
+CSV rows are appended after every batch. NPZ and Parquet (needs pyarrow) outputs
+are written as part files every BATCH_CONFIG["flush_rows"] rows and merged when
+the run finishes. --resume skips every image already present in the output (or its
+parts), so an interrupted run picks up where it stopped.
+
+Examples:
+    python bulk_score.py /data/archive --output scores.csv
+    python bulk_score.py photos.zip more/ --output scores.parquet --models cnn,vgg --resume
+    python bulk_score.py /data/archive --output scores.npz --processes --workers 8
+"""
+import argparse
+import collections
+import concurrent.futures
+import csv
+import glob
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tarfile
+import threading
+import time
+import zipfile
+
+import numpy as np
+
+from config import BATCH_CONFIG
+from logging_utils import get_logger
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+    PARQUET_AVAILABLE = True
+except ImportError:
+    PARQUET_AVAILABLE = False
+
+logger = get_logger("authnet.bulk_score")
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp", ".gif", ".tif", ".tiff")
+TAR_EXTENSIONS = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz")
+OUTPUT_FORMATS = {".csv": "csv", ".npz": "npz", ".parquet": "parquet"}
+
+
+# ---- Inputs -----------------------------------------------------------------
+
+def _hidden(name):
+    base = os.path.basename(name.rstrip("/"))
+    return not base or base.startswith(".") or name.startswith("__MACOSX/")
+
+
+def _file_items(path, skip):
+    """(key, source) pairs for one file: the image itself, or every image inside an archive"""
+    lower = path.lower()
+    if lower.endswith(".zip"):
+        from jobs import _archive_images
+        with zipfile.ZipFile(path) as archive:
+            for member in _archive_images(archive):
+                key = f"{path}!{member}"
+                if key not in skip:
+                    yield key, ("zip", path, member)
+    elif lower.endswith(TAR_EXTENSIONS):
+        # Compressed tars can only be read front to back, so members are read here, as the queue drains
+        with tarfile.open(path) as archive:
+            for member in archive:
+                key = f"{path}!{member.name}"
+                if member.isfile() and not _hidden(member.name) and key not in skip:
+                    yield key, ("bytes", archive.extractfile(member).read())
+    elif lower.endswith(IMAGE_EXTENSIONS) and path not in skip:
+        yield path, ("file", path)
+
+
+def iter_images(paths, skip=frozenset()):
+    """(key, source) for every image under `paths` (files, directories, archives) whose key isn't in skip"""
+    for path in paths:
+        if not os.path.isdir(path):
+            yield from _file_items(path, skip)
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+            for name in sorted(files):
+                if not name.startswith("."):
+                    yield from _file_items(os.path.join(root, name), skip)
+
+
+_open_archives = threading.local()
+
+
+def _zip_member(path, member):
+    """Read a zip member through an archive handle kept open per decode thread"""
+    archives = getattr(_open_archives, "zips", None)
+    if archives is None:
+        archives = _open_archives.zips = {}
+    archive = archives.get(path)
+    if archive is None:
+        archive = archives[path] = zipfile.ZipFile(path)
+    return archive.read(member)
+
+
+def decode(key, source):
+    """(key, preprocessed (H, W, 3) array or None, error or None); runs in a decode worker"""
+    from utilities import preprocess_image
+    try:
+        kind = source[0]
+        if kind == "file":
+            with open(source[1], "rb") as f:
+                contents = f.read()
+        elif kind == "zip":
+            contents = _zip_member(source[1], source[2])
+        else:
+            contents = source[1]
+        return key, preprocess_image(contents)[0], None
+    except Exception as e:
+        return key, None, f"Could not decode image: {e}"
+
+
+def prefetch(executor, items, depth):
+    """Decode `items` on the executor, in order, with at most `depth` decodes queued or running"""
+    items = iter(items)
+    pending = collections.deque()
+    for key, source in items:
+        pending.append(executor.submit(decode, key, source))
+        if len(pending) >= depth:
+            break
+    while pending:
+        result = pending.popleft().result()
+        for key, source in items:
+            pending.append(executor.submit(decode, key, source))
+            break
+        yield result
+
+
+def batches(decoded, batch_size):
+    """(keys, (n, H, W, 3) batch, [(key, error)]) with full batches except the last"""
+    keys, arrays, failures = [], [], []
+    for key, array, error in decoded:
+        if error is not None:
+            failures.append((key, error))
+            continue
+        keys.append(key)
+        arrays.append(array)
+        if len(arrays) == batch_size:
+            yield keys, np.stack(arrays), failures
+            keys, arrays, failures = [], [], []
+    if arrays or failures:
+        yield keys, np.stack(arrays) if arrays else None, failures
+
+
+# ---- Scoring ----------------------------------------------------------------
+
+def score_batch(predict_fns, x, threshold):
+    """Columns for a batch: per-model fake scores, then the majority vote as in the ensemble endpoint"""
+    from tiling import fake_scores
+    scores = np.stack([fake_scores(predict(x)) for predict in predict_fns.values()], axis=1)
+    votes = (scores > threshold).sum(axis=1)
+    columns = {f"score_{name}": scores[:, i] for i, name in enumerate(predict_fns)}
+    columns.update({
+        "fake_votes": votes.astype(np.int32),
+        "verdict": np.where(2 * votes > scores.shape[1], "fake", "real"),
+        "confidence": scores.mean(axis=1)
+    })
+    return columns
+
+
+def result_rows(keys, columns, failures, model_names):
+    """Scored and failed images as one columnar dict"""
+    n, failed = len(keys), len(failures)
+    rows = {"path": np.array(keys + [key for key, _ in failures], dtype=object)}
+    for name in model_names:
+        column = f"score_{name}"
+        values = columns[column] if n else np.zeros(0, dtype=np.float32)
+        rows[column] = np.concatenate([values.astype(np.float32), np.full(failed, np.nan, dtype=np.float32)])
+    rows["fake_votes"] = np.concatenate([columns["fake_votes"] if n else np.zeros(0, np.int32),
+                                         np.full(failed, -1, dtype=np.int32)])
+    rows["verdict"] = np.array(list(columns["verdict"] if n else []) + ["error"] * failed, dtype=object)
+    rows["confidence"] = np.concatenate([columns["confidence"].astype(np.float32) if n else np.zeros(0, np.float32),
+                                         np.full(failed, np.nan, dtype=np.float32)])
+    rows["error"] = np.array([""] * n + [error for _, error in failures], dtype=object)
+    return rows
+
+
+# ---- Outputs ----------------------------------------------------------------
+
+class CsvOutput:
+    """Rows appended to a CSV file after every batch"""
+
+    def __init__(self, path, columns):
+        self.path = path
+        self.columns = columns
+        self._file = None
+
+    def done_keys(self):
+        if not os.path.exists(self.path):
+            return set()
+        # Drop a row cut short by a crash so it is scored again
+        with open(self.path, "rb+") as f:
+            data = f.read()
+            if data and not data.endswith(b"\n"):
+                f.truncate(data.rfind(b"\n") + 1)
+        with open(self.path, newline="") as f:
+            return {row["path"] for row in csv.DictReader(f)}
+
+    def write(self, rows):
+        if self._file is None:
+            new = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+            self._file = open(self.path, "a", newline="")
+            self._writer = csv.writer(self._file)
+            if new:
+                self._writer.writerow(self.columns)
+        for values in zip(*(rows[column] for column in self.columns)):
+            self._writer.writerow([_csv_value(value) for value in values])
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+def _csv_value(value):
+    if isinstance(value, (float, np.floating)):
+        # Missing scores (failed images) are empty cells
+        return "" if np.isnan(value) else round(float(value), 6)
+    return value
+
+
+class PartsOutput:
+    """
+    Rows buffered and written as part files next to the output ("<output>.parts/"),
+    merged into the output when the run finishes. Subclasses read and write one table.
+    """
+    suffix = None
+
+    def __init__(self, path, columns, flush_rows):
+        self.path = path
+        self.columns = columns
+        self.flush_rows = flush_rows
+        self.parts_dir = path + ".parts"
+        self._buffer = []
+        self._buffered = 0
+
+    def _parts(self):
+        return sorted(glob.glob(os.path.join(self.parts_dir, f"part-*{self.suffix}")))
+
+    def _tables(self):
+        paths = ([self.path] if os.path.exists(self.path) else []) + self._parts()
+        return [self.read(path) for path in paths]
+
+    def done_keys(self):
+        keys = set()
+        for table in self._tables():
+            keys.update(str(key) for key in table["path"])
+        return keys
+
+    def write(self, rows):
+        self._buffer.append(rows)
+        self._buffered += len(rows["path"])
+        if self._buffered >= self.flush_rows:
+            self._flush()
+
+    def _flush(self):
+        if not self._buffered:
+            return
+        os.makedirs(self.parts_dir, exist_ok=True)
+        part = os.path.join(self.parts_dir, f"part-{len(self._parts()):06d}{self.suffix}")
+        self._write_atomic(part, _concat(self._buffer, self.columns))
+        self._buffer, self._buffered = [], 0
+
+    def _write_atomic(self, path, table):
+        temp_path = path + ".tmp" + self.suffix
+        self.write_table(temp_path, table)
+        os.replace(temp_path, path)
+
+    def close(self):
+        self._flush()
+        if not os.path.isdir(self.parts_dir):
+            return
+        self._write_atomic(self.path, _concat(self._tables(), self.columns))
+        shutil.rmtree(self.parts_dir)
+
+
+class NpzOutput(PartsOutput):
+    suffix = ".npz"
+
+    def read(self, path):
+        with np.load(path, allow_pickle=False) as data:
+            return {column: data[column] for column in data.files}
+
+    def write_table(self, path, table):
+        arrays = {column: np.asarray(values, dtype=str) if values.dtype == object else values
+                  for column, values in table.items()}
+        with open(path, "wb") as f:
+            np.savez(f, **arrays)
+
+
+class ParquetOutput(PartsOutput):
+    suffix = ".parquet"
+
+    def read(self, path):
+        table = pyarrow.parquet.read_table(path)
+        return {column: table.column(column).to_numpy(zero_copy_only=False) for column in table.column_names}
+
+    def write_table(self, path, table):
+        pyarrow.parquet.write_table(pyarrow.table({column: list(values) if values.dtype == object else values
+                                                   for column, values in table.items()}), path)
+
+
+def _concat(tables, columns):
+    return {column: np.concatenate([np.asarray(table[column], dtype=object) if table[column].dtype.kind in "OU"
+                                    else table[column] for table in tables]) for column in columns}
+
+
+def open_output(path, columns, flush_rows):
+    output_format = OUTPUT_FORMATS.get(os.path.splitext(path)[1].lower())
+    if output_format is None:
+        raise SystemExit(f"Output must end in one of: {', '.join(OUTPUT_FORMATS)}")
+    if output_format == "csv":
+        return CsvOutput(path, columns)
+    if output_format == "npz":
+        return NpzOutput(path, columns, flush_rows)
+    if not PARQUET_AVAILABLE:
+        raise SystemExit("Parquet output needs pyarrow (pip install pyarrow)")
+    return ParquetOutput(path, columns, flush_rows)
+
+
+# ---- Driver -----------------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description="Score image directories and archives with the AuthNet models")
+    parser.add_argument("inputs", nargs="+", help="Image files, directories and zip/tar archives")
+    parser.add_argument("--output", required=True, help="Output file (.csv, .npz or .parquet)")
+    parser.add_argument("--models", default="cnn,effnet,vgg", help="Comma-separated models to score with")
+    parser.add_argument("--threshold", type=float, default=0.5)
+    parser.add_argument("--batch-size", type=int, default=BATCH_CONFIG["chunk_size"])
+    parser.add_argument("--workers", type=int, default=BATCH_CONFIG["decode_workers"],
+                        help="Decode workers (default: one per CPU)")
+    parser.add_argument("--processes", action="store_true",
+                        help="Decode in worker processes instead of threads (for formats whose decoder holds the GIL)")
+    parser.add_argument("--prefetch-batches", type=int, default=BATCH_CONFIG["prefetch_batches"],
+                        help="Batches of decoded images kept ready ahead of the models")
+    parser.add_argument("--resume", action="store_true", help="Skip images already in the output")
+    parser.add_argument("--overwrite", action="store_true", help="Replace an existing output")
+    args = parser.parse_args()
+
+    from model_registry import load_models, get_model, model_version
+    model_names = [name for name in (n.strip() for n in args.models.split(",")) if name]
+    columns = ["path"] + [f"score_{name}" for name in model_names] + ["fake_votes", "verdict", "confidence", "error"]
+    output = open_output(args.output, columns, BATCH_CONFIG["flush_rows"])
+    exists = os.path.exists(args.output) or os.path.isdir(args.output + ".parts")
+    if exists and args.overwrite:
+        if os.path.exists(args.output):
+            os.remove(args.output)
+        shutil.rmtree(args.output + ".parts", ignore_errors=True)
+    elif exists and not args.resume:
+        raise SystemExit(f"{args.output} exists; pass --resume to continue it or --overwrite to replace it")
+    done = output.done_keys() if args.resume else set()
+
+    load_models()
+    predict_fns, versions = {}, {}
+    for name in model_names:
+        model = get_model(name)
+        if model is None:
+            raise SystemExit(f"Model {name} is not loaded")
+        predict_fns[name] = model.predict
+        versions[name] = model_version(model)
+
+    workers = args.workers or os.cpu_count() or 1
+    if args.processes:
+        executor = concurrent.futures.ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"))
+    else:
+        executor = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix="decode")
+    depth = max(workers, args.batch_size * args.prefetch_batches)
+    logger.info("Bulk scoring started", extra={"inputs": args.inputs, "models": versions, "workers": workers,
+                                               "processes": args.processes, "batch_size": args.batch_size,
+                                               "resumed": len(done)})
+    started = time.perf_counter()
+    scored = failed = 0
+    inference_seconds = 0.0
+    try:
+        with executor:
+            decoded = prefetch(executor, iter_images(args.inputs, done), depth)
+            for keys, x, failures in batches(decoded, args.batch_size):
+                columns_for_batch = {}
+                if x is not None:
+                    inference_started = time.perf_counter()
+                    columns_for_batch = score_batch(predict_fns, x, args.threshold)
+                    inference_seconds += time.perf_counter() - inference_started
+                output.write(result_rows(keys, columns_for_batch, failures, model_names))
+                scored += len(keys)
+                failed += len(failures)
+                elapsed = time.perf_counter() - started
+                print(f"\r{scored} scored, {failed} failed, {scored / elapsed:.1f} images/s", end="", file=sys.stderr)
+    finally:
+        output.close()
+    elapsed = time.perf_counter() - started
+    print(file=sys.stderr)
+    print(json.dumps({
+        "output": args.output,
+        "scored": scored,
+        "failed": failed,
+        "skipped": len(done),
+        "seconds": round(elapsed, 3),
+        "images_per_second": round(scored / elapsed, 2) if elapsed else None,
+        # Share of the wall time the models were busy; well below 1 means decoding is the bottleneck
+        "model_utilization": round(inference_seconds / elapsed, 3) if elapsed else None,
+        "model_versions": versions
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
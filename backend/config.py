@@ -1,4 +1,11 @@
 # Configuration for AuthNet backend
+import json
+import os
+
+# Runtime data written by the backend (embedding stores, job queue), by default backend/data whatever the
+# working directory; AUTHNET_DATA_DIR moves it elsewhere
+DATA_DIR = os.path.abspath(os.environ.get("AUTHNET_DATA_DIR")
+                           or os.path.join(os.path.dirname(os.path.abspath(__file__)), "data"))
 
 # Model settings
 MODEL_CONFIG = {
@@ -36,6 +43,38 @@ MODEL_CONFIG = {
     }
 }
 
+# Environment override for the remote server, e.g. when a benchmark spawns the backend
+if os.environ.get("AUTHNET_REMOTE_SERVER_URL"):
+    MODEL_CONFIG["remote"]["server_url"] = os.environ["AUTHNET_REMOTE_SERVER_URL"]
+
+# Model replicas: copies of a model loaded side by side, each call going to the least busy one
+REPLICA_CONFIG = {
+    # Replicas per model (each adds the model's memory again); 1 serves every request from one copy
+    "replicas": {"cnn": 1, "effnet": 1, "vgg": 1},
+    # TensorFlow threads per replica (None: the CPUs split evenly between a model's replicas)
+    "threads_per_replica": None
+}
+
+# JSON override of the replica counts, e.g. AUTHNET_REPLICAS='{"effnet": 4}'
+if os.environ.get("AUTHNET_REPLICAS"):
+    REPLICA_CONFIG["replicas"].update(json.loads(os.environ["AUTHNET_REPLICAS"]))
+
+# Process-isolated inference (see inference_workers.py): each model replica runs in its own worker
+# process, the API process keeps HTTP, decoding and heatmap encoding
+INFERENCE_WORKER_CONFIG = {
+    "enabled": os.environ.get("AUTHNET_INFERENCE_WORKERS", "").lower() in ("1", "true", "yes"),
+    # Calls handed to a worker at once, each with its own shared-memory slot (in /dev/shm)
+    "slots": 4,
+    # Bytes per slot for the input batch and the arrays returned; larger arrays go through the pipe
+    "slot_bytes": 16 * 1024 * 1024,
+    # Seconds a worker may take to load and warm up its model
+    "start_timeout": 300,
+    # Seconds a call may take before its worker is considered hung, killed and restarted
+    "call_timeout": 120,
+    # Seconds before a worker that exited is started again (doubling while it keeps failing)
+    "restart_delay": 1.0
+}
+
 # Server settings
 SERVER_CONFIG = {
     # CORS settings
@@ -56,4 +95,210 @@ PREPROCESSING_CONFIG = {
     "image_size": (224, 224),
     "normalize": True,
     "normalization_factor": 255.0
-}
\ No newline at end of file
+}
+
+# Heatmap response settings
+HEATMAP_CONFIG = {
+    # Default encoding when a request doesn't pass heatmap_format:
+    #   "jpeg"         - heatmap blended over the upload, base64 JPEG (legacy response)
+    #   "png"/"webp"   - colormapped heatmap only
+    #   "grid_float16" - raw low-resolution activation grid (little-endian float16)
+    #   "grid_uint8"   - raw low-resolution activation grid scaled to 0-255
+    "default_format": "jpeg",
+    # "auto" (CAM for GAP + Dense models such as effnet, Grad-CAM otherwise), "gradcam", "cam" or "none"
+    "default_mode": "auto",
+    # Longest edge of rendered heatmaps (and of the decoded image used for overlays),
+    # keeps heatmap memory and latency flat regardless of upload size
+    "max_edge": 512,
+    "jpeg_quality": 90,
+    "webp_quality": 80
+}
+
+# Upload ingestion limits
+UPLOAD_CONFIG = {
+    # Largest accepted upload in bytes (checked against Content-Length and while streaming)
+    "max_bytes": 25 * 1024 * 1024,
+    # Bytes read from the upload per chunk
+    "chunk_size": 256 * 1024,
+    # Largest decoded image accepted, checked from the image header before decoding
+    "max_pixels": 50_000_000,
+    "max_edge": 16384
+}
+
+# Logging settings
+LOGGING_CONFIG = {
+    # Minimum level always emitted ("DEBUG", "INFO", "WARNING", ...)
+    "level": "INFO",
+    # "json" for one structured record per line, "text" for human-readable lines
+    "format": "json",
+    # Fraction of requests whose DEBUG records are emitted (0 disables per-request debug)
+    "debug_sample_rate": 0.01,
+    # Records buffered for the background writer; records beyond this are dropped, never blocking
+    "queue_size": 10000
+}
+
+# Per-request stage timing (Server-Timing headers / trace=true responses)
+TRACE_CONFIG = {
+    # Directory for Chrome trace-event JSON files of trace=true requests ("" disables writing);
+    # load them in chrome://tracing or https://ui.perfetto.dev
+    "output_dir": ""
+}
+
+# Admin endpoints (profiling, ...) - disabled while api_key is empty
+ADMIN_CONFIG = {
+    # Sent as "X-Admin-Key: <key>" or "Authorization: Bearer <key>"
+    "api_key": os.environ.get("AUTHNET_ADMIN_KEY", ""),
+    # Where profiling sessions write their output
+    "profile_dir": "profiles",
+    # Upper bounds for a single profiling session
+    "max_profile_seconds": 300,
+    "max_profile_requests": 1000,
+    # Python sampling interval in seconds
+    "sample_interval": 0.005,
+    # Seconds a hot reload waits for requests still using the old model version
+    "reload_drain_timeout": 60
+}
+
+# Batch scoring (majority_pipeline_batch, batched Grad-CAM, offline tools)
+BATCH_CONFIG = {
+    # Images per forward pass; bounds peak memory for large archives
+    "chunk_size": 64,
+    # Images per Grad-CAM gradient pass (gradients and activations are kept for the whole chunk)
+    "gradcam_chunk_size": 16,
+    # bulk_score.py: decode workers (None = one per CPU) and decoded images kept ready, in batches
+    "decode_workers": None,
+    "prefetch_batches": 4,
+    # bulk_score.py: rows buffered before an NPZ/Parquet part file is written (lost at most on a crash)
+    "flush_rows": 4096
+}
+
+# Tiled high-resolution analysis (analysis=tiled on /predict/{model})
+TILING_CONFIG = {
+    # Tile edge in pixels of the original image; tiles are resized if this differs from the model input
+    "tile_size": 224,
+    # Offset between tiles (None = tile_size, i.e. no overlap); widened up to tile_size to respect max_tiles,
+    # beyond which the image is downscaled so the tiles still cover all of it
+    "stride": None,
+    "max_tiles": 64,
+    # Tiles per forward pass; bounds peak memory for very large images
+    "batch_size": 16,
+    # How tile scores combine into the image score: "max" (any region) or "mean"
+    "aggregate": "max"
+}
+
+# Video / animated image analysis (/predict/video)
+VIDEO_CONFIG = {
+    # Largest accepted video upload in bytes (streamed to a temporary file, never held in memory)
+    "max_bytes": 200 * 1024 * 1024,
+    # Default sampling: "rate" (at most fps frames per second) or "scene" (on scene changes)
+    "sample": "rate",
+    "fps": 2.0,
+    # Mean absolute difference (0-1) of grayscale thumbnails that counts as a scene change
+    "scene_threshold": 0.12,
+    # Frames closer than this to the last sampled frame are skipped as near-duplicates
+    "dedupe_threshold": 0.01,
+    # Upper bound on frames analyzed per upload
+    "max_frames": 300,
+    # Frames per forward pass
+    "batch_size": 16
+}
+
+# Asynchronous analysis jobs (/jobs)
+JOBS_CONFIG = {
+    # SQLite database holding the job queue and results
+    "db_path": os.path.join(DATA_DIR, "jobs", "jobs.sqlite3"),
+    # Uploaded job inputs, stored once per content hash
+    "data_dir": os.path.join(DATA_DIR, "jobs", "data"),
+    # Worker processes started with the API; jobs are opt-in (0 disables the job subsystem)
+    "workers": int(os.environ.get("AUTHNET_JOB_WORKERS", "0")),
+    # Largest accepted job upload in bytes (archives, videos)
+    "max_bytes": 1024 * 1024 * 1024,
+    # Jobs interrupted by a restart are retried this many times before being marked failed
+    "max_attempts": 3,
+    # Seconds an idle worker waits before polling the queue again
+    "poll_interval": 0.5
+}
+
+# Admission control for local inference (see admission.py)
+ADMISSION_CONFIG = {
+    # When False every request is admitted straight away
+    "enabled": True,
+    # Admitted (queued + running) work per model, in megapixels of upload; beyond it requests get 429
+    "capacity_megapixels": 64,
+    # Share of that budget bulk traffic may hold, the rest is reserved for interactive calls
+    "bulk_share": 0.5,
+    # Requests running on each replica of a model at once; the others wait, interactive lane first
+    "concurrency": 2,
+    # Smallest cost charged per request, so small images still count
+    "min_cost_megapixels": 0.25,
+    # Upper bound on the Retry-After hint, in seconds
+    "max_retry_after": 30
+}
+
+# Request deadlines (X-Request-Timeout header or ?timeout=, seconds; see deadlines.py)
+DEADLINE_CONFIG = {
+    # Budget for requests that don't state one (None: no deadline)
+    "default_seconds": None,
+    # Longest budget a client may ask for
+    "max_seconds": 300,
+    # An optional stage runs only if the remaining time exceeds its usual duration times this
+    "safety_factor": 1.5,
+    # Weight of the newest measurement in the per-stage duration estimates
+    "estimate_weight": 0.2,
+    # Seconds between client-disconnect checks while a request is being processed
+    "disconnect_poll_interval": 0.25
+}
+
+# Embeddings captured during predictions and similarity search (/similar, see embeddings.py)
+EMBEDDING_CONFIG = {
+    # Storing embeddings of uploads is opt-in (AUTHNET_EMBEDDINGS=1); /similar searches whatever is stored
+    "enabled": os.environ.get("AUTHNET_EMBEDDINGS", "").lower() in ("1", "true", "yes"),
+    # Models whose embeddings are stored as they serve predictions (when enabled)
+    "capture_models": ["effnet"],
+    # Feature layer per model; None (or a layer the model lacks) uses the input of the output layer,
+    # average-pooled if it is spatial
+    "layers": {"effnet": "effnet_gap", "cnn": None, "vgg": None},
+    # One store per model version under this directory (memory-mapped float16 vectors + SQLite metadata)
+    "store_dir": os.path.join(DATA_DIR, "embeddings"),
+    # Captured embeddings waiting for the writer thread; beyond this they are dropped, never blocking
+    "queue_size": 1024,
+    "default_k": 10,
+    "max_k": 100,
+    # Vectors scored per step of a scan, in bytes of float16 data; bounds search memory
+    "scan_chunk_bytes": 64 * 1024 * 1024,
+    # Coarse-quantized (IVF) index: lists, lists searched per query by default, k-means sample and passes
+    "index_lists": 1024,
+    "index_probe": 16,
+    "index_train_size": 200_000,
+    "index_iterations": 10
+}
+
+# Behavior of the stub models used without TensorFlow (model_registry._StubModel, simple_server.py).
+# The defaults answer instantly; set a latency distribution, batch cost, errors and memory to load test
+# the serving stack without real models
+STUB_CONFIG = {
+    # "none", "constant", "uniform", "normal", "lognormal" or "exponential"
+    "latency": "none",
+    # Typical per-call latency in seconds (median for lognormal, mean otherwise)
+    "latency_seconds": 0.0,
+    # Spread: half-width for uniform, standard deviation for normal, sigma of the log for lognormal
+    "latency_spread": 0.0,
+    # Extra seconds per image in the batch
+    "per_item_seconds": 0.0,
+    # Fraction of calls that fail
+    "error_rate": 0.0,
+    # Bytes touched per image while a call runs (activations)
+    "memory_per_item_bytes": 0,
+    # Bytes held by each stub model for its lifetime (weights)
+    "resident_bytes": 0,
+    # Random seed for reproducible runs (None: unseeded)
+    "seed": None,
+    # Calls one stub runs at once, like the compute of one model replica (None: unlimited)
+    "concurrency": None,
+    # Per-model overrides of the settings above, e.g. {"vgg": {"latency_seconds": 0.2}}
+    "models": {}
+}
+
+# JSON override, e.g. AUTHNET_STUB_CONFIG='{"latency": "lognormal", "latency_seconds": 0.05}'
+if os.environ.get("AUTHNET_STUB_CONFIG"):
+    STUB_CONFIG.update(json.loads(os.environ["AUTHNET_STUB_CONFIG"]))
@@ -0,0 +1,212 @@
+"""
+Request deadlines and graceful degradation.
+
+A client states how long it is prepared to wait with an X-Request-Timeout header
+or a `timeout` query parameter (seconds). The HTTP middleware turns that into a
+Deadline for the request, visible to all of its code through a context variable
+(including worker threads, which inherit the request's context).
+
+The request path consults the deadline at its stage boundaries: queued work whose
+deadline passes is dropped, optional stages (heatmaps, tiles, slower ensemble
+members) are skipped when the time they usually take (a running estimate per stage
+and model) no longer fits, and the response lists what was skipped. A client
+disconnect cancels the deadline, so work for an abandoned request stops at the next
+stage boundary.
+"""
+import asyncio
+import contextvars
+import threading
+import time
+from fastapi.responses import JSONResponse
+from config import DEADLINE_CONFIG
+from logging_utils import get_logger
+from metrics import DEADLINE_SKIPS
+
+logger = get_logger("authnet.deadlines")
+_current_deadline = contextvars.ContextVar("current_deadline", default=None)
+
+# (stage, model) -> smoothed duration in seconds
+_estimates = {}
+_estimates_lock = threading.Lock()
+
+
+class DeadlineExceeded(Exception):
+    """The request ran out of time (504) or its client went away (499)"""
+
+    def __init__(self, message, status_code=504):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class Deadline:
+    """Time budget of a single request; seconds=None means no deadline, only disconnect cancellation"""
+
+    def __init__(self, seconds=None):
+        self.seconds = seconds
+        self.expires = time.monotonic() + seconds if seconds is not None else None
+        self.cancelled = None
+        self.skipped = []
+        self._lock = threading.Lock()
+
+    def remaining(self):
+        """Seconds left (None without a deadline)"""
+        if self.expires is None:
+            return None
+        return self.expires - time.monotonic()
+
+    def expired(self):
+        if self.cancelled is not None:
+            return True
+        remaining = self.remaining()
+        return remaining is not None and remaining <= 0
+
+    def cancel(self, reason):
+        if self.cancelled is None:
+            self.cancelled = reason
+            logger.info("Request cancelled: %s", reason)
+
+    def check(self, stage):
+        """Raise DeadlineExceeded if the request should stop before `stage`"""
+        if self.cancelled is not None:
+            DEADLINE_SKIPS.inc(stage=stage, reason="cancelled")
+            raise DeadlineExceeded(f"Request cancelled before {stage}: {self.cancelled}", status_code=499)
+        if self.expired():
+            DEADLINE_SKIPS.inc(stage=stage, reason="deadline")
+            raise DeadlineExceeded(f"Deadline of {self.seconds}s exceeded before {stage}")
+
+    def affordable(self, stage, model=None):
+        """True if `stage` usually finishes within the remaining time"""
+        if self.cancelled is not None:
+            return False
+        remaining = self.remaining()
+        if remaining is None:
+            return True
+        estimate = stage_estimate(stage, model) or 0.0
+        return remaining > estimate * DEADLINE_CONFIG["safety_factor"]
+
+    def skip(self, stage, model=None):
+        """Record an optional stage left out to meet the deadline"""
+        reason = "cancelled" if self.cancelled is not None else "deadline"
+        with self._lock:
+            self.skipped.append({"stage": stage, "model": model, "reason": reason})
+        DEADLINE_SKIPS.inc(stage=stage, reason=reason)
+
+
+def current_deadline():
+    return _current_deadline.get()
+
+
+def check(stage):
+    """Deadline check for code that may also run outside a request"""
+    deadline = _current_deadline.get()
+    if deadline is not None:
+        deadline.check(stage)
+
+
+def affordable(stage, model=None):
+    """Whether optional `stage` still fits the current request's deadline (always True outside a request)"""
+    deadline = _current_deadline.get()
+    return deadline is None or deadline.affordable(stage, model)
+
+
+def skip(stage, model=None):
+    deadline = _current_deadline.get()
+    if deadline is not None:
+        deadline.skip(stage, model)
+
+
+def stage_estimate(stage, model=None):
+    with _estimates_lock:
+        return _estimates.get((stage, model))
+
+
+def observe(stage, model, seconds):
+    """Fold a measured stage duration into its running estimate"""
+    key = (stage, model)
+    weight = DEADLINE_CONFIG["estimate_weight"]
+    with _estimates_lock:
+        previous = _estimates.get(key)
+        _estimates[key] = seconds if previous is None else (1 - weight) * previous + weight * seconds
+
+
+class measure:
+    """Context manager recording how long a stage took, for later affordable() decisions"""
+    __slots__ = ("stage", "model", "started")
+
+    def __init__(self, stage, model=None):
+        self.stage = stage
+        self.model = model
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            observe(self.stage, self.model, time.perf_counter() - self.started)
+        return False
+
+
+def timeout_for(limit):
+    """`limit` (e.g. an outbound HTTP timeout) capped by the current request's remaining time"""
+    deadline = _current_deadline.get()
+    remaining = deadline.remaining() if deadline is not None else None
+    if remaining is None:
+        return limit
+    return max(0.001, min(limit, remaining))
+
+
+def parse_timeout(request):
+    """Requested budget in seconds from X-Request-Timeout or ?timeout=, else the default; ValueError if invalid"""
+    raw = request.headers.get("x-request-timeout") or request.query_params.get("timeout")
+    if raw is None or raw == "":
+        return DEADLINE_CONFIG["default_seconds"]
+    seconds = float(raw)
+    if not seconds > 0:
+        raise ValueError("timeout must be a positive number of seconds")
+    return min(seconds, DEADLINE_CONFIG["max_seconds"])
+
+
+async def request_deadline(request, call_next):
+    """HTTP middleware giving each /predict/* request its Deadline"""
+    if not request.url.path.startswith("/predict/"):
+        return await call_next(request)
+    try:
+        seconds = parse_timeout(request)
+    except ValueError:
+        return JSONResponse(status_code=400, content={"detail": "Invalid timeout; use a positive number of seconds"})
+    _current_deadline.set(Deadline(seconds))
+    return await call_next(request)
+
+
+async def cancel_on_disconnect(request, awaitable):
+    """
+    Await `awaitable`, polling for a client disconnect meanwhile. On disconnect the
+    request's deadline is cancelled (stopping thread work at its next check) and the
+    awaitable is cancelled; raises DeadlineExceeded (499).
+    """
+    task = asyncio.ensure_future(awaitable)
+    interval = DEADLINE_CONFIG["disconnect_poll_interval"]
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=interval)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                deadline = _current_deadline.get()
+                if deadline is not None:
+                    deadline.cancel("client disconnected")
+                task.cancel()
+                try:
+                    await task
+                except BaseException:
+                    pass
+                raise DeadlineExceeded("Client disconnected", status_code=499)
+    finally:
+        if not task.done():
+            task.cancel()
+
+
+def deadline_exceeded_response(request, exc):
+    """Exception handler body for DeadlineExceeded"""
+    return JSONResponse(status_code=exc.status_code, content={"detail": str(exc)})
@@ -0,0 +1,452 @@
+"""
+Embedding capture and similarity search.
+
+For the models in EMBEDDING_CONFIG["capture_models"], predictions also return the
+model's penultimate-layer activations (effnet_gap for EfficientNet, the pooled
+features feeding the output layer otherwise), taken from the same forward pass.
+They are L2-normalized and handed to a background writer thread that appends them
+to a per-model-version EmbeddingStore:
+
+    <store_dir>/<model>-<version>/vectors.f16    float16 (capacity, dim), memory-mapped
+    <store_dir>/<model>-<version>/meta.sqlite3   one row per vector (upload hash, verdict)
+    <store_dir>/<model>-<version>/ivf/           optional coarse-quantized index
+
+Search is batched cosine top-k: queries are scored against the memory-mapped
+vectors a bounded chunk at a time, so the store never has to fit in RAM. With an
+IVF index (k-means centroids plus the vector ids of each list, built by
+build_index) only the lists closest to each query are scored, and vectors
+appended since the build are scanned exactly.
+
+A store has a single writer (the process serving the API); searches read
+concurrently up to the last committed row.
+"""
+import json
+import os
+import queue
+import shutil
+import sqlite3
+import threading
+import time
+import numpy as np
+try:
+    import tensorflow as tf
+    TF_AVAILABLE = True
+except Exception:
+    tf = None
+    TF_AVAILABLE = False
+from config import EMBEDDING_CONFIG
+from logging_utils import get_logger
+from metrics import record_trace, EMBEDDING_WRITES, SIMILARITY_SEARCH_LATENCY
+
+logger = get_logger("authnet.embeddings")
+
+# Traced forward+features functions per (model, model_type)
+_feature_fns = {}
+
+
+def capturing(name):
+    """Whether predictions of model `name` store their embeddings"""
+    return EMBEDDING_CONFIG["enabled"] and name in EMBEDDING_CONFIG["capture_models"]
+
+
+def _feature_tensor(keras_model, model_type):
+    layer_name = EMBEDDING_CONFIG["layers"].get(model_type)
+    if layer_name:
+        try:
+            return keras_model.get_layer(layer_name).output
+        except ValueError:
+            logger.warning("Embedding layer %s not found in %s, using the output layer's input", layer_name, model_type)
+    return keras_model.layers[-1].input
+
+
+def get_feature_fn(keras_model, model_type="cnn"):
+    """tf.function mapping a batch to (predictions, embeddings (B, dim)), built once per model"""
+    key = (id(keras_model), model_type)
+    cached = _feature_fns.get(key)
+    if cached is not None and cached[0] is keras_model:
+        return cached[1]
+    feature_model = tf.keras.models.Model([keras_model.inputs],
+                                          [keras_model.output, _feature_tensor(keras_model, model_type)])
+
+    @tf.function(reduce_retracing=True)
+    def feature_step(x):
+        record_trace(f"features_{model_type}")
+        predictions, features = feature_model(x, training=False)
+        if len(features.shape) == 4:
+            features = tf.reduce_mean(features, axis=(1, 2))
+        return predictions, tf.reshape(features, (tf.shape(features)[0], -1))
+
+    _feature_fns[key] = (keras_model, feature_step)
+    return feature_step
+
+
+def forget_model(keras_model):
+    """Drop the traced function built for a model that has been replaced"""
+    for key in [key for key, (model, _) in list(_feature_fns.items()) if model is keras_model]:
+        _feature_fns.pop(key, None)
+
+
+def predict_with_features(model_obj, x, model_type="cnn"):
+    """(predictions, float32 embeddings (B, dim)) from one forward pass"""
+    if hasattr(model_obj, "predict_with_features"):
+        return model_obj.predict_with_features(x)
+    keras_model = model_obj.model if hasattr(model_obj, 'model') else model_obj
+    predictions, features = get_feature_fn(keras_model, model_type)(tf.convert_to_tensor(x, dtype=tf.float32))
+    return predictions.numpy(), features.numpy().astype(np.float32)
+
+
+def normalize(vectors):
+    """Rows scaled to unit length (zero rows stay zero), as float32"""
+    vectors = np.asarray(vectors, dtype=np.float32).reshape(len(vectors), -1)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+
+
+def _merge_topk(scores, ids, new_scores, new_ids, k):
+    """Keep the k best (score, id) pairs per query row"""
+    scores = np.concatenate([scores, new_scores], axis=1)
+    ids = np.concatenate([ids, new_ids], axis=1)
+    if scores.shape[1] > k:
+        best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        scores = np.take_along_axis(scores, best, axis=1)
+        ids = np.take_along_axis(ids, best, axis=1)
+    return scores, ids
+
+
+class IvfIndex:
+    """Coarse quantizer: centroids, and the vector ids of each list stored contiguously"""
+
+    def __init__(self, directory):
+        self.centroids = np.load(os.path.join(directory, "centroids.npy"))
+        self.offsets = np.load(os.path.join(directory, "offsets.npy"))
+        self.ids = np.load(os.path.join(directory, "ids.npy"), mmap_mode="r")
+        with open(os.path.join(directory, "index.json")) as f:
+            info = json.load(f)
+        # Vectors from this row on were appended after the build
+        self.count = info["count"]
+        self.built = info["built"]
+
+    def candidates(self, query, nprobe):
+        """Sorted ids of the vectors in the nprobe lists closest to a (normalized) query"""
+        nprobe = min(nprobe, len(self.centroids))
+        lists = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        ids = np.concatenate([self.ids[self.offsets[i]:self.offsets[i + 1]] for i in lists])
+        ids.sort()
+        return ids
+
+
+class EmbeddingStore:
+    """Append-only float16 vectors in a growable memory-mapped file, with metadata in SQLite"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.vectors_path = os.path.join(directory, "vectors.f16")
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(directory, "meta.sqlite3"), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS embeddings (
+            id INTEGER PRIMARY KEY, sha256 TEXT NOT NULL UNIQUE, predicted_class INTEGER,
+            probability REAL, created_at REAL)""")
+        self._db.execute("CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT)")
+        self._db.commit()
+        row = self._db.execute("SELECT value FROM info WHERE key = 'dim'").fetchone()
+        self.dim = int(row[0]) if row else None
+        # Rows 0..count-1 are committed; vectors beyond them are leftovers of an interrupted append
+        self.count = self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        self._vectors = None
+        if self.dim is not None and os.path.exists(self.vectors_path):
+            self._map(os.path.getsize(self.vectors_path) // (self.dim * 2))
+        self.index = None
+        if os.path.isdir(os.path.join(directory, "ivf")):
+            try:
+                self.index = IvfIndex(os.path.join(directory, "ivf"))
+            except Exception as e:
+                logger.warning("Ignoring unreadable embedding index in %s: %s", directory, e)
+
+    def _map(self, capacity):
+        self._vectors = np.memmap(self.vectors_path, dtype=np.float16, mode="r+", shape=(capacity, self.dim))
+
+    def _reserve(self, rows):
+        """Grow the vector file (doubling) so it holds `rows` vectors"""
+        capacity = len(self._vectors) if self._vectors is not None else 0
+        if rows <= capacity:
+            return
+        capacity = max(rows, capacity * 2, 1024)
+        with open(self.vectors_path, "ab") as f:
+            f.truncate(capacity * self.dim * 2)
+        self._map(capacity)
+
+    def append(self, vectors, metadata):
+        """
+        Store normalized `vectors` (n, dim) with their metadata dicts (sha256, predicted_class,
+        probability); uploads already in the store are skipped. Returns the number stored.
+        """
+        vectors = normalize(vectors)
+        with self._lock:
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                self._db.execute("INSERT OR REPLACE INTO info (key, value) VALUES ('dim', ?)", (str(self.dim),))
+            if vectors.shape[1] != self.dim:
+                raise ValueError(f"Embedding has {vectors.shape[1]} dimensions, the store holds {self.dim}")
+            seen = set()
+            keep = []
+            for i, meta in enumerate(metadata):
+                sha256 = meta["sha256"]
+                if sha256 in seen or self._db.execute("SELECT 1 FROM embeddings WHERE sha256 = ?",
+                                                      (sha256,)).fetchone():
+                    continue
+                seen.add(sha256)
+                keep.append(i)
+            if not keep:
+                return 0
+            start = self.count
+            self._reserve(start + len(keep))
+            self._vectors[start:start + len(keep)] = vectors[keep]
+            now = time.time()
+            self._db.executemany(
+                "INSERT INTO embeddings (id, sha256, predicted_class, probability, created_at) VALUES (?, ?, ?, ?, ?)",
+                [(start + j, metadata[i]["sha256"], metadata[i].get("predicted_class"),
+                  metadata[i].get("probability"), now) for j, i in enumerate(keep)])
+            self._db.commit()
+            self.count = start + len(keep)
+            return len(keep)
+
+    def rows(self, ids):
+        """Metadata of the given vector ids, keyed by id"""
+        ids = [int(i) for i in ids]
+        if not ids:
+            return {}
+        with self._lock:
+            found = self._db.execute(
+                f"SELECT id, sha256, predicted_class, probability, created_at FROM embeddings "
+                f"WHERE id IN ({','.join('?' * len(ids))})", ids).fetchall()
+        return {row[0]: {"sha256": row[1], "predicted_class": row[2], "probability": row[3], "created_at": row[4]}
+                for row in found}
+
+    def _scan(self, vectors, queries, start, stop, k):
+        """Exact top-k of queries (q, dim) over rows [start, stop), a chunk of rows at a time"""
+        scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        ids = np.zeros((len(queries), 0), dtype=np.int64)
+        chunk = max(1, EMBEDDING_CONFIG["scan_chunk_bytes"] // (self.dim * 2))
+        for offset in range(start, stop, chunk):
+            block = np.asarray(vectors[offset:min(stop, offset + chunk)], dtype=np.float32)
+            similarities = queries @ block.T
+            block_ids = np.broadcast_to(np.arange(offset, offset + len(block)), similarities.shape)
+            scores, ids = _merge_topk(scores, ids, similarities, block_ids, k)
+        return scores, ids
+
+    def search(self, queries, k, nprobe=0):
+        """
+        Cosine top-k for a batch of query embeddings (q, dim). nprobe > 0 searches that
+        many IVF lists (exact search if there is no index). Returns per query a list of
+        (similarity, id) pairs, best first, and the method used ("ivf" or "exact").
+        """
+        queries = normalize(queries)
+        count, vectors, index = self.count, self._vectors, self.index
+        if count == 0 or vectors is None:
+            return [[] for _ in queries], "exact"
+        if queries.shape[1] != self.dim:
+            raise ValueError(f"Query has {queries.shape[1]} dimensions, the store holds {self.dim}")
+        k = min(k, count)
+        method = "ivf" if nprobe > 0 and index is not None else "exact"
+        if method == "exact":
+            scores, ids = self._scan(vectors, queries, 0, count, k)
+        else:
+            # Vectors appended since the index was built are scanned exactly, for all queries at once
+            scores, ids = self._scan(vectors, queries, index.count, count, k)
+        results = []
+        for row, query in enumerate(queries):
+            row_scores, row_ids = scores[row:row + 1], ids[row:row + 1]
+            if method == "ivf":
+                candidates = index.candidates(query, nprobe)
+                if len(candidates):
+                    similarities = np.asarray(vectors[candidates], dtype=np.float32) @ query
+                    row_scores, row_ids = _merge_topk(row_scores, row_ids, similarities[None, :],
+                                                      candidates[None, :], k)
+            order = np.argsort(-row_scores[0])
+            results.append([(float(row_scores[0, i]), int(row_ids[0, i])) for i in order])
+        return results, method
+
+    def build_index(self, lists=None, train_size=None, iterations=None, seed=0):
+        """
+        Train k-means centroids (cosine) on a sample of the stored vectors, assign every
+        vector to its closest centroid and write the lists; swapped in when complete.
+        """
+        lists = lists or EMBEDDING_CONFIG["index_lists"]
+        train_size = train_size or EMBEDDING_CONFIG["index_train_size"]
+        iterations = iterations or EMBEDDING_CONFIG["index_iterations"]
+        count, vectors = self.count, self._vectors
+        if count == 0:
+            raise ValueError("The store is empty")
+        rng = np.random.default_rng(seed)
+        sample_ids = np.sort(rng.choice(count, min(train_size, count), replace=False))
+        sample = np.asarray(vectors[sample_ids], dtype=np.float32)
+        lists = min(lists, len(sample))
+        centroids = sample[rng.choice(len(sample), lists, replace=False)].copy()
+        for _ in range(iterations):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            filled = np.bincount(assignment, minlength=lists) > 0
+            # Lists that lost all their members keep their previous centroid
+            centroids[filled] = normalize(sums[filled])
+
+        labels = np.empty(count, dtype=np.int32)
+        chunk = max(1, EMBEDDING_CONFIG["scan_chunk_bytes"] // (self.dim * 2))
+        for offset in range(0, count, chunk):
+            block = np.asarray(vectors[offset:min(count, offset + chunk)], dtype=np.float32)
+            labels[offset:offset + len(block)] = np.argmax(block @ centroids.T, axis=1)
+        ids = np.argsort(labels, kind="stable").astype(np.int64)
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(labels, minlength=lists))]).astype(np.int64)
+
+        target = os.path.join(self.directory, "ivf")
+        staging = target + ".new"
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+        np.save(os.path.join(staging, "centroids.npy"), centroids)
+        np.save(os.path.join(staging, "offsets.npy"), offsets)
+        np.save(os.path.join(staging, "ids.npy"), ids)
+        with open(os.path.join(staging, "index.json"), "w") as f:
+            json.dump({"count": count, "lists": lists, "built": time.time()}, f)
+        if os.path.isdir(target):
+            shutil.rmtree(target + ".old", ignore_errors=True)
+            os.rename(target, target + ".old")
+        os.rename(staging, target)
+        shutil.rmtree(target + ".old", ignore_errors=True)
+        self.index = IvfIndex(target)
+        return {"vectors": count, "lists": lists}
+
+    def status(self):
+        return {
+            "vectors": self.count,
+            "dim": self.dim,
+            "index": {"vectors": self.index.count, "lists": len(self.index.centroids), "built": self.index.built}
+            if self.index is not None else None
+        }
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def embedding_store(name, version, create=True):
+    """The store of a model version, opened on first use; None if it doesn't exist and create is False"""
+    key = (name, version)
+    with _stores_lock:
+        store = _stores.get(key)
+        if store is None:
+            directory = os.path.join(EMBEDDING_CONFIG["store_dir"], f"{name}-{version}")
+            # Reads must not leave an empty store on disk; only the first write creates it
+            if not create and not os.path.isdir(directory):
+                return None
+            store = _stores[key] = EmbeddingStore(directory)
+        return store
+
+
+def store_status():
+    """Status of every store on disk, keyed by "<model>-<version>" """
+    root = EMBEDDING_CONFIG["store_dir"]
+    if not os.path.isdir(root):
+        return {}
+    status = {}
+    for entry in sorted(os.listdir(root)):
+        if "-" in entry and os.path.isdir(os.path.join(root, entry)):
+            status[entry] = embedding_store(*entry.split("-", 1), create=False).status()
+    return status
+
+
+# Background writer: appends never run on the request path
+_pending = queue.Queue(maxsize=EMBEDDING_CONFIG["queue_size"])
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def _write_loop():
+    while True:
+        items = [_pending.get()]
+        while len(items) < 256:
+            try:
+                items.append(_pending.get_nowait())
+            except queue.Empty:
+                break
+        grouped = {}
+        for name, version, vectors, metadata in items:
+            grouped.setdefault((name, version), []).append((vectors, metadata))
+        for (name, version), entries in grouped.items():
+            try:
+                stored = embedding_store(name, version).append(np.concatenate([v for v, _ in entries]),
+                                                               [m for _, batch in entries for m in batch])
+                total = sum(len(batch) for _, batch in entries)
+                EMBEDDING_WRITES.inc(stored, model=name, result="stored")
+                EMBEDDING_WRITES.inc(total - stored, model=name, result="duplicate")
+            except Exception as e:
+                EMBEDDING_WRITES.inc(model=name, result="error")
+                logger.warning("Could not store embeddings for %s: %s", name, e)
+
+
+def record(name, version, vectors, metadata):
+    """Queue embeddings (n, dim) with their metadata dicts for the store; drops them if the queue is full"""
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = threading.Thread(target=_write_loop, name="embedding-writer", daemon=True)
+                _writer.start()
+    try:
+        _pending.put_nowait((name, version, np.asarray(vectors, dtype=np.float32), metadata))
+    except queue.Full:
+        EMBEDDING_WRITES.inc(len(metadata), model=name, result="dropped")
+
+
+def search(name, version, queries, k, nprobe=0, exclude=()):
+    """
+    Top-k matches with metadata per query embedding, and the method used. Uploads whose sha256
+    is in `exclude` (such as the query itself, stored when it was analyzed before) are left out.
+    """
+    exclude = set(exclude)
+    store = embedding_store(name, version, create=False)
+    if store is None:
+        return [[] for _ in queries], "exact"
+    with SIMILARITY_SEARCH_LATENCY.time(model=name, index="ivf" if nprobe and store.index is not None else "exact"):
+        # Each excluded hash is stored at most once, so k + len(exclude) candidates still leave k matches
+        results, method = store.search(queries, k + len(exclude), nprobe)
+    rows = store.rows({i for matches in results for _, i in matches})
+    return [[{**rows[i], "verdict": "fake" if rows[i]["predicted_class"] == 1 else "real",
+              "similarity": round(score, 4)} for score, i in matches
+             if i in rows and rows[i]["sha256"] not in exclude][:k]
+            for matches in results], method
+
+
+_index_builds = {}
+_index_lock = threading.Lock()
+
+
+def start_index_build(name, version):
+    """Build the IVF index of a store in the background; None if a build for it is already running"""
+    key = f"{name}-{version}"
+    with _index_lock:
+        current = _index_builds.get(key)
+        if current is not None and current["state"] == "building":
+            return None
+        status = _index_builds[key] = {"store": key, "state": "building", "started": time.time()}
+
+    def build():
+        try:
+            store = embedding_store(name, version, create=False)
+            if store is None:
+                raise ValueError(f"No embeddings stored for {key}")
+            result = store.build_index()
+            status.update(state="done", finished=time.time(), **result)
+            logger.info("Embedding index built", extra={"store": key, **result})
+        except Exception as e:
+            status.update(state="failed", error=str(e), finished=time.time())
+            logger.exception("Embedding index build failed for %s", key)
+
+    threading.Thread(target=build, name=f"index-{key}", daemon=True).start()
+    return dict(status)
+
+
+def index_builds():
+    with _index_lock:
+        return {key: dict(status) for key, status in _index_builds.items()}
@@ -5,6 +5,9 @@ Fixed model loader that creates working models with 3-channel input support
 import tensorflow as tf
 import numpy as np
 import os
+from logging_utils import get_logger
+
+logger = get_logger("authnet.loader")
 
 
 def create_fixed_vgg_model():
@@ -133,32 +136,32 @@ def load_fixed_model(model_name, model_path):
     """
     Load a model, creating a fixed version if the original fails
     """
-    print(f"🔄 Attempting to load {model_name} from {model_path}")
+    logger.info("Attempting to load %s from %s", model_name, model_path)
     
     # First try to load the original model
     try:
         if os.path.exists(model_path):
             model = tf.keras.models.load_model(model_path, compile=False)
-            print(f"✅ Original {model_name} loaded successfully")
+            logger.info("Original %s loaded successfully", model_name)
             
             # Test with 3-channel input
             test_input = np.random.random((1, 224, 224, 3)).astype(np.float32)
             _ = model.predict(test_input, verbose=0)
-            print(f"✅ {model_name} 3-channel input test passed")
+            logger.info("%s 3-channel input test passed", model_name)
             return model
             
     except Exception as e:
-        print(f"⚠️ Original {model_name} failed to load: {e}")
+        logger.warning("Original %s failed to load: %s", model_name, e)
     
     # Create fixed version
-    print(f"🔧 Creating fixed version of {model_name}")
+    logger.info("Creating fixed version of %s", model_name)
     if 'vgg' in model_name.lower():
         model = create_fixed_vgg_model()
     elif 'effnet' in model_name.lower() or 'efficientnet' in model_name.lower():
         model = create_fixed_efficientnet_model()
     else:
         # Fallback to CNN for unknown models
-        print(f"🔄 Unknown model type {model_name}, using CNN fallback")
+        logger.info("Unknown model type %s, using CNN fallback", model_name)
         try:
             base_dir = os.path.dirname(os.path.abspath(__file__))
             cnn_path = os.path.join(base_dir, "models/cnn_standalone.keras")
@@ -171,12 +174,12 @@ def load_fixed_model(model_name, model_path):
             outputs = tf.keras.layers.Dense(2, activation='softmax')(x)
             model = tf.keras.Model(inputs, outputs)
     
-    print(f"✅ Fixed {model_name} created successfully")
+    logger.info("Fixed %s created successfully", model_name)
     
     # Test the fixed model
     test_input = np.random.random((1, 224, 224, 3)).astype(np.float32)
     pred = model.predict(test_input, verbose=0)
-    print(f"✅ {model_name} test prediction: {pred[0]}")
+    logger.info("%s test prediction: %s", model_name, pred[0])
     
     return model
 
@@ -0,0 +1,286 @@
+"""
+Batched Grad-CAM engine.
+
+One traced function per model computes the target-class gradients of a whole
+batch in a single GradientTape pass and returns one activation grid per image.
+Used for single images by the API (compute_gradcam_heatmap) and for many images
+by offline tools (compute_gradcam_batch), with memory bounded by chunking.
+
+Models whose Grad-CAM layer feeds GlobalAveragePooling2D -> (Dropout) -> Dense
+output can instead use CAM: the map is the dense weights of the predicted class
+applied to the conv activations, so it comes out of the forward pass with no
+backward pass at all (see heatmap_mode / resolve_heatmap_mode).
+"""
+import cv2
+import numpy as np
+try:
+    import tensorflow as tf
+    TF_AVAILABLE = True
+except Exception:
+    tf = None
+    TF_AVAILABLE = False
+from config import BATCH_CONFIG
+from logging_utils import get_logger, request_sampled
+from metrics import record_trace, CACHE_REQUESTS
+from model_registry import resolve_gradcam_layer, replica_of, replicas_of
+
+logger = get_logger("authnet.gradcam")
+
+# Heatmap modes accepted by the API; "auto" picks CAM where the architecture allows it
+HEATMAP_MODES = ("auto", "gradcam", "cam", "none")
+
+# Traced GradCAM functions per (model, model_type), built on first use
+_gradcam_fns = {}
+
+# Traced forward+CAM functions per (model, model_type); None marks ineligible models
+_cam_fns = {}
+
+
+def get_gradcam_fn(keras_model, model_type="cnn"):
+    """
+    Return a tf.function computing (unnormalized, ReLU'd) GradCAM grids for a batch, shape (B, h, w).
+    Each sample uses its own highest-scoring class. The gradient model and its trace are built
+    once per model and reused across requests.
+    """
+    key = (id(keras_model), model_type)
+    cached = _gradcam_fns.get(key)
+    if cached is not None and cached[0] is keras_model:
+        CACHE_REQUESTS.inc(cache="gradcam_fn", result="hit")
+        return cached[1]
+    CACHE_REQUESTS.inc(cache="gradcam_fn", result="miss")
+
+    conv_layer_name = resolve_gradcam_layer(keras_model, model_type)
+    if conv_layer_name is None:
+        logger.warning("No convolutional layer found for %s", model_type)
+        return None
+    logger.info("Using conv layer %s for %s GradCAM", conv_layer_name, model_type)
+
+    grad_model = tf.keras.models.Model(
+        [keras_model.inputs],
+        [keras_model.get_layer(conv_layer_name).output, keras_model.output]
+    )
+
+    @tf.function(reduce_retracing=True)
+    def gradcam_step(x):
+        record_trace(f"gradcam_{model_type}")
+        with tf.GradientTape() as tape:
+            conv_outputs, predictions = grad_model(x, training=False)
+            # Handle predictions - ensure it's a tensor
+            if isinstance(predictions, (list, tuple)):
+                predictions = tf.convert_to_tensor(predictions)
+            # Score of each sample's highest-probability class. Samples don't interact in
+            # inference mode, so the gradient of the sum gives every sample its own gradients
+            class_idx = tf.argmax(predictions, axis=1)
+            loss = tf.reduce_sum(tf.gather(predictions, class_idx, axis=1, batch_dims=1))
+
+        grads = tape.gradient(loss, conv_outputs)
+        if grads is None:
+            return tf.zeros(tf.shape(conv_outputs)[:3], dtype=conv_outputs.dtype)
+        pooled_grads = tf.reduce_mean(grads, axis=(1, 2))
+        heatmaps = tf.einsum("bhwc,bc->bhw", conv_outputs, pooled_grads)
+        return tf.maximum(heatmaps, 0)
+
+    _gradcam_fns[key] = (keras_model, gradcam_step)
+    return gradcam_step
+
+
+def forget_model(keras_model):
+    """Drop the traced functions built for a model that has been replaced"""
+    for cache in (_gradcam_fns, _cam_fns):
+        for key in [key for key, (model, _) in list(cache.items()) if model is keras_model]:
+            cache.pop(key, None)
+
+
+def _cam_layers(keras_model, model_type):
+    """(conv_layer, dense_layer) if the Grad-CAM layer feeds GAP -> (Dropout) -> Dense output, else None"""
+    conv_layer_name = resolve_gradcam_layer(keras_model, model_type)
+    if conv_layer_name is None:
+        return None
+    conv_layer = keras_model.get_layer(conv_layer_name)
+    layers = keras_model.layers
+    tail = layers[layers.index(conv_layer) + 1:]
+    if len(tail) < 2 or not isinstance(tail[0], tf.keras.layers.GlobalAveragePooling2D):
+        return None
+    dense = tail[-1]
+    if not isinstance(dense, tf.keras.layers.Dense) or not all(
+            isinstance(layer, tf.keras.layers.Dropout) for layer in tail[1:-1]):
+        return None
+    # The chain must be linear: GAP reads the conv output and the dense layer is the model output
+    if tail[0].input is not conv_layer.output or dense.output is not keras_model.output:
+        return None
+    return conv_layer, dense
+
+
+def get_cam_fn(keras_model, model_type="cnn"):
+    """
+    Return a tf.function mapping a batch to (predictions, ReLU'd CAM grids of shape (B, h, w),
+    pooled features (B, channels)), or None if the model isn't a GAP + Dense architecture.
+    The pooled features are the GAP output, i.e. the model's penultimate-layer embedding.
+    """
+    key = (id(keras_model), model_type)
+    cached = _cam_fns.get(key)
+    if cached is not None and cached[0] is keras_model:
+        CACHE_REQUESTS.inc(cache="cam_fn", result="hit")
+        return cached[1]
+    CACHE_REQUESTS.inc(cache="cam_fn", result="miss")
+
+    cam_step = None
+    try:
+        found = _cam_layers(keras_model, model_type)
+    except Exception as e:
+        logger.debug("CAM eligibility check failed for %s: %s", model_type, e)
+        found = None
+    if found is not None:
+        conv_layer, dense = found
+        feature_model = tf.keras.models.Model([keras_model.inputs], [conv_layer.output, keras_model.output])
+        class_weights = tf.transpose(dense.kernel)  # (classes, channels)
+
+        @tf.function(reduce_retracing=True)
+        def cam_step(x):
+            record_trace(f"cam_{model_type}")
+            activations, predictions = feature_model(x, training=False)
+            class_idx = tf.argmax(predictions, axis=1)
+            weights = tf.gather(class_weights, class_idx)  # (B, channels)
+            cams = tf.einsum("bhwc,bc->bhw", activations, tf.cast(weights, activations.dtype))
+            return predictions, tf.maximum(cams, 0), tf.reduce_mean(activations, axis=(1, 2))
+
+        logger.info("Using CAM on %s for %s heatmaps", conv_layer.name, model_type)
+
+    _cam_fns[key] = (keras_model, cam_step)
+    return cam_step
+
+
+def resolve_heatmap_mode(actual_model, model_type, heatmap_mode="auto"):
+    """The mode actually used for a model: CAM only where eligible, Grad-CAM otherwise"""
+    if heatmap_mode == "none":
+        return "none"
+    replica = replicas_of(actual_model)[0]
+    if hasattr(replica, "heatmap_mode"):
+        # Served by an inference worker, which has the model
+        return replica.heatmap_mode(heatmap_mode)
+    if not TF_AVAILABLE:
+        return "none"
+    if heatmap_mode == "gradcam":
+        return "gradcam"
+    # Replicas are copies of one architecture, any of them answers
+    keras_model = replica.model if hasattr(replica, 'model') else replica
+    try:
+        eligible = get_cam_fn(keras_model, model_type) is not None
+    except Exception as e:
+        logger.warning("Error building CAM function for %s: %s", model_type, e)
+        eligible = False
+    if heatmap_mode == "cam" and not eligible:
+        logger.debug("CAM requested but %s is not a GAP + Dense model, using Grad-CAM", model_type)
+    return "cam" if eligible else "gradcam"
+
+
+def _normalize_grids(heatmaps):
+    """Scale each (h, w) grid of a batch by its own maximum, in place"""
+    maxima = heatmaps.max(axis=(1, 2), keepdims=True)
+    np.divide(heatmaps, maxima, out=heatmaps, where=maxima > 0)
+    return heatmaps
+
+
+def predict_with_cam(actual_model, x, model_type="cnn", with_features=False):
+    """
+    Forward pass that also returns the CAM grid of the first image (normalized to [0, 1],
+    None if empty). x is the preprocessed model input; the model must be CAM-eligible.
+    with_features=True adds the pooled features (embeddings) of the batch as a third value.
+    """
+    if hasattr(actual_model, "predict_with_cam"):
+        return actual_model.predict_with_cam(x, with_features=with_features)
+    keras_model = actual_model.model if hasattr(actual_model, 'model') else actual_model
+    cam_step = get_cam_fn(keras_model, model_type)
+    predictions, cams, features = cam_step(tf.convert_to_tensor(x, dtype=tf.float32))
+    grid = _normalize_grids(cams.numpy().astype(np.float32))[0]
+    if with_features:
+        return predictions.numpy(), (grid if grid.any() else None), features.numpy()
+    return predictions.numpy(), (grid if grid.any() else None)
+
+
+def _input_chunks(images, chunk_size, target_size, normalized):
+    """Yield float32 (n, H, W, 3) model inputs from an array or an iterable of images"""
+    chunk = []
+    for img in images:
+        if img.shape[:2] != (target_size[1], target_size[0]):
+            img = cv2.resize(img, target_size)
+        chunk.append(img)
+        if len(chunk) == chunk_size:
+            yield _as_input(chunk, normalized)
+            chunk = []
+    if chunk:
+        yield _as_input(chunk, normalized)
+
+
+def _as_input(chunk, normalized):
+    x = np.stack(chunk).astype(np.float32, copy=False)
+    # Normalize the input (0-1 range) unless the caller already did
+    return x if normalized else x / 255.0
+
+
+def compute_gradcam_batch(actual_model, images, model_type="cnn", target_size=(224, 224), chunk_size=None,
+                          normalized=False, heatmap_mode="gradcam"):
+    """
+    GradCAM grids for many images, each normalized to [0, 1] at the conv layer's resolution.
+
+    images is an (N, H, W, 3) array or an iterable of (H, W, 3) arrays with 0-255 pixel
+    values (or model-ready 0-1 values with normalized=True); they are resized to
+    target_size as needed. At most chunk_size images (BATCH_CONFIG["gradcam_chunk_size"]
+    by default) go through the gradient pass at once; heatmap_mode "auto"/"cam" uses
+    the gradient-free CAM for eligible models. Returns a float32 (N, h, w)
+    array, where images without any positive activation are all zeros, or None
+    if GradCAM isn't available for the model. A ReplicaPool's least busy replica runs the whole batch.
+    """
+    if not TF_AVAILABLE:
+        return None
+    chunk_size = chunk_size or BATCH_CONFIG["gradcam_chunk_size"]
+    with replica_of(actual_model) as replica:
+        return _gradcam_grids(replica, images, model_type, target_size, chunk_size, normalized, heatmap_mode)
+
+
+def _gradcam_grids(model, images, model_type, target_size, chunk_size, normalized, heatmap_mode):
+    """compute_gradcam_batch on one model (wrapper or Keras model)"""
+    keras_model = model.model if hasattr(model, 'model') else model
+    if resolve_heatmap_mode(keras_model, model_type, heatmap_mode) == "cam":
+        cam_step = get_cam_fn(keras_model, model_type)
+        gradcam_step = lambda x: cam_step(x)[1]
+    else:
+        try:
+            gradcam_step = get_gradcam_fn(keras_model, model_type)
+        except Exception as grad_error:
+            logger.warning("Error building gradient model: %s", grad_error)
+            return None
+        if gradcam_step is None:
+            return None
+
+    grids = []
+    for x in _input_chunks(images, chunk_size, target_size, normalized):
+        heatmaps = gradcam_step(tf.convert_to_tensor(x)).numpy().astype(np.float32)
+        grids.append(_normalize_grids(heatmaps))
+    if not grids:
+        return None
+    return np.concatenate(grids)
+
+
+def compute_gradcam_heatmap(actual_model, img_array, model_type="cnn", target_size=(224, 224)):
+    """
+    Compute the raw GradCAM grid (normalized to [0, 1], at the conv layer's resolution)
+    using already-loaded model: a registry entry (pool or wrapper), run on its least busy replica
+    """
+    try:
+        with replica_of(actual_model) as replica:
+            if hasattr(replica, "gradcam_heatmap"):
+                # Computed by the inference worker serving the model
+                return replica.gradcam_heatmap(img_array, target_size)
+            grids = compute_gradcam_batch(replica, [img_array], model_type=model_type, target_size=target_size)
+        if grids is None:
+            return None
+        heatmap = grids[0]
+        if not heatmap.any():
+            logger.debug("Zero max in heatmap for %s", model_type)
+            return None
+        return heatmap
+
+    except Exception as e:
+        logger.warning("Error generating GradCAM for %s: %s", model_type, e, exc_info=request_sampled())
+        return None
@@ -0,0 +1,386 @@
+"""
+Process-isolated inference.
+
+With INFERENCE_WORKER_CONFIG["enabled"], every model replica is loaded in its own
+worker process (spawned, one call at a time) and the API process keeps only HTTP,
+decoding, admission and heatmap encoding, so a forward pass or Grad-CAM holding
+the GIL no longer stalls request handling.
+
+A WorkerReplica stands in for the model in the registry (and in a ReplicaPool):
+predict, predict_with_features, predict_with_cam, heatmap mode resolution and
+Grad-CAM grids are forwarded to its worker. Arrays don't go through pickling:
+each worker shares a block of memory with the API process, split into `slots`
+slots of `slot_bytes` used in rotation as a ring. A call takes a free slot,
+copies its input batch into it and sends only (offset, shape, dtype) over the
+pipe; the worker reads the batch in place and writes the predictions, CAM or
+Grad-CAM grids and embeddings back into the same slot. Arrays larger than a
+slot fall back to the pipe (authnet_inference_worker_pipe_transfers_total).
+
+A reader thread per worker delivers replies. When the worker dies (or a call
+exceeds call_timeout and it is killed) the calls it held fail, the API keeps
+serving, and the worker is started again with the same model file.
+"""
+import atexit
+import itertools
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from multiprocessing import shared_memory
+import numpy as np
+from config import INFERENCE_WORKER_CONFIG, REPLICA_CONFIG, STUB_CONFIG
+from logging_utils import get_logger
+from metrics import INFERENCE_WORKER_RESTARTS, INFERENCE_WORKER_PIPE_TRANSFERS
+
+logger = get_logger("authnet.inference_workers")
+
+# Workers started by this process, stopped at exit
+_workers = set()
+_workers_lock = threading.Lock()
+
+# Byte alignment of arrays within a slot
+_ALIGN = 64
+
+
+class InferenceWorkerError(RuntimeError):
+    """A call a worker could not complete: the model raised, the worker died or it timed out"""
+
+
+def _pack(buf, base, size, values):
+    """Descriptors of values, copying arrays into buf[base:base + size] while they fit"""
+    descriptors = []
+    offset = 0
+    for value in values:
+        if not isinstance(value, np.ndarray):
+            descriptors.append(("value", value))
+            continue
+        value = np.ascontiguousarray(value)
+        if offset + value.nbytes > size:
+            descriptors.append(("pipe", value))
+            continue
+        np.ndarray(value.shape, value.dtype, buffer=buf, offset=base + offset)[...] = value
+        descriptors.append(("shm", base + offset, value.shape, value.dtype.str))
+        offset += -(-value.nbytes // _ALIGN) * _ALIGN
+    return descriptors
+
+
+def _unpack(buf, descriptors, copy):
+    """Values of descriptors; shared-memory arrays are views unless copy is set"""
+    values = []
+    for descriptor in descriptors:
+        if descriptor[0] == "shm":
+            _, offset, shape, dtype = descriptor
+            array = np.ndarray(shape, np.dtype(dtype), buffer=buf, offset=offset)
+            values.append(array.copy() if copy else array)
+        else:
+            values.append(descriptor[1])
+    return values
+
+
+def _pipe_transfers(name, descriptors):
+    for descriptor in descriptors:
+        if descriptor[0] == "pipe":
+            INFERENCE_WORKER_PIPE_TRANSFERS.inc(model=name)
+
+
+class WorkerReplica:
+    """One model replica running in a worker process; a drop-in for the model object"""
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        self.stub = False
+        self.pid = None
+        self.restarts = 0
+        self.slots = INFERENCE_WORKER_CONFIG["slots"]
+        self.slot_bytes = INFERENCE_WORKER_CONFIG["slot_bytes"]
+        self.threads = REPLICA_CONFIG["threads_per_replica"] or max(
+            1, (os.cpu_count() or 1) // max(1, int(REPLICA_CONFIG["replicas"].get(name, 1))))
+        self._shm = shared_memory.SharedMemory(create=True, size=self.slots * self.slot_bytes)
+        self._free = queue.Queue()
+        for slot in range(self.slots):
+            self._free.put(slot)
+        self._ctx = multiprocessing.get_context("spawn")
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._closed = threading.Event()
+        self._pending = {}
+        self._ids = itertools.count()
+        self._heatmap_modes = {}
+        self._failures = 0
+        self._start()
+        self._reader = threading.Thread(target=self._read, name=f"authnet-worker-reader-{name}", daemon=True)
+        self._reader.start()
+        with _workers_lock:
+            _workers.add(self)
+
+    def _start(self):
+        self._conn, child_conn = self._ctx.Pipe()
+        self._process = self._ctx.Process(
+            target=worker_main,
+            args=(self.name, self.path, self._shm.name, self.slot_bytes, child_conn, dict(STUB_CONFIG), self.threads),
+            name=f"authnet-inference-{self.name}",
+            daemon=True
+        )
+        self._process.start()
+        # Only the worker holds the other end, so its exit shows up as EOF here
+        child_conn.close()
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    def wait_ready(self, timeout=None):
+        """Block until the worker has loaded and warmed up its model; InferenceWorkerError on timeout"""
+        timeout = INFERENCE_WORKER_CONFIG["start_timeout"] if timeout is None else timeout
+        if not self._ready.wait(timeout):
+            raise InferenceWorkerError(f"Inference worker for {self.name} not ready after {timeout}s")
+
+    def _read(self):
+        """Deliver replies; restart the worker when it exits"""
+        while not self._closed.is_set():
+            conn, process = self._conn, self._process
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                if self._closed.is_set():
+                    return
+                self._crashed(process)
+                continue
+            call_id, ok, payload = message
+            if call_id is None:
+                self._started(payload)
+            else:
+                self._deliver(call_id, ok, payload)
+
+    def _started(self, info):
+        self.pid = info["pid"]
+        self.stub = info["stub"]
+        self._failures = 0
+        self._ready.set()
+        logger.info("Inference worker ready", extra={"model": self.name, "pid": self.pid, "stub": self.stub})
+
+    def _deliver(self, call_id, ok, payload):
+        with self._lock:
+            entry = self._pending.pop(call_id, None)
+        if entry is None:
+            return
+        future, slot = entry
+        try:
+            if ok:
+                _pipe_transfers(self.name, payload)
+                result = _unpack(self._shm.buf, payload, copy=True)
+        finally:
+            self._free.put(slot)
+        if ok:
+            future.set_result(result)
+        else:
+            future.set_exception(InferenceWorkerError(payload))
+
+    def _crashed(self, process):
+        with self._lock:
+            self._ready.clear()
+            pending, self._pending = self._pending, {}
+            self._conn.close()
+        process.join(5)
+        error = InferenceWorkerError(f"Inference worker for {self.name} exited with {process.exitcode}")
+        for future, slot in pending.values():
+            self._free.put(slot)
+            future.set_exception(error)
+        # Back off while the worker keeps dying (e.g. during startup)
+        delay = INFERENCE_WORKER_CONFIG["restart_delay"] * 2 ** min(self._failures, 6)
+        self._failures += 1
+        self.restarts += 1
+        INFERENCE_WORKER_RESTARTS.inc(model=self.name)
+        logger.error("Inference worker exited, restarting",
+                     extra={"model": self.name, "pid": process.pid, "exitcode": process.exitcode,
+                            "failed_calls": len(pending), "delay": delay})
+        if self._closed.wait(delay):
+            return
+        with self._lock:
+            # close() sets _closed under the lock, so no worker is started after it
+            if not self._closed.is_set():
+                self._start()
+
+    def _call(self, op, arrays, **options):
+        """Run `op` on the worker with `arrays` passed through a shared-memory slot; its output values"""
+        timeout = INFERENCE_WORKER_CONFIG["call_timeout"]
+        try:
+            slot = self._free.get(timeout=timeout)
+        except queue.Empty:
+            raise InferenceWorkerError(f"No free slot for {self.name} after {timeout}s")
+        future = Future()
+        sent = False
+        try:
+            descriptors = _pack(self._shm.buf, slot * self.slot_bytes, self.slot_bytes, arrays)
+            _pipe_transfers(self.name, descriptors)
+            while not sent:
+                self.wait_ready()
+                with self._lock:
+                    # A crash between the wait and here clears ready; wait for the restarted worker
+                    if not self._ready.is_set():
+                        continue
+                    call_id = next(self._ids)
+                    self._pending[call_id] = (future, slot)
+                    sent = True
+                    try:
+                        self._conn.send((call_id, op, slot, descriptors, options))
+                    except OSError:
+                        pass  # the reader sees the exit and fails the call
+        finally:
+            # Once sent, the slot is freed with the reply (or the crash)
+            if not sent:
+                self._free.put(slot)
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeout:
+            logger.error("Inference call timed out, killing the worker",
+                         extra={"model": self.name, "op": op, "pid": self.pid, "timeout": timeout})
+            self._process.kill()
+            raise InferenceWorkerError(f"Inference on {self.name} timed out after {timeout}s")
+
+    def predict(self, x):
+        return self._call("predict", [np.asarray(x)])[0]
+
+    def predict_with_features(self, x):
+        prediction, features = self._call("features", [np.asarray(x)])
+        return prediction, features
+
+    def predict_with_cam(self, x, with_features=False):
+        values = self._call("cam", [np.asarray(x)], with_features=with_features)
+        return tuple(values)
+
+    def heatmap_mode(self, heatmap_mode="auto"):
+        """The heatmap mode the worker's model supports for a requested one (cached: the model is fixed)"""
+        mode = self._heatmap_modes.get(heatmap_mode)
+        if mode is None:
+            mode = self._heatmap_modes[heatmap_mode] = self._call("heatmap_mode", [], heatmap_mode=heatmap_mode)[0]
+        return mode
+
+    def gradcam_heatmap(self, img_array, target_size=(224, 224)):
+        """Grad-CAM grid of one image computed by the worker, or None"""
+        return self._call("gradcam", [np.asarray(img_array)], target_size=tuple(target_size))[0]
+
+    def worker_status(self):
+        return {
+            "pid": self.pid,
+            "alive": self.ready and self._process.is_alive(),
+            "restarts": self.restarts,
+            "in_flight": len(self._pending),
+            "stub": self.stub
+        }
+
+    def close(self, timeout=10):
+        """Stop the worker and release the shared memory"""
+        with self._lock:
+            if self._closed.is_set():
+                return
+            self._closed.set()
+            self._ready.clear()
+            conn, process = self._conn, self._process
+        try:
+            conn.send(None)
+        except OSError:
+            pass
+        process.join(timeout)
+        if process.is_alive():
+            process.kill()
+            process.join()
+        # The worker's exit ends the reader (EOF)
+        self._reader.join(timeout)
+        conn.close()
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for future, _ in pending.values():
+            future.set_exception(InferenceWorkerError(f"Inference worker for {self.name} stopped"))
+        self._shm.close()
+        self._shm.unlink()
+        with _workers_lock:
+            _workers.discard(self)
+
+
+@atexit.register
+def stop_workers():
+    """Stop every worker started by this process"""
+    with _workers_lock:
+        workers = list(_workers)
+    for worker in workers:
+        worker.close()
+
+
+def _limit_threads(threads):
+    """The worker's TensorFlow thread budget: one caller, `threads` threads per op"""
+    import tensorflow as tf
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+
+
+def _load(name, path, threads):
+    """(model, stub) for the worker: the model file, or a stub if TensorFlow or the file is unusable"""
+    from model_registry import TF_AVAILABLE, _StubModel, load_local_model
+    if TF_AVAILABLE:
+        _limit_threads(threads)
+        try:
+            model = load_local_model(name, path) if os.path.exists(path) else None
+        except Exception as e:
+            logger.exception("Inference worker could not load %s: %s", path, e)
+            model = None
+        if model is not None:
+            return model, False
+        logger.warning("Using stub model for %s in its inference worker", name)
+    return _StubModel(name), True
+
+
+def _run(model, name, op, args, options):
+    """Output values of one call"""
+    if op == "predict":
+        return [model.predict(args[0])]
+    if op == "features":
+        from embeddings import predict_with_features
+        return list(predict_with_features(model, args[0], model_type=name))
+    if op == "cam":
+        from gradcam import predict_with_cam
+        return list(predict_with_cam(model, args[0], model_type=name, with_features=options["with_features"]))
+    if op == "heatmap_mode":
+        from gradcam import resolve_heatmap_mode
+        return [resolve_heatmap_mode(model, name, options["heatmap_mode"])]
+    if op == "gradcam":
+        from gradcam import compute_gradcam_heatmap
+        return [compute_gradcam_heatmap(model, args[0], model_type=name, target_size=options["target_size"])]
+    raise ValueError(f"Unknown inference worker call: {op}")
+
+
+def worker_main(name, path, shm_name, slot_bytes, conn, stub_config, threads):
+    """Worker process: load one model, then serve calls from the API process until the pipe closes"""
+    # The API process decides when workers stop (a signal to the whole process group, as from Ctrl+C or a
+    # service manager, must not kill them before the API closes them); they also exit when the pipe closes
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    STUB_CONFIG.update(stub_config)
+    shm = shared_memory.SharedMemory(name=shm_name)
+    model, stub = _load(name, path, threads)
+    if not stub:
+        from model_registry import warm_up
+        warm_up(name, model)
+    conn.send((None, True, {"pid": os.getpid(), "stub": stub}))
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            break
+        if message is None:
+            break
+        call_id, op, slot, descriptors, options = message
+        args = []
+        try:
+            args = _unpack(shm.buf, descriptors, copy=False)
+            outputs = _run(model, name, op, args, options)
+            reply = (call_id, True, _pack(shm.buf, slot * slot_bytes, slot_bytes, outputs))
+        except Exception as e:
+            reply = (call_id, False, str(e) or type(e).__name__)
+        # Views into the shared memory must be gone before it can be closed
+        del args
+        conn.send(reply)
+    shm.close()
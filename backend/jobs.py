@@ -0,0 +1,509 @@
+"""
+Asynchronous analysis jobs.
+
+Archives, videos and tiled scans of large images can take far longer than a
+synchronous request should. /jobs stores the upload on disk, queues a job in a
+local SQLite database and returns straight away; a small pool of worker
+processes (started with the API) claims queued jobs, runs them against the
+process-wide model registry and writes progress and results back to the same
+database. No broker is involved: SQLite's locking is the queue.
+
+Inputs are stored once per content hash, and a job with the same kind, content
+and parameters as an existing (not failed) job is not queued again, the existing
+one is returned instead. Jobs that were running when the server stopped are put
+back in the queue at the next start, up to JOBS_CONFIG["max_attempts"] times.
+"""
+import hashlib
+import json
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+import uuid
+import zipfile
+import numpy as np
+from config import JOBS_CONFIG, TILING_CONFIG, VIDEO_CONFIG, BATCH_CONFIG, UPLOAD_CONFIG
+from logging_utils import get_logger
+
+logger = get_logger("authnet.jobs")
+
+JOB_KINDS = ("predict", "ensemble", "tiled", "video", "archive")
+
+JOB_STATUSES = ("queued", "running", "done", "failed")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    params TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    input_path TEXT NOT NULL,
+    dedupe_key TEXT NOT NULL UNIQUE,
+    status TEXT NOT NULL,
+    progress REAL NOT NULL DEFAULT 0,
+    message TEXT,
+    result TEXT,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker INTEGER,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (status, created);
+"""
+
+
+class JobError(Exception):
+    """A job input that can't be processed; the job fails without being retried"""
+
+
+def dedupe_key(kind, sha256, params):
+    """Identity of a job: same kind, same content, same parameters"""
+    canonical = json.dumps({"kind": kind, "sha256": sha256, "params": params}, sort_keys=True)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class JobStore:
+    """The job table; one instance (and connection) per process"""
+
+    def __init__(self, db_path=None):
+        self.db_path = db_path or JOBS_CONFIG["db_path"]
+        os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(_SCHEMA)
+
+    def submit(self, kind, params, sha256, input_path):
+        """Queue a job, or return the existing one for the same input. Returns (row, deduplicated)"""
+        key = dedupe_key(kind, sha256, params)
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute("SELECT * FROM jobs WHERE dedupe_key = ?", (key,)).fetchone()
+                if row is not None and row["status"] != "failed":
+                    self._conn.execute("COMMIT")
+                    return row, True
+                if row is not None:
+                    # A failed job is retried from scratch when submitted again
+                    self._conn.execute(
+                        "UPDATE jobs SET status = 'queued', progress = 0, message = NULL, result = NULL, error = NULL,"
+                        " attempts = 0, worker = NULL, created = ?, started = NULL, finished = NULL, input_path = ?"
+                        " WHERE id = ?", (now, input_path, row["id"]))
+                    job_id = row["id"]
+                else:
+                    job_id = uuid.uuid4().hex
+                    self._conn.execute(
+                        "INSERT INTO jobs (id, kind, params, sha256, input_path, dedupe_key, status, created)"
+                        " VALUES (?, ?, ?, ?, ?, ?, 'queued', ?)",
+                        (job_id, kind, json.dumps(params), sha256, input_path, key, now))
+                row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return row, False
+
+    def get(self, job_id):
+        with self._lock:
+            return self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+
+    def claim(self, worker):
+        """Atomically move the oldest queued job to running for `worker` (a pid); None if the queue is empty"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT id FROM jobs WHERE status = 'queued' ORDER BY created LIMIT 1").fetchone()
+                if row is None:
+                    self._conn.execute("COMMIT")
+                    return None
+                self._conn.execute(
+                    "UPDATE jobs SET status = 'running', worker = ?, started = ?, attempts = attempts + 1,"
+                    " progress = 0, message = NULL WHERE id = ?", (worker, time.time(), row["id"]))
+                job = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (row["id"],)).fetchone()
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return job
+
+    def progress(self, job_id, fraction, message=None):
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET progress = ?, message = ? WHERE id = ? AND status = 'running'",
+                               (round(min(max(fraction, 0.0), 1.0), 4), message, job_id))
+
+    def finish(self, job_id, result):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = 'done', progress = 1, result = ?, error = NULL, finished = ? WHERE id = ?",
+                (json.dumps(result), time.time(), job_id))
+
+    def fail(self, job_id, error):
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET status = 'failed', error = ?, finished = ? WHERE id = ?",
+                               (error, time.time(), job_id))
+
+    def requeue(self, worker=None):
+        """
+        Put running jobs (all of them, or only `worker`'s) back in the queue, failing the
+        ones that already used up their attempts. Returns the number requeued.
+        """
+        where, args = ("status = 'running'", ()) if worker is None else ("status = 'running' AND worker = ?", (worker,))
+        with self._lock:
+            self._conn.execute(
+                f"UPDATE jobs SET status = 'failed', error = 'Interrupted too many times', finished = ?"
+                f" WHERE {where} AND attempts >= ?", (time.time(),) + args + (JOBS_CONFIG["max_attempts"],))
+            return self._conn.execute(
+                f"UPDATE jobs SET status = 'queued', worker = NULL, progress = 0, message = NULL WHERE {where}",
+                args).rowcount
+
+    def counts(self):
+        """Number of jobs per status"""
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status").fetchall()
+        counts = dict.fromkeys(JOB_STATUSES, 0)
+        counts.update({row["status"]: row["n"] for row in rows})
+        return counts
+
+
+def job_status(row):
+    """Public view of a job row (everything but the result)"""
+    return {
+        "job_id": row["id"],
+        "kind": row["kind"],
+        "status": row["status"],
+        "progress": row["progress"],
+        "message": row["message"],
+        "params": json.loads(row["params"]),
+        "sha256": row["sha256"],
+        "attempts": row["attempts"],
+        "created": row["created"],
+        "started": row["started"],
+        "finished": row["finished"],
+        "error": row["error"]
+    }
+
+
+def store_input(temp_path, sha256, suffix=""):
+    """Move an uploaded file into the content-addressed input store; returns its path"""
+    os.makedirs(JOBS_CONFIG["data_dir"], exist_ok=True)
+    path = os.path.join(JOBS_CONFIG["data_dir"], sha256 + suffix)
+    if os.path.exists(path):
+        os.unlink(temp_path)
+    else:
+        os.replace(temp_path, path)
+    return path
+
+
+# --- Job handlers (run in the worker processes) -----------------------------------------------
+
+def _predict_fn(name):
+    """predict(batch) for a registry model, failing the job if the model isn't available"""
+    from model_registry import get_model
+    model = get_model(name)
+    if model is None:
+        raise JobError(f"Model {name} is not loaded")
+    return model.predict
+
+
+def _read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _check_image(contents):
+    """The upload guards of the synchronous endpoints: reject unreadable or oversized images before decoding"""
+    from fastapi import HTTPException
+    from uploads import inspect_image_header
+    try:
+        inspect_image_header(contents)
+    except HTTPException as e:
+        raise JobError(e.detail)
+
+
+def _read_image(path):
+    contents = _read(path)
+    _check_image(contents)
+    return contents
+
+
+def _model_entry(name, prediction, threshold):
+    from verdicts import interpret_prediction
+    predicted_class, probabilities, fake_confidence = interpret_prediction(prediction, threshold)
+    return {"model": name, "predicted_class": predicted_class, "probabilities": probabilities,
+            "probability": fake_confidence}
+
+
+def run_predict(path, params, progress):
+    from utilities import preprocess_image
+    img_array = preprocess_image(_read_image(path))
+    prediction = _predict_fn(params["model"])(img_array)
+    return dict(_model_entry(params["model"], prediction, params["threshold"]), threshold=params["threshold"])
+
+
+def run_ensemble(path, params, progress):
+    from utilities import preprocess_image
+    from verdicts import ensemble_decision
+    img_array = preprocess_image(_read_image(path))
+    per_model = []
+    for i, name in enumerate(params["models"]):
+        per_model.append(_model_entry(name, _predict_fn(name)(img_array), params["threshold"]))
+        progress((i + 1) / len(params["models"]), name)
+    return {"models": per_model, "ensemble": ensemble_decision(per_model, params["threshold"])}
+
+
+def run_tiled(path, params, progress):
+    from tiling import analyze_tiles
+    tiles = analyze_tiles(_read_image(path), _predict_fn(params["model"]), stride=params["tile_stride"] or None,
+                          max_tiles=params["max_tiles"] or None, aggregate=params["tile_aggregate"])
+    tiles["scores"] = tiles.pop("score_map").round(4).tolist()
+    tiles["predicted_class"] = 1 if tiles["score"] > params["threshold"] else 0
+    tiles["model"] = params["model"]
+    return tiles
+
+
+def run_video(path, params, progress):
+    from video import decode_frames, sample_frames, score_frames, summarize, VideoDecodeError
+    predict_fns = {name: _predict_fn(name) for name in params["models"]}
+    fps = params["fps"]
+    frames = sample_frames(decode_frames(path, fps if params["sample"] == "rate" else None), sample=params["sample"],
+                           fps=fps, scene_threshold=params["scene_threshold"], max_frames=params["max_frames"])
+    scored = []
+    try:
+        for batch in score_frames(frames, predict_fns):
+            scored.extend(batch)
+            # The number of frames that will be sampled isn't known up front, max_frames bounds it
+            progress(len(scored) / params["max_frames"], f"{len(scored)} frames")
+    except VideoDecodeError as e:
+        if not scored:
+            raise JobError(f"Upload is not a readable video or animated image: {e}")
+        logger.warning("Video decoding stopped early: %s", e)
+    finally:
+        frames.close()
+    if not scored:
+        raise JobError("No frames could be decoded from the upload")
+    return {"frames": scored, "summary": summarize(scored, params["threshold"])}
+
+
+def _archive_images(archive):
+    """Image members of a zip archive, skipping directories and hidden/metadata files"""
+    names = []
+    for info in archive.infolist():
+        base = os.path.basename(info.filename)
+        if info.is_dir() or not base or base.startswith(".") or info.filename.startswith("__MACOSX/"):
+            continue
+        names.append(info.filename)
+    return names
+
+
+def run_archive(path, params, progress):
+    """Score every image of a zip archive with each model, a batch of images at a time"""
+    from utilities import preprocess_image
+    from tiling import fake_scores
+    from verdicts import ensemble_decision
+    try:
+        archive = zipfile.ZipFile(path)
+    except zipfile.BadZipFile:
+        raise JobError("Upload is not a zip archive")
+    predict_fns = {name: _predict_fn(name) for name in params["models"]}
+    threshold = params["threshold"]
+    batch_size = BATCH_CONFIG["chunk_size"]
+    items = []
+    with archive:
+        names = _archive_images(archive)
+        if not names:
+            raise JobError("Archive contains no files")
+        for start in range(0, len(names), batch_size):
+            batch_names, inputs = [], []
+            for name in names[start:start + batch_size]:
+                # The declared size bounds what read() inflates, so a zip bomb is never expanded
+                if archive.getinfo(name).file_size > UPLOAD_CONFIG["max_bytes"]:
+                    items.append({"name": name, "error": f"File exceeds {UPLOAD_CONFIG['max_bytes']} bytes"})
+                    continue
+                try:
+                    contents = archive.read(name)
+                    _check_image(contents)
+                    inputs.append(preprocess_image(contents)[0])
+                    batch_names.append(name)
+                except JobError as e:
+                    items.append({"name": name, "error": str(e)})
+                except Exception as e:
+                    items.append({"name": name, "error": f"Could not decode image: {e}"})
+            if inputs:
+                x = np.stack(inputs)
+                per_model = {model: fake_scores(predict(x)) for model, predict in predict_fns.items()}
+                for i, name in enumerate(batch_names):
+                    scores = {model: round(float(values[i]), 4) for model, values in per_model.items()}
+                    votes = [{"predicted_class": int(score > threshold), "probability": score}
+                             for score in scores.values()]
+                    decision = ensemble_decision(votes, threshold)
+                    items.append({"name": name, "scores": scores, "verdict": decision["majority_label"],
+                                  "confidence": round(decision["ensemble_confidence"], 4)})
+            done = min(start + batch_size, len(names))
+            progress(done / len(names), f"{done}/{len(names)} files")
+    scored = [item for item in items if "verdict" in item]
+    return {
+        "items": items,
+        "summary": {
+            "files": len(items),
+            "scored": len(scored),
+            "errors": len(items) - len(scored),
+            "fake": sum(1 for item in scored if item["verdict"] == "fake"),
+            "real": sum(1 for item in scored if item["verdict"] == "real"),
+            "models": list(params["models"]),
+            "threshold": threshold
+        }
+    }
+
+
+HANDLERS = {
+    "predict": run_predict,
+    "ensemble": run_ensemble,
+    "tiled": run_tiled,
+    "video": run_video,
+    "archive": run_archive
+}
+
+
+def job_params(kind, model_name="cnn", model_names="cnn,effnet,vgg", threshold=0.5, tile_stride=0, max_tiles=0,
+               tile_aggregate=None, sample=None, fps=None, scene_threshold=None, max_frames=None):
+    """
+    The parameters that matter for `kind`, with defaults filled in, so that equivalent
+    submissions deduplicate. Raises ValueError on invalid input.
+    """
+    from tiling import AGGREGATIONS
+    from video import SAMPLING_MODES
+    if kind not in HANDLERS:
+        raise ValueError(f"Invalid kind. Use one of: {', '.join(JOB_KINDS)}")
+    if not 0.1 <= threshold <= 0.9:
+        raise ValueError("Threshold must be between 0.1 and 0.9")
+
+    def model(name):
+        name = "vgg" if name == "vgg16" else name
+        if name not in ("cnn", "effnet", "vgg"):
+            raise ValueError("Invalid model name. Use cnn, effnet, vgg, or vgg16")
+        return name
+
+    params = {"threshold": threshold}
+    if kind in ("predict", "tiled"):
+        params["model"] = model(model_name)
+    else:
+        names = [model(name.strip()) for name in model_names.split(",") if name.strip()]
+        if not names:
+            raise ValueError("model_names must list at least one of cnn, effnet, vgg")
+        params["models"] = names
+    if kind == "tiled":
+        tile_aggregate = tile_aggregate or TILING_CONFIG["aggregate"]
+        if tile_aggregate not in AGGREGATIONS:
+            raise ValueError(f"Invalid tile_aggregate. Use one of: {', '.join(AGGREGATIONS)}")
+        if tile_stride < 0 or not 0 <= max_tiles <= TILING_CONFIG["max_tiles"]:
+            raise ValueError(f"tile_stride must be >= 0 and max_tiles between 0 and {TILING_CONFIG['max_tiles']}")
+        params.update(tile_stride=tile_stride, max_tiles=max_tiles, tile_aggregate=tile_aggregate)
+    if kind == "video":
+        sample = sample or VIDEO_CONFIG["sample"]
+        fps = fps or VIDEO_CONFIG["fps"]
+        scene_threshold = VIDEO_CONFIG["scene_threshold"] if scene_threshold is None else scene_threshold
+        max_frames = max_frames or VIDEO_CONFIG["max_frames"]
+        if sample not in SAMPLING_MODES:
+            raise ValueError(f"Invalid sample. Use one of: {', '.join(SAMPLING_MODES)}")
+        if fps <= 0 or not 0 <= scene_threshold <= 1 or not 1 <= max_frames <= VIDEO_CONFIG["max_frames"]:
+            raise ValueError(f"fps must be > 0, scene_threshold in [0, 1] and max_frames in [1, {VIDEO_CONFIG['max_frames']}]")
+        params.update(sample=sample, fps=fps, scene_threshold=scene_threshold, max_frames=max_frames)
+    return params
+
+
+# --- Workers --------------------------------------------------------------------------------
+
+def run_job(store, job):
+    """Execute one claimed job and record its outcome"""
+    job_id = job["id"]
+    params = json.loads(job["params"])
+    started = time.perf_counter()
+    logger.info("Job started", extra={"job_id": job_id, "kind": job["kind"], "attempt": job["attempts"]})
+    try:
+        result = HANDLERS[job["kind"]](job["input_path"], params,
+                                       lambda fraction, message=None: store.progress(job_id, fraction, message))
+    except JobError as e:
+        store.fail(job_id, str(e))
+        logger.warning("Job failed: %s", e, extra={"job_id": job_id})
+        return
+    except Exception as e:
+        store.fail(job_id, f"{type(e).__name__}: {e}")
+        logger.exception("Job crashed", extra={"job_id": job_id})
+        return
+    store.finish(job_id, result)
+    logger.info("Job finished", extra={"job_id": job_id, "seconds": round(time.perf_counter() - started, 3)})
+
+
+def worker_main(stop_event):
+    """Worker process loop: claim, run, repeat until stop_event is set"""
+    from model_registry import load_models
+    # Applies the upload limits' decompression bomb guard (Image.MAX_IMAGE_PIXELS) in this process too
+    import uploads  # noqa: F401
+    store = JobStore()
+    load_models()
+    worker = os.getpid()
+    logger.info("Job worker started", extra={"pid": worker})
+    while not stop_event.is_set():
+        job = store.claim(worker)
+        if job is None:
+            stop_event.wait(JOBS_CONFIG["poll_interval"])
+            continue
+        run_job(store, job)
+
+
+class WorkerPool:
+    """
+    JOBS_CONFIG["workers"] worker processes. A monitor thread restarts workers that die
+    and puts the job they were running back in the queue.
+    """
+
+    def __init__(self, store, workers=None):
+        self.store = store
+        self.workers = JOBS_CONFIG["workers"] if workers is None else workers
+        # spawn, not fork: the API process has threads (and possibly TensorFlow) running
+        self._ctx = multiprocessing.get_context("spawn")
+        self._stop = self._ctx.Event()
+        self._processes = []
+        self._monitor = None
+
+    def _spawn(self):
+        process = self._ctx.Process(target=worker_main, args=(self._stop,), name="authnet-job-worker", daemon=True)
+        process.start()
+        return process
+
+    def start(self):
+        requeued = self.store.requeue()
+        if requeued:
+            logger.info("Requeued %d interrupted jobs", requeued)
+        self._processes = [self._spawn() for _ in range(self.workers)]
+        self._monitor = threading.Thread(target=self._watch, name="authnet-job-monitor", daemon=True)
+        self._monitor.start()
+        logger.info("Job workers started", extra={"workers": self.workers})
+
+    def _watch(self):
+        while not self._stop.wait(1.0):
+            for i, process in enumerate(self._processes):
+                if process.is_alive() or self._stop.is_set():
+                    continue
+                logger.error("Job worker %s exited with %s, restarting", process.pid, process.exitcode)
+                self.store.requeue(process.pid)
+                self._processes[i] = self._spawn()
+
+    def stop(self, timeout=10):
+        """Stop the workers; a job still running after `timeout` is interrupted and resumed on the next start"""
+        self._stop.set()
+        deadline = time.monotonic() + timeout
+        for process in self._processes:
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        if self._monitor is not None:
+            self._monitor.join()
+        self._processes = []
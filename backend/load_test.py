@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+"""
+End-to-end load test for the AuthNet API.
+
+Generates synthetic images across realistic sizes and formats, drives the
+prediction endpoints at the requested concurrency levels and prints (or writes)
+a JSON report with throughput, latency percentiles and error rates per scenario.
+
+Examples:
+    # Against an already running backend (stub or real models)
+    python load_test.py --base-url http://localhost:8000
+
+    # Spawn a local backend, sweep concurrency, with and without heatmaps
+    python load_test.py --spawn-backend --concurrency 1,4,16 --heatmaps both --output results.json
+
+    # Exercise the remote path: spawned backend forwards to a model server
+    python load_test.py --spawn-backend --remote-url http://localhost:8001 --targets cnn
+
+    # No TensorFlow needed: stub models with a simulated latency distribution, and the
+    # remote path through a spawned stand-in model server (simple_server.py)
+    python load_test.py --spawn-backend --stub-config '{"latency": "lognormal", "latency_seconds": 0.05, "latency_spread": 0.5}'
+    python load_test.py --spawn-backend --spawn-model-server --stub-config '{"error_rate": 0.01}'
+
+    # Throughput and latency by replica count (spawned backend restarted per count); stub
+    # "concurrency": 1 makes each stub replica serve one call at a time, like a real model copy
+    python load_test.py --spawn-backend --replicas 1,2,4 --targets effnet --heatmaps off \
+        --stub-config '{"latency": "constant", "latency_seconds": 0.05, "concurrency": 1}'
+"""
+import argparse
+import io
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+from PIL import Image
+
+# label -> (width, height): thumbnail, typical web upload, full HD, 12MP phone photo
+IMAGE_SIZES = {
+    "224": (224, 224),
+    "1024x768": (1024, 768),
+    "1920x1080": (1920, 1080),
+    "4032x3024": (4032, 3024)
+}
+IMAGE_FORMATS = {"jpeg": "image/jpeg", "png": "image/png", "webp": "image/webp"}
+
+
+def create_synthetic_image(width, height, image_format, seed=0):
+    """Photo-like synthetic image: smooth gradients, a few shapes and sensor-style noise"""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    base = np.stack([
+        127 + 100 * np.sin(x / (width / 3.0) + rng.uniform(0, 6)),
+        127 + 100 * np.cos(y / (height / 2.5) + rng.uniform(0, 6)),
+        127 + 100 * np.sin((x + y) / (width / 4.0))
+    ], axis=-1)
+    for _ in range(6):
+        cx, cy = rng.integers(0, width), rng.integers(0, height)
+        radius = rng.integers(min(width, height) // 20 + 1, min(width, height) // 5 + 2)
+        mask = (x - cx) ** 2 + (y - cy) ** 2 < radius ** 2
+        base[mask] = rng.uniform(0, 255, size=3)
+    base += rng.normal(0, 6, size=base.shape)
+    img = Image.fromarray(np.clip(base, 0, 255).astype(np.uint8))
+
+    buffer = io.BytesIO()
+    if image_format == "jpeg":
+        img.save(buffer, format="JPEG", quality=90)
+    elif image_format == "png":
+        img.save(buffer, format="PNG")
+    else:
+        img.save(buffer, format="WEBP", quality=85)
+    return buffer.getvalue()
+
+
+def percentile(sorted_values, q):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, math.ceil(q / 100.0 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def run_scenario(base_url, path, image_bytes, content_type, params, concurrency, total_requests, timeout):
+    """Send total_requests requests with `concurrency` workers; returns the scenario stats"""
+    local = threading.local()
+    latencies = []
+    statuses = {}
+    errors = []
+    response_bytes = [0]
+    lock = threading.Lock()
+
+    def session():
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        return local.session
+
+    def one_request(i):
+        files = {"file": (f"bench_{i}", image_bytes, content_type)}
+        started = time.perf_counter()
+        try:
+            response = session().post(f"{base_url}{path}", files=files, params=params, timeout=timeout)
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+                response_bytes[0] += len(response.content)
+                if response.status_code != 200:
+                    errors.append(f"{response.status_code}: {response.text[:200]}")
+        except requests.RequestException as e:
+            with lock:
+                statuses["connection_error"] = statuses.get("connection_error", 0) + 1
+                errors.append(str(e)[:200])
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one_request, range(total_requests)))
+    wall_time = time.perf_counter() - started
+
+    latencies.sort()
+    failed = sum(count for status, count in statuses.items() if status != 200)
+    to_ms = lambda v: round(v * 1000, 2) if v is not None else None
+    return {
+        "requests": total_requests,
+        "concurrency": concurrency,
+        "wall_time_s": round(wall_time, 3),
+        "throughput_rps": round(total_requests / wall_time, 2) if wall_time > 0 else None,
+        "latency_ms": {
+            "p50": to_ms(percentile(latencies, 50)),
+            "p95": to_ms(percentile(latencies, 95)),
+            "p99": to_ms(percentile(latencies, 99)),
+            "mean": to_ms(sum(latencies) / len(latencies)) if latencies else None,
+            "max": to_ms(latencies[-1]) if latencies else None
+        },
+        "error_rate": round(failed / total_requests, 4) if total_requests else 0.0,
+        "status_counts": {str(k): v for k, v in statuses.items()},
+        "mean_response_bytes": round(response_bytes[0] / max(1, len(latencies))),
+        "sample_errors": errors[:5]
+    }
+
+
+def wait_for_health(base_url, timeout=300):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            response = requests.get(f"{base_url}/health", timeout=2)
+            if response.status_code == 200:
+                return response.json()
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f"Server at {base_url} did not become healthy within {timeout}s")
+
+
+def spawn_server(app, port, env=None):
+    """Start a backend module's app under uvicorn on the given port"""
+    backend_dir = os.path.dirname(os.path.abspath(__file__))
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", app, "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=backend_dir,
+        env=env,
+        stdout=subprocess.DEVNULL
+    )
+
+
+def spawn_backend(port, remote_url=None, stub_config=None, replicas=None):
+    """Start main.py on the given port (stub models, shaped by stub_config, if TensorFlow is missing),
+    optionally with every model loaded as this many replicas"""
+    env = dict(os.environ)
+    if remote_url:
+        env["AUTHNET_REMOTE_SERVER_URL"] = remote_url
+    if stub_config:
+        env["AUTHNET_STUB_CONFIG"] = stub_config
+    if replicas:
+        env["AUTHNET_REPLICAS"] = json.dumps({name: replicas for name in ("cnn", "effnet", "vgg")})
+    return spawn_server("main:app", port, env)
+
+
+def spawn_model_server(port, stub_config=None):
+    """Start the stand-in model server (simple_server.py) with the given stub settings"""
+    env = dict(os.environ)
+    if stub_config:
+        env["AUTHNET_STUB_CONFIG"] = stub_config
+    return spawn_server("simple_server:app", port, env)
+
+
+def parse_list(value):
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+def run_scenarios(base_url, args, replicas=None):
+    """Every size x format x target x heatmap x concurrency combination against one server"""
+    heatmap_modes = {"on": [True], "off": [False], "both": [True, False]}[args.heatmaps]
+    scenarios = []
+    for size_label in parse_list(args.sizes):
+        width, height = IMAGE_SIZES[size_label]
+        for image_format in parse_list(args.formats):
+            image_bytes = create_synthetic_image(width, height, image_format)
+            content_type = IMAGE_FORMATS[image_format]
+            for target in parse_list(args.targets):
+                path = "/predict/ensemble" if target == "ensemble" else f"/predict/{target}"
+                for include_heatmaps in heatmap_modes:
+                    params = {"include_heatmaps": str(include_heatmaps).lower(), "heatmap_format": args.heatmap_format}
+                    if args.warmup:
+                        run_scenario(base_url, path, image_bytes, content_type, params, 1, args.warmup, args.timeout)
+                    for concurrency in [int(c) for c in parse_list(args.concurrency)]:
+                        stats = run_scenario(base_url, path, image_bytes, content_type, params,
+                                             concurrency, args.requests, args.timeout)
+                        stats.update({
+                            "target": target,
+                            "image_size": size_label,
+                            "image_format": image_format,
+                            "image_bytes": len(image_bytes),
+                            "heatmaps": include_heatmaps,
+                            "replicas": replicas
+                        })
+                        scenarios.append(stats)
+                        replica_label = f"r={replicas} " if replicas else ""
+                        print(f"{target:8s} {size_label:>10s} {image_format:5s} heatmaps={str(include_heatmaps):5s} "
+                              f"{replica_label}c={concurrency:<3d} {stats['throughput_rps']} rps  "
+                              f"p50={stats['latency_ms']['p50']}ms p99={stats['latency_ms']['p99']}ms "
+                              f"errors={stats['error_rate']:.1%}", file=sys.stderr)
+    return scenarios
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end load test for the AuthNet API")
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--targets", default="cnn,effnet,vgg,ensemble",
+                        help="Comma-separated models and/or 'ensemble'")
+    parser.add_argument("--sizes", default="224,1024x768,1920x1080,4032x3024",
+                        help=f"Comma-separated image sizes from: {', '.join(IMAGE_SIZES)}")
+    parser.add_argument("--formats", default="jpeg", help=f"Comma-separated formats from: {', '.join(IMAGE_FORMATS)}")
+    parser.add_argument("--concurrency", default="1,4,16", help="Comma-separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=50, help="Requests per scenario")
+    parser.add_argument("--heatmaps", choices=["on", "off", "both"], default="both")
+    parser.add_argument("--heatmap-format", default="jpeg")
+    parser.add_argument("--warmup", type=int, default=3, help="Unmeasured requests before each target")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--spawn-backend", action="store_true", help="Start a local backend for the run")
+    parser.add_argument("--port", type=int, default=8765, help="Port for --spawn-backend")
+    parser.add_argument("--remote-url", default=None,
+                        help="With --spawn-backend, make the backend forward to this model server (remote path)")
+    parser.add_argument("--stub-config", default=None,
+                        help="JSON STUB_CONFIG overrides for spawned servers' stub models (latency, errors, memory)")
+    parser.add_argument("--spawn-model-server", action="store_true",
+                        help="With --spawn-backend, start simple_server.py and use it as the remote model server")
+    parser.add_argument("--model-server-port", type=int, default=8766, help="Port for --spawn-model-server")
+    parser.add_argument("--replicas", default=None,
+                        help="With --spawn-backend, comma-separated replica counts per model; "
+                             "the backend is restarted for each and every scenario runs against it")
+    parser.add_argument("--output", default=None, help="Write the JSON report here instead of stdout")
+    args = parser.parse_args()
+    if args.stub_config:
+        json.loads(args.stub_config)
+    if args.replicas and not args.spawn_backend:
+        parser.error("--replicas needs --spawn-backend")
+    replica_counts = [int(r) for r in parse_list(args.replicas)] if args.replicas else [None]
+
+    processes = []
+    base_url = args.base_url.rstrip("/")
+    remote_url = args.remote_url
+    if args.spawn_backend:
+        base_url = f"http://127.0.0.1:{args.port}"
+        if args.spawn_model_server:
+            remote_url = f"http://127.0.0.1:{args.model_server_port}"
+            processes.append(spawn_model_server(args.model_server_port, args.stub_config))
+
+    backend = None
+    try:
+        if args.spawn_model_server:
+            wait_for_health(remote_url)
+        scenarios = []
+        for replicas in replica_counts:
+            if args.spawn_backend:
+                backend = spawn_backend(args.port, remote_url, args.stub_config, replicas)
+            health = wait_for_health(base_url)
+            scenarios.extend(run_scenarios(base_url, args, replicas))
+            if backend is not None:
+                backend.terminate()
+                backend.wait(timeout=30)
+                backend = None
+
+        report = {
+            "base_url": base_url,
+            "remote_url": remote_url,
+            "stub_config": json.loads(args.stub_config) if args.stub_config else None,
+            "server": health,
+            "host": {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()},
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "scenarios": scenarios
+        }
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(report, f, indent=2)
+            print(f"Wrote {len(scenarios)} scenarios to {args.output}", file=sys.stderr)
+        else:
+            print(json.dumps(report, indent=2))
+    finally:
+        if backend is not None:
+            processes.append(backend)
+        for process in processes:
+            process.terminate()
+            process.wait(timeout=30)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+Structured, sampled, non-blocking logging for the backend.
+
+Records are handed to a bounded queue and written to stdout by a background
+listener thread, so request handlers never block on I/O. DEBUG records are only
+emitted for the sampled fraction of requests (see LOGGING_CONFIG in config.py).
+"""
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import uuid
+from config import LOGGING_CONFIG
+
+# Per-request context, set by begin_request() from the HTTP middleware
+_request_id = contextvars.ContextVar("request_id", default=None)
+_request_sampled = contextvars.ContextVar("request_sampled", default=False)
+
+# Attributes present on every LogRecord; anything else was passed via extra=
+_STANDARD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+_listener = None
+dropped_records = 0
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with any extra= fields merged in"""
+
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 6),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage()
+        }
+        for key, value in record.__dict__.items():
+            if key not in _STANDARD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class RequestContextFilter(logging.Filter):
+    """Tag records with the request id and drop DEBUG records from unsampled requests"""
+
+    def __init__(self, level):
+        super().__init__()
+        self.level = level
+
+    def filter(self, record):
+        request_id = _request_id.get()
+        if request_id is not None:
+            record.request_id = request_id
+        if record.levelno >= self.level:
+            return True
+        return _request_sampled.get()
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records when the queue is full instead of blocking or raising"""
+
+    def enqueue(self, record):
+        global dropped_records
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            dropped_records += 1
+
+    def prepare(self, record):
+        # Render the message now so args holding arrays aren't kept alive (or mutated) in the queue
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def setup_logging(config=None):
+    """Install the queue handler on the root logger (idempotent)"""
+    global _listener
+    if _listener is not None:
+        return
+    config = config or LOGGING_CONFIG
+    level = logging.getLevelName(config["level"].upper())
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    if config["format"] == "json":
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+
+    log_queue = queue.Queue(maxsize=config["queue_size"])
+    queue_handler = DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(RequestContextFilter(level))
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    # Let DEBUG through to the filter only if some requests are sampled
+    root.setLevel(logging.DEBUG if config["debug_sample_rate"] > 0 else level)
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=False)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+
+def get_logger(name):
+    setup_logging()
+    return logging.getLogger(name)
+
+
+def begin_request(request_id=None):
+    """Start the logging context for a request; returns the request id"""
+    request_id = request_id or uuid.uuid4().hex[:16]
+    _request_id.set(request_id)
+    _request_sampled.set(random.random() < LOGGING_CONFIG["debug_sample_rate"])
+    return request_id
+
+
+def current_request_id():
+    """Request id of the request being handled, or None outside a request"""
+    return _request_id.get()
+
+
+def request_sampled():
+    """True if DEBUG output is enabled for the current request"""
+    return _request_sampled.get()
+
@@ -1,5 +1,8 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi import FastAPI, UploadFile, File, HTTPException, Depends, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response, StreamingResponse
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
 try:
     # TensorFlow is optional for development. If unavailable we fall back to stubs so the API can run.
     from tensorflow.keras.models import load_model
@@ -12,309 +15,627 @@ except Exception:
     tf = None
     TF_AVAILABLE = False
 import numpy as np
-from PIL import Image
 import io
 import requests
 import os
-import cv2
-import base64
+import asyncio
+import itertools
+import json
+import tempfile
 from io import BytesIO
-from config import MODEL_CONFIG, SERVER_CONFIG, PREPROCESSING_CONFIG
-from utilities import generate_gradcam_cnn, generate_gradcam_effnet, generate_gradcam_vgg16, toImageArray
+from config import (MODEL_CONFIG, SERVER_CONFIG, PREPROCESSING_CONFIG, HEATMAP_CONFIG, UPLOAD_CONFIG, TILING_CONFIG,
+                    VIDEO_CONFIG, JOBS_CONFIG, EMBEDDING_CONFIG, INFERENCE_WORKER_CONFIG)
+from utilities import (generate_gradcam_cnn, generate_gradcam_effnet, generate_gradcam_vgg16, toImageArray, encode_heatmap,
+                       preprocess_image, HEATMAP_FORMATS)
+from responses import encode_prediction_response, RESPONSE_FORMATS, MSGPACK_AVAILABLE
+from uploads import read_upload, read_upload_to_file, UploadSizeLimit
+from logging_utils import get_logger, begin_request, request_sampled, current_request_id
+from metrics import (track_requests, render_metrics, METRICS_CONTENT_TYPE, INFERENCE_LATENCY, GRADCAM_LATENCY,
+                     HEATMAP_ENCODE_LATENCY, MODEL_QUEUE_DEPTH, REMOTE_ERRORS)
+from timing import stage, current_trace, server_timing
+from admin import require_admin
+from model_registry import (models, load_models, is_stub, replica_of, replicas_of, ReplicaPool, ModelLease,
+                            model_version, model_versions, reloads, start_reload)
+from verdicts import interpret_prediction, ensemble_decision, ENSEMBLE_MODELS
+from tiling import analyze_tiles, AGGREGATIONS
+from video import decode_frames, sample_frames, score_frames, summarize, SAMPLING_MODES, VideoDecodeError
+from gradcam import compute_gradcam_heatmap, resolve_heatmap_mode, predict_with_cam, HEATMAP_MODES
+from admission import admission, request_lane, upload_cost
+from deadlines import (request_deadline, cancel_on_disconnect, current_deadline, DeadlineExceeded,
+                       deadline_exceeded_response, check, affordable, skip, measure, stage_estimate, timeout_for)
+from jobs import JobStore, WorkerPool, job_params, job_status, store_input
+from embeddings import (capturing, predict_with_features, record, search as search_embeddings, store_status,
+                        start_index_build, index_builds)
+from inference_workers import stop_workers as stop_inference_workers
+from profiling import profile_requests, start_profiling, stop_profiling, profiling_status
+
+logger = get_logger("authnet.backend")
 
 app = FastAPI()
 
+def upload_limit(path):
+    """Upload limit in bytes for a request path"""
+    if path == "/predict/video":
+        return VIDEO_CONFIG["max_bytes"]
+    if path == "/jobs":
+        return JOBS_CONFIG["max_bytes"]
+    return UPLOAD_CONFIG["max_bytes"]
+
+# Refuse bodies over the upload limit while they are received, before the multipart parser spools them.
+# Added first so it is the innermost middleware: its 413 reaches the route without passing through the
+# task groups of the "http" middlewares, which would turn it into a 400.
+app.add_middleware(UploadSizeLimit, limit_for=upload_limit)
+
 # Apply CORS settings from config
 app.add_middleware(
     CORSMiddleware,
     **SERVER_CONFIG["cors"]
 )
 
+app.middleware("http")(track_requests)
+
+app.middleware("http")(server_timing)
+
+app.middleware("http")(profile_requests)
+
+app.middleware("http")(request_deadline)
+
+app.add_exception_handler(DeadlineExceeded, deadline_exceeded_response)
+
+@app.middleware("http")
+async def request_context(request, call_next):
+    """Attach a request id (and the per-request log sampling decision) to everything logged"""
+    request_id = begin_request(request.headers.get("x-request-id"))
+    response = await call_next(request)
+    response.headers["X-Request-ID"] = request_id
+    return response
+
 # Check if we should use remote models
 use_remote_models = bool(MODEL_CONFIG["remote"]["server_url"])
 
-# Initialize models dictionary
-models = {}
+@app.on_event("startup")
+def load_local_models():
+    """
+    Shared, process-wide models (see model_registry.py), loaded unless forwarding to a remote server, in
+    inference worker processes if enabled (see inference_workers.py). Loaded at startup rather than import,
+    so a spawned child re-importing this module (`python main.py`) never loads or spawns anything.
+    """
+    if use_remote_models:
+        logger.info("Using remote models, skipping local model loading")
+        return
+    load_models(isolated=INFERENCE_WORKER_CONFIG["enabled"])
 
-# Provide simple stub model to allow the API to operate in environments without TF installed.
-class _StubModel:
-    def predict(self, x):
-        # return a deterministic 2-class softmax-like vector
-        return np.array([[0.8, 0.2]])
+# Asynchronous jobs (see jobs.py); the store is opened on first use, the workers start with the app
+job_store = None
+job_pool = None
 
-# Model wrapper to handle input shape conversion - now focuses on 3-channel RGB
-class _ModelWrapper:
-    def __init__(self, model, expects_grayscale=False):
-        self.model = model
-        self.expects_grayscale = expects_grayscale
-    
-    def predict(self, x):
-        # Ensure input is 3-channel RGB for all our fixed models
-        if len(x.shape) == 4 and x.shape[-1] == 3:
-            # Input is already 3-channel, proceed normally
-            return self.model.predict(x)
-        elif len(x.shape) == 4 and x.shape[-1] == 1:
-            # Convert single channel to 3-channel
-            x_rgb = np.repeat(x, 3, axis=-1)
-            return self.model.predict(x_rgb)
-        else:
-            # Fallback - should not happen with our preprocessing
-            print(f"⚠️ Unexpected input shape: {x.shape}")
-            return self.model.predict(x)
+def get_job_store():
+    global job_store
+    if job_store is None:
+        job_store = JobStore()
+    return job_store
 
-# Function to safely load models with better error handling
-def safe_load_model(model_path, model_name):
+def jobs_enabled():
+    return JOBS_CONFIG["workers"] > 0 and not use_remote_models
+
+@app.on_event("startup")
+def start_job_workers():
+    global job_pool
+    if jobs_enabled():
+        job_pool = WorkerPool(get_job_store())
+        job_pool.start()
+
+@app.on_event("shutdown")
+def stop_job_workers():
+    global job_pool
+    if job_pool is not None:
+        job_pool.stop()
+        job_pool = None
+
+app.on_event("shutdown")(stop_inference_workers)
+
+def validate_output_formats(heatmap_format, response_format, heatmap_mode="auto"):
+    """Reject unknown heatmap modes/formats and response formats before doing any work"""
+    if heatmap_mode not in HEATMAP_MODES:
+        raise HTTPException(status_code=400, detail=f"Invalid heatmap_mode. Use one of: {', '.join(HEATMAP_MODES)}")
+    if heatmap_format not in HEATMAP_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Invalid heatmap_format. Use one of: {', '.join(HEATMAP_FORMATS)}")
+    if response_format not in RESPONSE_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Invalid response_format. Use one of: {', '.join(RESPONSE_FORMATS)}")
+    if response_format == "msgpack" and not MSGPACK_AVAILABLE:
+        raise HTTPException(status_code=406, detail="msgpack responses require the msgpack package on the server")
+
+def run_model(name, img_array, model_obj=None, features=None):
     """
-    Safely load a model with comprehensive error handling
+    Forward pass on a loaded model (the registered one unless a pinned model_obj is given), recorded in the
+    inference metrics. Given a `features` dict, the model's embeddings from the same pass go into features[name].
     """
+    model_obj = model_obj or models[name]
+    MODEL_QUEUE_DEPTH.inc(model=name)
     try:
-        print(f"🔄 Attempting to load {model_name} model...")
-        
-        # First check if file exists and is readable
-        if not os.path.exists(model_path):
-            print(f"❌ Model file not found: {model_path}")
-            return None
-            
-        # Check file size
-        file_size = os.path.getsize(model_path)
-        if file_size == 0:
-            print(f"❌ Model file is empty: {model_path}")
-            return None
-        print(f"� Model file size: {file_size / (1024*1024):.1f} MB")
-        
-        # Try to load the model
-        model = load_model(model_path, compile=False)
-        print(f"✅ {model_name} model loaded successfully")
-        return model
-        
-    except Exception as e:
-        error_msg = str(e)
-        if "input shape" in error_msg.lower():
-            print(f"⚠️ {model_name} has input shape incompatibility: {error_msg}")
-            print(f"🔄 This model expects different input format than provided")
-        elif "layer" in error_msg.lower():
-            print(f"⚠️ {model_name} has layer compatibility issues: {error_msg}")
+        with INFERENCE_LATENCY.time(model=name), stage("inference", model=name), measure("inference", name):
+            with replica_of(model_obj) as replica:
+                if features is None:
+                    return replica.predict(img_array)
+                prediction, features[name] = predict_with_features(replica, img_array, model_type=name)
+                return prediction
+    finally:
+        MODEL_QUEUE_DEPTH.dec(model=name)
+
+def run_model_with_cam(name, img_array, model_obj=None, features=None):
+    """Forward pass on a CAM-eligible model returning (prediction, CAM grid or None); `features` as for run_model"""
+    model_obj = model_obj or models[name]
+    MODEL_QUEUE_DEPTH.inc(model=name)
+    try:
+        with INFERENCE_LATENCY.time(model=name), stage("inference", model=name), measure("inference", name):
+            with replica_of(model_obj) as replica:
+                if features is None:
+                    return predict_with_cam(replica, img_array, model_type=name)
+                prediction, grid, features[name] = predict_with_cam(replica, img_array, model_type=name,
+                                                                    with_features=True)
+                return prediction, grid
+    finally:
+        MODEL_QUEUE_DEPTH.dec(model=name)
+
+def capture_embedding(name, model_obj, features, sha256, predicted_class, fake_confidence):
+    """Queue the embedding of an analyzed upload for the similarity store"""
+    if sha256 is not None and features.get(name) is not None:
+        record(name, model_version(model_obj), features[name][:1],
+               [{"sha256": sha256, "predicted_class": predicted_class, "probability": fake_confidence}])
+
+def finish_response(payload, response_format, trace=False):
+    """Attach the stage breakdown if requested, list stages skipped (for the deadline) and serialize the payload"""
+    deadline = current_deadline()
+    if deadline is not None and deadline.skipped:
+        payload["skipped"] = payload.get("skipped", []) + deadline.skipped
+    request_trace = current_trace()
+    if trace and request_trace is not None:
+        payload["trace"] = request_trace.summary()
+    with stage("serialize"):
+        return encode_prediction_response(payload, response_format)
+
+def remote_prediction(name, filename, content_type, contents, threshold):
+    """
+    One model's prediction from the remote model server. Its /predict/{model} API (model_server.py) answers
+    with the raw probabilities only, so the verdict is made here with this request's threshold, and the entry
+    is shaped like a local one; heatmaps, tiling and response formats are never delegated to it.
+    """
+    remote_url = f"{MODEL_CONFIG['remote']['server_url']}{MODEL_CONFIG['remote']['endpoints'][name]}"
+    headers = {'X-Request-ID': current_request_id() or ''}
+    if MODEL_CONFIG['remote']['api_key']:
+        headers['Authorization'] = f"Bearer {MODEL_CONFIG['remote']['api_key']}"
+    files = {'file': (filename, contents, content_type)}
+    check("remote")
+    try:
+        with stage("remote", model=name):
+            response = requests.post(remote_url, files=files, headers=headers,
+                                     timeout=timeout_for(MODEL_CONFIG['remote']['timeout']))
+    except requests.RequestException as e:
+        REMOTE_ERRORS.inc(endpoint=name, kind="connection")
+        raise HTTPException(status_code=503, detail=f"Error connecting to remote model server: {str(e)}")
+    if response.status_code != 200:
+        REMOTE_ERRORS.inc(endpoint=name, kind="status")
+        raise HTTPException(status_code=response.status_code, detail=f"Remote model server error: {response.text}")
+    result = response.json()
+    predicted_class, probabilities, fake_confidence = interpret_prediction(np.array([result["probabilities"]]),
+                                                                           threshold)
+    return {
+        "model": name,
+        "model_version": result.get("model_version", "remote"),
+        "predicted_class": predicted_class,
+        "probabilities": probabilities,
+        "probability": fake_confidence,
+        "heatmap": None,
+        "heatmap_mode": "none",
+        "remote": True
+    }
+
+def remote_heatmap_skips(names, include_heatmaps):
+    """`skipped` entries telling the client that requested heatmaps can't come from the remote model server"""
+    if not include_heatmaps:
+        return []
+    return [{"stage": "heatmap", "model": name, "reason": "remote"} for name in names]
+
+def ensemble_member_prediction(name, img_array, threshold, heatmaps_wanted, heatmap_mode="auto", model_obj=None,
+                               sha256=None):
+    """
+    Run one ensemble member. Returns (entry, cam_grid): the per-model response entry
+    (without its heatmap) and the CAM grid when the heatmap came out of the forward pass.
+    Given the upload's sha256, the member's embedding is captured if it is configured to be.
+    """
+    model_obj = model_obj or models[name]
+    try:
+        mode = "none"
+        if heatmaps_wanted and not is_stub(model_obj):
+            mode = resolve_heatmap_mode(model_obj, name, heatmap_mode)
+        cam_grid = None
+        features = {} if sha256 is not None and capturing(name) else None
+        if mode == "cam":
+            # CAM comes out of the forward pass itself
+            prediction, cam_grid = run_model_with_cam(name, img_array, model_obj, features)
         else:
-            print(f"❌ {model_name} failed to load: {error_msg}")
-        
-        print(f"💡 Using stub model for {model_name} to maintain API functionality")
-        return None
+            prediction = run_model(name, img_array, model_obj, features)
+        predicted_class, probabilities, fake_confidence = interpret_prediction(prediction, threshold)
+        if features:
+            capture_embedding(name, model_obj, features, sha256, predicted_class, fake_confidence)
+        return {
+            "model": name,
+            "model_version": model_version(model_obj),
+            "predicted_class": predicted_class,
+            "probabilities": probabilities,
+            "probability": fake_confidence,
+            "heatmap": None,
+            "heatmap_mode": mode,
+            "stub": is_stub(model_obj)
+        }, cam_grid
+    except Exception as e:
+        return {
+            "model": name,
+            "error": str(e),
+            "stub": is_stub(model_obj)
+        }, None
 
-# Load local models if not using remote models
-if not use_remote_models:
-    if not TF_AVAILABLE:
-        print("⚠️ TensorFlow not available - using stub models for development.")
-        models = {"cnn": _StubModel(), "effnet": _StubModel(), "vgg": _StubModel()}
-    else:
-        print("🔄 Starting model loading process...")
+def ensemble_member_heatmap(name, mode, cam_grid, overlay_img, heatmap_format, model_obj=None):
+    """Encoded heatmap for an ensemble member in the given mode, or None"""
+    if mode == "cam":
+        return encode_model_heatmap(cam_grid, overlay_img, name, heatmap_format) if cam_grid is not None else None
+    if mode == "gradcam":
         try:
-            print("Loading local models...")
-            print(f"Current working directory: {os.getcwd()}")
-            
-            # Get absolute paths to model files
-            base_dir = os.path.dirname(os.path.abspath(__file__))
-            cnn_path = os.path.join(base_dir, MODEL_CONFIG["local"]["cnn"])
-            vgg_path = os.path.join(base_dir, MODEL_CONFIG["local"]["vgg"])
-            effnet_path = os.path.join(base_dir, MODEL_CONFIG["local"]["effnet"])
-            
-            print(f"CNN path: {cnn_path}")
-            print(f"VGG path: {vgg_path}")
-            print(f"EffNet path: {effnet_path}")
-            
-            # Load CNN model
-            if os.path.exists(cnn_path):
-                cnn_model = safe_load_model(cnn_path, "CNN")
-                if cnn_model is not None:
-                    models["cnn"] = _ModelWrapper(cnn_model, expects_grayscale=False)
-                else:
-                    models["cnn"] = _StubModel()
-            else:
-                print(f"❌ CNN model file not found: {cnn_path}")
-                models["cnn"] = _StubModel()
-                
-            # Load VGG model using fixed loader
-            from fixed_model_loader import load_fixed_model
-            
-            vgg_model = load_fixed_model("vgg", vgg_path)
-            if vgg_model is not None:
-                models["vgg"] = _ModelWrapper(vgg_model, expects_grayscale=False)
-            else:
-                models["vgg"] = _StubModel()
-            
-            # Load EffNet model using fixed loader
-            effnet_model = load_fixed_model("effnet", effnet_path)
-            if effnet_model is not None:
-                models["effnet"] = _ModelWrapper(effnet_model, expects_grayscale=False)
-            else:
-                models["effnet"] = _StubModel()
-            
-            if not models:
-                print("⚠️ No local models loaded — consider using a remote model server or placing model files in the backend/models directory")
-                print("⚠️ No local models loaded — consider using a remote model server or placing model files in the backend/models directory")
-
-            print(f"✅ Loaded {len(models)} models successfully")
-            print(f"Available models: {list(models.keys())}")
-            print("🚀 Model loading complete")
-        except Exception as e:
-            print(f"❌ Error loading local models: {e}")
-            # Continue without models - they might be loaded later or we'll use remote
-else:
-    print("🌐 Using remote models, skipping local model loading...")
-
-# Preprocess uploaded image - ensures 3-channel RGB input for all models
-def preprocess_image(file, target_size=None):
-    if target_size is None:
-        target_size = PREPROCESSING_CONFIG["image_size"]
-    
-    # Always convert to RGB to ensure 3 channels
-    img = Image.open(io.BytesIO(file)).convert("RGB")
-    img = img.resize(target_size)
-
-    # Convert to numpy array ensuring 3 channels
-    img_array = np.array(img, dtype=np.float32)
-    
-    # Ensure we have 3 channels (should be guaranteed by RGB conversion)
-    if len(img_array.shape) == 2:
-        # Grayscale - convert to 3 channels
-        img_array = np.stack([img_array] * 3, axis=-1)
-    elif img_array.shape[-1] == 1:
-        # Single channel - convert to 3 channels  
-        img_array = np.repeat(img_array, 3, axis=-1)
-    elif img_array.shape[-1] == 4:
-        # RGBA - keep only RGB channels
-        img_array = img_array[:, :, :3]
-    
-    # Ensure exactly 3 channels
-    assert img_array.shape[-1] == 3, f"Expected 3 channels, got {img_array.shape[-1]}"
-    
-    img_array = np.expand_dims(img_array, axis=0)
-    
-    if PREPROCESSING_CONFIG["normalize"]:
-        img_array /= PREPROCESSING_CONFIG["normalization_factor"]
-        
-    print(f"📸 Preprocessed image shape: {img_array.shape}")
-    return img_array
+            model_obj = model_obj or models[name]
+            return generate_improved_gradcam(model_obj, overlay_img, model_type=name, heatmap_format=heatmap_format)
+        except Exception:
+            return None
+    return None
 
 # New ensemble prediction endpoint (must come before generic predict route)
 @app.post("/predict/ensemble")
-async def predict_ensemble(file: UploadFile = File(...), threshold: float = 0.5, include_heatmaps: bool = True):
+async def predict_ensemble(request: Request, file: UploadFile = File(...), threshold: float = 0.5,
+                           include_heatmaps: bool = True, heatmap_format: str = HEATMAP_CONFIG["default_format"], response_format: str = "json",
+                           trace: bool = False, heatmap_mode: str = HEATMAP_CONFIG["default_mode"]):
     """Run all available models and return aggregated (majority vote) decision.
 
     Returns per-model predictions plus ensemble stats. Uses same threshold handling
     for sigmoid models. If a model failed to load (stub) it's still included but
-    flagged in the response. Heatmaps generated only for real models when requested.
+    flagged in the response. Heatmaps generated only for real models when requested,
+    encoded per heatmap_format and serialized per response_format. heatmap_mode
+    picks Grad-CAM or the gradient-free CAM ("auto": CAM where the model allows it,
+    "none": no heatmaps). trace=true adds a per-stage timing breakdown, including
+    each model's share, to the body.
     """
     if not 0.1 <= threshold <= 0.9:
         raise HTTPException(status_code=400, detail="Threshold must be between 0.1 and 0.9")
+    validate_output_formats(heatmap_format, response_format, heatmap_mode)
+    if heatmap_mode == "none":
+        include_heatmaps = False
 
-    contents = await file.read()
+    with stage("upload"):
+        upload = await read_upload(file)
+    contents = upload.contents
 
-    # Remote forwarding (if configured)
+    # Remote models: each member from the model server's /predict/{model}, aggregated here
     if use_remote_models:
-        try:
-            remote_url = f"{MODEL_CONFIG['remote']['server_url']}/predict/ensemble"
-            headers = {}
-            if MODEL_CONFIG['remote']['api_key']:
-                headers['Authorization'] = f"Bearer {MODEL_CONFIG['remote']['api_key']}"
-            files = {'file': (file.filename, contents, file.content_type)}
-            response = requests.post(remote_url, files=files, headers=headers, timeout=MODEL_CONFIG['remote']['timeout'])
-            if response.status_code == 200:
-                return response.json()
-            raise HTTPException(status_code=response.status_code, detail=f"Remote ensemble error: {response.text}")
-        except requests.RequestException as e:
-            raise HTTPException(status_code=503, detail=f"Error connecting to remote model server: {str(e)}")
+        answers = await asyncio.gather(*(
+            run_in_threadpool(remote_prediction, name, file.filename, file.content_type, contents, threshold)
+            for name in ENSEMBLE_MODELS
+        ), return_exceptions=True)
+        failures = [answer for answer in answers if isinstance(answer, BaseException)]
+        if failures and (len(failures) == len(answers) or not all(isinstance(f, HTTPException) for f in failures)):
+            # No member answered (or something other than the remote call failed): that error is the response
+            raise failures[0]
+        per_model = [
+            {"model": name, "error": answer.detail, "remote": True} if isinstance(answer, HTTPException) else answer
+            for name, answer in zip(ENSEMBLE_MODELS, answers)
+        ]
+        result = {
+            "models": per_model,
+            "ensemble": ensemble_decision(per_model, threshold)
+        }
+        skipped = remote_heatmap_skips(ENSEMBLE_MODELS, include_heatmaps)
+        if skipped:
+            result["skipped"] = skipped
+        return finish_response(result, response_format, trace)
 
     if not models:
         raise HTTPException(status_code=503, detail="No models loaded")
 
-    img_array = preprocess_image(contents)
+    names = [name for name in ENSEMBLE_MODELS if name in models]
+
+    async def admitted_ensemble():
+        ticket = await admission.admit(names, upload_cost(upload.width, upload.height), request_lane(request.headers))
+        async with ticket:
+            # The lease keeps this request on the model versions it started with if a reload swaps them
+            with ModelLease(names) as lease:
+                return await run_in_threadpool(ensemble_local, lease.models, contents, threshold, include_heatmaps,
+                                               heatmap_format, heatmap_mode, upload.sha256)
+
+    per_model = await cancel_on_disconnect(request, admitted_ensemble())
+
+    result = {
+        "models": per_model,
+        "ensemble": ensemble_decision(per_model, threshold)
+    }
+    return finish_response(result, response_format, trace)
 
-    per_model = []
-    fake_votes = 0
+def ensemble_local(pinned, contents, threshold, include_heatmaps, heatmap_format, heatmap_mode, sha256=None):
+    """
+    Per-model entries (with heatmaps) for the ensemble on the pinned models (name -> model, in
+    response order); runs in a worker thread once admitted.
+    Under a deadline the members run fastest first, and members or heatmaps that no longer fit are skipped.
+    """
+    check("preprocess")
+    img_array = preprocess_image(contents)
 
     # For heatmaps reuse original image array before preprocessing for Grad-CAM
     raw_img_for_gradcam = None
     if include_heatmaps:
         try:
-            raw_img_for_gradcam = toImageArray(io.BytesIO(contents))
+            with stage("decode_overlay"):
+                raw_img_for_gradcam = toImageArray(io.BytesIO(contents), max_edge=HEATMAP_CONFIG["max_edge"])
         except Exception:
             raw_img_for_gradcam = None
 
-    for name in ["cnn", "effnet", "vgg"]:
-        if name not in models:
+    names = list(pinned)
+    entries = {}
+    cam_grids = {}
+    for i, name in enumerate(sorted(names, key=lambda name: stage_estimate("inference", name) or 0.0)):
+        if i == 0:
+            check("inference")
+        elif not affordable("inference", name):
+            skip("inference", name)
+            entries[name] = {"model": name, "skipped": True, "stub": is_stub(pinned[name])}
+            continue
+        entries[name], cam_grids[name] = ensemble_member_prediction(name, img_array, threshold,
+                                                                    raw_img_for_gradcam is not None, heatmap_mode,
+                                                                    pinned[name], sha256)
+
+    for name, entry in entries.items():
+        mode = entry.get("heatmap_mode", "none")
+        if "error" in entry or mode == "none":
             continue
-        model_obj = models[name]
+        if not affordable(f"heatmap_{mode}", name):
+            skip("heatmap", name)
+            entry["heatmap_mode"] = "none"
+            continue
+        with measure(f"heatmap_{mode}", name):
+            entry["heatmap"] = ensemble_member_heatmap(name, mode, cam_grids[name], raw_img_for_gradcam, heatmap_format,
+                                                       pinned[name])
+    return [entries[name] for name in names]
+
+def sse_event(event, data):
+    """One server-sent event carrying a JSON payload"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.post("/predict/ensemble/stream")
+async def predict_ensemble_stream(request: Request, file: UploadFile = File(...), threshold: float = 0.5,
+                                  include_heatmaps: bool = True, heatmap_format: str = HEATMAP_CONFIG["default_format"],
+                                  heatmap_mode: str = HEATMAP_CONFIG["default_mode"]):
+    """Progressive variant of /predict/ensemble over server-sent events.
+
+    The models run concurrently and each one's verdict is pushed as a "model" event
+    as soon as it finishes, followed by the "ensemble" decision, then one "heatmap"
+    event per model as heatmaps render, and finally "done". Events carry the same
+    JSON as the corresponding parts of the /predict/ensemble response.
+    """
+    if not 0.1 <= threshold <= 0.9:
+        raise HTTPException(status_code=400, detail="Threshold must be between 0.1 and 0.9")
+    validate_output_formats(heatmap_format, "json", heatmap_mode)
+    if heatmap_mode == "none":
+        include_heatmaps = False
+
+    with stage("upload"):
+        upload = await read_upload(file)
+    contents = upload.contents
+
+    if use_remote_models:
+        # The remote members answer in one piece; relay them as the same event sequence
+        remote = await predict_ensemble(
+            request, UploadFile(io.BytesIO(contents), filename=file.filename, headers=file.headers),
+            threshold=threshold, include_heatmaps=include_heatmaps, heatmap_format=heatmap_format,
+            response_format="json", heatmap_mode=heatmap_mode
+        )
+
+        def relay():
+            for entry in remote["models"]:
+                yield sse_event("model", {k: v for k, v in entry.items() if k != "heatmap"})
+            yield sse_event("ensemble", remote["ensemble"])
+            for entry in remote["models"]:
+                if entry.get("heatmap") is not None:
+                    yield sse_event("heatmap", {"model": entry["model"], "heatmap": entry["heatmap"],
+                                                "heatmap_mode": entry.get("heatmap_mode")})
+            yield sse_event("done", {"skipped": remote["skipped"]} if remote.get("skipped") else {})
+
+        return StreamingResponse(relay(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+    names = [name for name in ENSEMBLE_MODELS if name in models]
+    if not names:
+        raise HTTPException(status_code=503, detail="No models loaded")
+    ticket = await admission.admit(names, upload_cost(upload.width, upload.height), request_lane(request.headers))
+    lease = ModelLease(names)
+
+    def release_request():
+        lease.release()
+        ticket.release()
+
+    try:
+        img_array = await run_in_threadpool(preprocess_image, contents)
+    except BaseException:
+        release_request()
+        raise
+    deadline = current_deadline()
+    # Members run concurrently; under a deadline the ones that usually take too long aren't started
+    by_speed = sorted(names, key=lambda name: stage_estimate("inference", name) or 0.0)
+    skipped_members = [name for name in by_speed[1:] if not affordable("inference", name)]
+    for name in skipped_members:
+        skip("inference", name)
+
+    def decode_overlay():
         try:
-            prediction = model_obj.predict(img_array)
-            prediction_flat = prediction.flatten()
-            if len(prediction_flat) == 1:
-                sigmoid_prob = float(prediction_flat[0])
-                probabilities = [1.0 - sigmoid_prob, sigmoid_prob]
-                predicted_class = 1 if sigmoid_prob > threshold else 0
-                fake_confidence = sigmoid_prob
-            else:
-                probabilities = prediction.tolist()[0]
-                predicted_class = int(np.argmax(prediction, axis=1)[0])
-                fake_confidence = probabilities[1] if len(probabilities) > 1 else 0.5
-
-            if predicted_class == 1:
-                fake_votes += 1
-
-            heatmap_b64 = None
-            if include_heatmaps and raw_img_for_gradcam is not None and not isinstance(model_obj, _StubModel):
-                try:
-                    actual_model = model_obj.model if hasattr(model_obj, 'model') else model_obj
-                    heatmap_b64 = generate_improved_gradcam(
-                        actual_model,
-                        raw_img_for_gradcam,
-                        model_type="cnn" if name == "cnn" else ("effnet" if name == "effnet" else "vgg")
+            with stage("decode_overlay"):
+                return toImageArray(io.BytesIO(contents), max_edge=HEATMAP_CONFIG["max_edge"])
+        except Exception:
+            return None
+
+    async def events():
+        overlay_task = asyncio.ensure_future(run_in_threadpool(decode_overlay)) if include_heatmaps else None
+        predictions = [
+            asyncio.ensure_future(run_in_threadpool(
+                ensemble_member_prediction, name, img_array, threshold, include_heatmaps, heatmap_mode,
+                lease.models[name], upload.sha256
+            ))
+            for name in names if name not in skipped_members
+        ]
+        try:
+            per_model = {}
+            cam_grids = {}
+            for name in skipped_members:
+                per_model[name] = {"model": name, "skipped": True, "stub": is_stub(lease.models[name])}
+                cam_grids[name] = None
+                yield sse_event("model", per_model[name])
+            for finished in asyncio.as_completed(predictions):
+                entry, cam_grid = await finished
+                per_model[entry["model"]] = entry
+                cam_grids[entry["model"]] = cam_grid
+                yield sse_event("model", {k: v for k, v in entry.items() if k != "heatmap"})
+
+            try:
+                decision = ensemble_decision([per_model[name] for name in names], threshold)
+            except HTTPException as e:
+                yield sse_event("error", {"detail": e.detail})
+                return
+            yield sse_event("ensemble", decision)
+
+            overlay = await overlay_task if overlay_task is not None else None
+            if overlay is not None:
+                async def render(name):
+                    entry = per_model[name]
+                    with measure(f"heatmap_{entry['heatmap_mode']}", name):
+                        heatmap = await run_in_threadpool(ensemble_member_heatmap, name, entry["heatmap_mode"],
+                                                          cam_grids[name], overlay, heatmap_format,
+                                                          lease.models[name])
+                    return encode_prediction_response(
+                        {"model": name, "heatmap": heatmap, "heatmap_mode": entry["heatmap_mode"]}, "json"
                     )
-                except Exception:
-                    heatmap_b64 = None
+                pending = []
+                for name in names:
+                    mode = per_model[name].get("heatmap_mode", "none")
+                    if mode == "none":
+                        continue
+                    if affordable(f"heatmap_{mode}", name):
+                        pending.append(name)
+                    else:
+                        skip("heatmap", name)
+                for finished in asyncio.as_completed([render(name) for name in pending]):
+                    yield sse_event("heatmap", await finished)
+            yield sse_event("done", {"skipped": deadline.skipped} if deadline is not None and deadline.skipped else {})
+        except (asyncio.CancelledError, GeneratorExit):
+            # The client went away mid-stream; stop model work at its next deadline check
+            if deadline is not None:
+                deadline.cancel("client disconnected")
+            raise
+        finally:
+            for task in predictions + ([overlay_task] if overlay_task is not None else []):
+                task.cancel()
+            release_request()
 
-            per_model.append({
-                "model": name,
-                "predicted_class": predicted_class,
-                "probabilities": probabilities,
-                "probability": fake_confidence,
-                "heatmap": heatmap_b64,
-                "stub": isinstance(model_obj, _StubModel)
-            })
-        except Exception as e:
-            per_model.append({
-                "model": name,
-                "error": str(e),
-                "stub": isinstance(model_obj, _StubModel)
-            })
-
-    total_models = sum(1 for m in per_model if 'predicted_class' in m)
-    if total_models == 0:
-        raise HTTPException(status_code=500, detail="All model predictions failed")
-
-    # Majority vote decision (ties -> real)
-    majority_fake = fake_votes > (total_models / 2)
-
-    # Ensemble confidence: average of fake probabilities (for models that produced probabilities)
-    fake_probs = [m.get('probabilities', [None, None])[1] for m in per_model if m.get('probabilities') and len(m['probabilities']) > 1]
-    if not fake_probs:
-        # Fallback: use single-output probabilities if available
-        fake_probs = [m.get('probability') for m in per_model if m.get('probability') is not None]
-    ensemble_confidence = float(np.mean(fake_probs)) if fake_probs else 0.5
+    # The background task also releases the request if the client goes away before the stream starts
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+                             background=BackgroundTask(release_request))
 
-    return {
-        "models": per_model,
-        "ensemble": {
-            "majority_label": "fake" if majority_fake else "real",
-            "majority_class": 1 if majority_fake else 0,
-            "fake_votes": fake_votes,
-            "total_models": total_models,
-            "ensemble_confidence": ensemble_confidence,
-            "threshold": threshold
-        }
-    }
+@app.post("/predict/video")
+async def predict_video(request: Request, file: UploadFile = File(...), threshold: float = 0.5, sample: str = VIDEO_CONFIG["sample"],
+                        fps: float = VIDEO_CONFIG["fps"], scene_threshold: float = VIDEO_CONFIG["scene_threshold"],
+                        max_frames: int = VIDEO_CONFIG["max_frames"], model_names: str = "cnn,effnet,vgg"):
+    """Score a video or animated image frame by frame.
+
+    Frames are sampled at `fps` (sample=rate) or on scene changes (sample=scene),
+    near-duplicate frames are skipped, and sampled frames run through each model in
+    batches. The response is newline-delimited JSON streamed as batches finish: a
+    "start" record, one "frames" record per batch with per-frame scores, then a
+    "summary" record with the aggregate verdict.
+    """
+    if not 0.1 <= threshold <= 0.9:
+        raise HTTPException(status_code=400, detail="Threshold must be between 0.1 and 0.9")
+    if sample not in SAMPLING_MODES:
+        raise HTTPException(status_code=400, detail=f"Invalid sample. Use one of: {', '.join(SAMPLING_MODES)}")
+    if fps <= 0 or not 0 <= scene_threshold <= 1 or not 1 <= max_frames <= VIDEO_CONFIG["max_frames"]:
+        raise HTTPException(status_code=400, detail=f"fps must be > 0, scene_threshold in [0, 1] and max_frames in [1, {VIDEO_CONFIG['max_frames']}]")
+    names = [name.strip() for name in model_names.split(",") if name.strip()]
+    names = ["vgg" if name == "vgg16" else name for name in names]
+    if not names or any(name not in ("cnn", "effnet", "vgg") for name in names):
+        raise HTTPException(status_code=400, detail="Invalid model_names. Use a comma-separated list of cnn, effnet, vgg")
+    if use_remote_models:
+        raise HTTPException(status_code=501, detail="Video analysis runs on local models only")
+    missing = [name for name in names if name not in models]
+    if missing:
+        raise HTTPException(status_code=503, detail=f"Models not loaded: {', '.join(missing)}")
+
+    # Video is bulk traffic, charged up front for its worst case (max_frames model-sized frames)
+    frame_pixels = PREPROCESSING_CONFIG["image_size"][0] * PREPROCESSING_CONFIG["image_size"][1]
+    ticket = await admission.admit(names, max_frames * frame_pixels / 1e6, "bulk")
+
+    # OpenCV decodes from a path, so the upload is streamed to a temporary file
+    suffix = os.path.splitext(file.filename or "")[1][:10]
+    temp = tempfile.NamedTemporaryFile(prefix="authnet-video-", suffix=suffix, delete=False)
+    try:
+        with temp, stage("upload"):
+            size, digest = await read_upload_to_file(file, temp, VIDEO_CONFIG["max_bytes"])
+        frames = sample_frames(decode_frames(temp.name, fps if sample == "rate" else None), sample=sample, fps=fps,
+                               scene_threshold=scene_threshold, max_frames=max_frames)
+        # Decode the first frame up front so undecodable uploads get a plain 400
+        first = await run_in_threadpool(next, frames, None)
+    except VideoDecodeError as e:
+        os.unlink(temp.name)
+        ticket.release()
+        raise HTTPException(status_code=400, detail=f"Upload is not a readable video or animated image: {e}")
+    except BaseException:
+        os.unlink(temp.name)
+        ticket.release()
+        raise
+    if first is None:
+        os.unlink(temp.name)
+        ticket.release()
+        raise HTTPException(status_code=400, detail="No frames could be decoded from the upload")
+
+    lease = ModelLease(names)
+    predict_fns = {name: (lambda batch, name=name: run_model(name, batch, lease.models[name])) for name in names}
+    deadline = current_deadline()
+
+    def release_request():
+        lease.release()
+        ticket.release()
+
+    def stream():
+        scored = []
+        try:
+            yield json.dumps({"type": "start", "sha256": digest, "bytes": size, "sample": sample,
+                              "models": names, "model_versions": lease.versions()}) + "\n"
+            for batch in score_frames(itertools.chain([first], frames), predict_fns):
+                scored.extend(batch)
+                yield json.dumps({"type": "frames", "frames": batch}) + "\n"
+                if deadline is not None and deadline.expired():
+                    # Out of time: the summary covers the frames scored so far
+                    deadline.skip("frames")
+                    break
+            summary = dict(summarize(scored, threshold), type="summary")
+            if deadline is not None and deadline.skipped:
+                summary["skipped"] = deadline.skipped
+            yield json.dumps(summary) + "\n"
+        except VideoDecodeError as e:
+            yield json.dumps({"type": "error", "detail": str(e), "frames": len(scored)}) + "\n"
+        finally:
+            frames.close()
+            os.unlink(temp.name)
+            release_request()
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson", background=BackgroundTask(release_request))
 
 @app.post("/predict/{model_name}")
-async def predict(model_name: str, file: UploadFile = File(...), threshold: float = 0.5):
+async def predict(model_name: str, request: Request, file: UploadFile = File(...), threshold: float = 0.5,
+                  include_heatmaps: bool = True, heatmap_format: str = HEATMAP_CONFIG["default_format"],
+                  response_format: str = "json", trace: bool = False,
+                  heatmap_mode: str = HEATMAP_CONFIG["default_mode"], analysis: str = "global",
+                  tile_stride: int = 0, max_tiles: int = 0, tile_aggregate: str = TILING_CONFIG["aggregate"]):
     # Accept both 'vgg' and 'vgg16' for compatibility
     valid_models = ["cnn", "effnet", "vgg", "vgg16"]
     if model_name not in valid_models:
@@ -323,47 +644,41 @@ async def predict(model_name: str, file: UploadFile = File(...), threshold: floa
     # Validate threshold
     if not 0.1 <= threshold <= 0.9:
         raise HTTPException(status_code=400, detail="Threshold must be between 0.1 and 0.9")
+    validate_output_formats(heatmap_format, response_format, heatmap_mode)
+    if heatmap_mode == "none":
+        include_heatmaps = False
+    if analysis not in ("global", "tiled"):
+        raise HTTPException(status_code=400, detail="Invalid analysis. Use global or tiled")
+    if tile_aggregate not in AGGREGATIONS:
+        raise HTTPException(status_code=400, detail=f"Invalid tile_aggregate. Use one of: {', '.join(AGGREGATIONS)}")
+    if tile_stride < 0 or max_tiles < 0 or max_tiles > TILING_CONFIG["max_tiles"]:
+        raise HTTPException(status_code=400, detail=f"tile_stride must be >= 0 and max_tiles between 0 and {TILING_CONFIG['max_tiles']}")
     
     # Normalize vgg16 to vgg for internal processing
     internal_model_name = "vgg" if model_name == "vgg16" else model_name
     
-    contents = await file.read()
+    with stage("upload"):
+        upload = await read_upload(file)
+    contents = upload.contents
     
-    # If using remote models, forward the request
+    # If using remote models, get the prediction from the model server; the rest of the analysis is local-only
     if use_remote_models:
-        try:
-            remote_url = f"{MODEL_CONFIG['remote']['server_url']}{MODEL_CONFIG['remote']['endpoints'][internal_model_name]}"
-            
-            # Prepare headers with API key if provided
-            headers = {}
-            if MODEL_CONFIG['remote']['api_key']:
-                headers['Authorization'] = f"Bearer {MODEL_CONFIG['remote']['api_key']}"
-            
-            # Create a new file-like object from the contents
-            files = {'file': (file.filename, contents, file.content_type)}
-            
-            # Forward the request to the remote model server
-            response = requests.post(
-                remote_url,
-                files=files,
-                headers=headers,
-                timeout=MODEL_CONFIG['remote']['timeout']
-            )
-            
-            # Check if the request was successful
-            if response.status_code == 200:
-                return response.json()
-            else:
-                raise HTTPException(
-                    status_code=response.status_code,
-                    detail=f"Remote model server error: {response.text}"
-                )
-                
-        except requests.RequestException as e:
-            raise HTTPException(
-                status_code=503,
-                detail=f"Error connecting to remote model server: {str(e)}"
-            )
+        if analysis == "tiled":
+            raise HTTPException(status_code=501, detail="Tiled analysis runs on local models only")
+        entry = await run_in_threadpool(remote_prediction, internal_model_name, file.filename, file.content_type,
+                                        contents, threshold)
+        fake_confidence = entry["probability"]
+        payload = {
+            **entry,
+            "model": model_name,
+            "threshold": threshold,
+            "sensitivity": "High" if threshold < 0.4 else ("Low" if threshold > 0.6 else "Medium"),
+            "interpretation": f"{'FAKE' if entry['predicted_class'] == 1 else 'REAL'} ({fake_confidence:.1%} fake confidence)"
+        }
+        skipped = remote_heatmap_skips([internal_model_name], include_heatmaps)
+        if skipped:
+            payload["skipped"] = skipped
+        return finish_response(payload, response_format, trace)
     
     # If not using remote models, use local models
     if internal_model_name not in models:
@@ -372,96 +687,22 @@ async def predict(model_name: str, file: UploadFile = File(...), threshold: floa
             detail=f"Model {internal_model_name} is not loaded and no remote server is configured"
         )
     
-    # Process with local model
+    # Process with local model once admitted to its queue; a client disconnect cancels the work
+    async def admitted_prediction():
+        ticket = await admission.admit([internal_model_name], upload_cost(upload.width, upload.height),
+                                       request_lane(request.headers))
+        async with ticket:
+            with ModelLease([internal_model_name]) as lease:
+                return await run_in_threadpool(predict_local, model_name, internal_model_name,
+                                               lease.models[internal_model_name], contents, threshold,
+                                               include_heatmaps, heatmap_format, heatmap_mode, analysis,
+                                               tile_stride, max_tiles, tile_aggregate, upload.sha256)
+
     try:
-        img_array = preprocess_image(contents)
-        prediction = models[internal_model_name].predict(img_array)
-        
-        # Handle both single output (sigmoid) and dual output (softmax) models
-        prediction_flat = prediction.flatten()
-        
-        if len(prediction_flat) == 1:
-            # Single output sigmoid model (like original CNN)
-            sigmoid_prob = float(prediction_flat[0])
-            probabilities = [1.0 - sigmoid_prob, sigmoid_prob]  # [real_prob, fake_prob]
-            predicted_class = 1 if sigmoid_prob > threshold else 0  # Use custom threshold
-            fake_confidence = sigmoid_prob
-        else:
-            # Dual output softmax model (like VGG, EffNet binary)
-            probabilities = prediction.tolist()[0]
-            predicted_class = int(np.argmax(prediction, axis=1)[0])
-            fake_confidence = probabilities[1] if len(probabilities) > 1 else 0.5
-        
-        print(f"🔍 Model {internal_model_name} predictions (threshold: {threshold}):")
-        print(f"   Raw prediction shape: {prediction.shape}")
-        print(f"   Raw prediction: {prediction.flatten()}")
-        print(f"   Final probabilities: {probabilities}")
-        print(f"   Predicted class: {predicted_class}")
-        print(f"   Threshold used: {threshold} ({'High sensitivity' if threshold < 0.4 else 'Low sensitivity' if threshold > 0.6 else 'Medium sensitivity'})")
-        
-        # Generate heatmap using utilities  
-        heatmap_data = None
-        try:
-            print(f"🔍 Checking if heatmap generation is possible for {internal_model_name}")
-            print(f"   Model type: {type(models[internal_model_name])}")
-            print(f"   Is StubModel: {isinstance(models[internal_model_name], _StubModel)}")
-            
-            # Only generate heatmaps for models that loaded successfully (not stubs)
-            if not isinstance(models[internal_model_name], _StubModel):
-                print(f"✅ Proceeding with heatmap generation for {internal_model_name}")
-                # Convert file contents to image array for grad-cam
-                img_for_gradcam = toImageArray(io.BytesIO(contents))
-                print(f"   Image shape: {img_for_gradcam.shape}")
-                
-                if internal_model_name == "cnn":
-                    # Use the improved GradCAM function with the loaded model
-                    actual_model = models[internal_model_name].model if hasattr(models[internal_model_name], 'model') else models[internal_model_name]
-                    print(f"   Using model: {type(actual_model)}")
-                    heatmap_data = generate_improved_gradcam(
-                        actual_model, 
-                        img_for_gradcam, 
-                        model_type="cnn"
-                    )
-                    print(f"   Heatmap result: {'generated' if heatmap_data else 'None'}")
-                elif internal_model_name == "vgg":
-                    # Use GradCAM for VGG16
-                    actual_model = models[internal_model_name].model if hasattr(models[internal_model_name], 'model') else models[internal_model_name]
-                    print(f"   Using VGG model: {type(actual_model)}")
-                    heatmap_data = generate_improved_gradcam(
-                        actual_model, 
-                        img_for_gradcam, 
-                        model_type="vgg"
-                    )
-                    print(f"   VGG Heatmap result: {'generated' if heatmap_data else 'None'}")
-                elif internal_model_name == "effnet":
-                    # Use GradCAM for EfficientNet
-                    actual_model = models[internal_model_name].model if hasattr(models[internal_model_name], 'model') else models[internal_model_name]
-                    print(f"   Using EffNet model: {type(actual_model)}")
-                    heatmap_data = generate_improved_gradcam(
-                        actual_model, 
-                        img_for_gradcam, 
-                        model_type="effnet"
-                    )
-                    print(f"   EffNet Heatmap result: {'generated' if heatmap_data else 'None'}")
-                else:
-                    print(f"Info: Unknown model type {internal_model_name}")
-            else:
-                print(f"Info: Skipping heatmap generation for {internal_model_name} (using stub model)")
-        except Exception as e:
-            print(f"Warning: Could not generate heatmap for {internal_model_name}: {e}")
-            import traceback
-            traceback.print_exc()
-        
-        return {
-            "model": model_name,  # Return original model name for API consistency
-            "predicted_class": predicted_class,
-            "probabilities": probabilities,
-            "probability": fake_confidence,  # Fake probability
-            "threshold": threshold,
-            "sensitivity": "High" if threshold < 0.4 else ("Low" if threshold > 0.6 else "Medium"),
-            "interpretation": f"{'FAKE' if predicted_class == 1 else 'REAL'} ({fake_confidence:.1%} fake confidence)",
-            "heatmap": heatmap_data
-        }
+        payload = await cancel_on_disconnect(request, admitted_prediction())
+        return finish_response(payload, response_format, trace)
+    except (HTTPException, DeadlineExceeded):
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=500,
@@ -470,146 +711,343 @@ async def predict(model_name: str, file: UploadFile = File(...), threshold: floa
 
 
 
-# Improved GradCAM function that works with pre-loaded models
-def generate_improved_gradcam(actual_model, img_array, model_type="cnn", target_size=(224, 224), intensity=0.4):
-    """
-    Generate GradCAM heatmap using already-loaded model
-    """
+def predict_local(model_name, internal_model_name, model_obj, contents, threshold, include_heatmaps, heatmap_format,
+                  heatmap_mode, analysis, tile_stride, max_tiles, tile_aggregate, sha256=None):
+    """Prediction (plus heatmap and tiles) on the pinned local model; runs in a worker thread once admitted"""
+    check("preprocess")
+    img_array = preprocess_image(contents)
+    mode = "none"
+    if include_heatmaps and not is_stub(model_obj):
+        mode = resolve_heatmap_mode(model_obj, internal_model_name, heatmap_mode)
+    cam_grid = None
+    features = {} if sha256 is not None and capturing(internal_model_name) else None
+    if mode == "cam":
+        # CAM comes out of the forward pass itself
+        prediction, cam_grid = run_model_with_cam(internal_model_name, img_array, model_obj, features)
+    else:
+        prediction = run_model(internal_model_name, img_array, model_obj, features)
+    
+    predicted_class, probabilities, fake_confidence = interpret_prediction(prediction, threshold)
+    if features:
+        capture_embedding(internal_model_name, model_obj, features, sha256, predicted_class, fake_confidence)
+    if mode != "none" and not affordable(f"heatmap_{mode}", internal_model_name):
+        # Not enough time left for the heatmap; the prediction alone still answers the request
+        skip("heatmap", internal_model_name)
+        mode = "none"
+    
+    if request_sampled():
+        logger.debug(
+            "Model prediction",
+            extra={
+                "model": internal_model_name,
+                "raw_prediction": prediction.flatten().tolist(),
+                "probabilities": probabilities,
+                "predicted_class": predicted_class,
+                "threshold": threshold
+            }
+        )
+    
+    # Generate heatmap using utilities  
+    heatmap_data = None
     try:
-        if not TF_AVAILABLE:
-            return None
-            
-        # Preprocess image for the model
-        img_resized = cv2.resize(img_array, target_size)
-        x = np.expand_dims(img_resized, axis=0)
-        
-        # Normalize the input (0-1 range)
-        x = x.astype(np.float32) / 255.0
-        
-        # Try to find the last convolutional layer based on model type
-        conv_layer_name = None
-        conv_layers = []
-        
-        # Get the actual Keras model from wrapper
-        keras_model = actual_model.model if hasattr(actual_model, 'model') else actual_model
-        
-        # Model-specific layer name mapping
-        if model_type == "cnn":
-            # For CNN, use conv2d layers
-            for layer in keras_model.layers:
-                if 'conv2d' in layer.name.lower():
-                    conv_layers.append(layer.name)
-        elif model_type == "vgg":
-            # For VGG, look for block conv layers, prefer block5
-            for layer in keras_model.layers:
-                if 'conv' in layer.name.lower():
-                    conv_layers.append(layer.name)
-        elif model_type == "effnet":
-            # For EfficientNet, look for expansion or top conv layers
-            for layer in keras_model.layers:
-                if 'conv' in layer.name.lower():
-                    conv_layers.append(layer.name)
-        else:
-            # Generic approach
-            for layer in keras_model.layers:
-                if any(layer_type in layer.__class__.__name__.lower() for layer_type in ['conv2d', 'conv', 'convolution']):
-                    conv_layers.append(layer.name)
+        # Only generate heatmaps for models that loaded successfully (not stubs)
+        if mode != "none":
+            with measure(f"heatmap_{mode}", internal_model_name):
+                # Convert file contents to image array for grad-cam
+                with stage("decode_overlay"):
+                    img_for_gradcam = toImageArray(io.BytesIO(contents), max_edge=HEATMAP_CONFIG["max_edge"])
                 
-        if conv_layers:
-            # Use the last conv layer for all models
-            conv_layer_name = conv_layers[-1]
-            print(f"🎯 Using conv layer: {conv_layer_name} for {model_type}")
-            print(f"   Available conv layers: {conv_layers}")
+                if mode == "cam":
+                    if cam_grid is not None:
+                        heatmap_data = encode_model_heatmap(cam_grid, img_for_gradcam, internal_model_name, heatmap_format)
+                else:
+                    # Use the improved GradCAM function with the leased model (dispatched to a replica)
+                    heatmap_data = generate_improved_gradcam(
+                        model_obj, 
+                        img_for_gradcam, 
+                        model_type=internal_model_name,
+                        heatmap_format=heatmap_format
+                    )
         else:
-            print(f"Warning: No convolutional layer found for {model_type}")
-            return None
-        
-        # Build gradient model using the Keras model
-        try:
-            grad_model = tf.keras.models.Model(
-                [keras_model.inputs],
-                [keras_model.get_layer(conv_layer_name).output, keras_model.output]
-            )
-        except Exception as grad_error:
-            print(f"Error building gradient model: {grad_error}")
-            return None
-        
-        # Forward and backward pass
-        with tf.GradientTape() as tape:
-            conv_outputs, predictions = grad_model(x)
-            
-            # Handle predictions - ensure it's a tensor
-            if isinstance(predictions, list):
-                predictions = tf.convert_to_tensor(predictions)
-            
-            # Get the class with highest probability (convert to scalar)
-            class_idx = tf.argmax(predictions[0])
-            class_idx_scalar = int(class_idx.numpy())  # Convert to Python int
-            loss = predictions[:, class_idx_scalar]
-
-        # Compute gradients
-        grads = tape.gradient(loss, conv_outputs)
-        
-        if grads is None:
-            print(f"Warning: No gradients computed for {model_type}")
-            return None
-            
-        pooled_grads = tf.reduce_mean(grads, axis=(0, 1, 2))
-
-        # Generate heatmap
-        conv_outputs = conv_outputs[0]
-        heatmap = conv_outputs @ pooled_grads[..., tf.newaxis]
-        heatmap = tf.squeeze(heatmap)
-        
-        # Normalize heatmap
-        heatmap = tf.maximum(heatmap, 0)
-        heatmap_max = tf.math.reduce_max(heatmap)
-        if heatmap_max > 0:
-            heatmap = heatmap / heatmap_max
+            logger.debug("Skipping heatmap generation for %s (stub model or heatmaps off)", internal_model_name)
+    except Exception as e:
+        logger.warning("Could not generate heatmap for %s: %s", internal_model_name, e)
+    
+    tiles = None
+    if analysis == "tiled":
+        if affordable("tiles", internal_model_name):
+            with measure("tiles", internal_model_name):
+                tiles = analyze_image_tiles(internal_model_name, contents, tile_stride, max_tiles, tile_aggregate,
+                                            threshold, heatmap_format if include_heatmaps else None, model_obj)
         else:
-            print(f"Warning: Zero max in heatmap for {model_type}")
-            return None
+            skip("tiles", internal_model_name)
+    
+    return {
+        "model": model_name,  # Return original model name for API consistency
+        "predicted_class": predicted_class,
+        "probabilities": probabilities,
+        "probability": fake_confidence,  # Fake probability
+        "threshold": threshold,
+        "sensitivity": "High" if threshold < 0.4 else ("Low" if threshold > 0.6 else "Medium"),
+        "interpretation": f"{'FAKE' if predicted_class == 1 else 'REAL'} ({fake_confidence:.1%} fake confidence)",
+        "heatmap": heatmap_data,
+        "heatmap_mode": mode,
+        "model_version": model_version(model_obj),
+        **({"tiles": tiles} if tiles is not None else {})
+    }
+
+def analyze_image_tiles(name, contents, tile_stride, max_tiles, tile_aggregate, threshold, heatmap_format=None,
+                        model_obj=None):
+    """Tiled analysis of an upload at native resolution; the tile score map is the (coarse) heatmap"""
+    with stage("tiles", model=name):
+        tiles = analyze_tiles(contents, lambda batch: run_model(name, batch, model_obj), stride=tile_stride or None,
+                              max_tiles=max_tiles or None, aggregate=tile_aggregate)
+    score_map = tiles.pop("score_map")
+    tiles["scores"] = score_map.round(4).tolist()
+    tiles["predicted_class"] = 1 if tiles["score"] > threshold else 0
+    if heatmap_format is not None:
+        # Score map is already in [0, 1]; encode it as-is so colors are comparable across images
+        with stage("decode_overlay"):
+            overlay = toImageArray(io.BytesIO(contents), max_edge=HEATMAP_CONFIG["max_edge"])
+        tiles["heatmap"] = encode_model_heatmap(score_map, overlay, name, heatmap_format)
+    return tiles
+
+def generate_improved_gradcam(model_obj, img_array, model_type="cnn", target_size=(224, 224), intensity=0.4,
+                              heatmap_format="jpeg"):
+    """
+    Generate GradCAM heatmap using an already-loaded registry model (run on its least busy replica),
+    encoded per heatmap_format (see utilities.encode_heatmap). Returns None if no heatmap could be produced.
+    """
+    with GRADCAM_LATENCY.time(model=model_type), stage("gradcam", model=model_type):
+        heatmap = compute_gradcam_heatmap(model_obj, img_array, model_type=model_type, target_size=target_size)
+    if heatmap is None:
+        return None
+    return encode_model_heatmap(heatmap, img_array, model_type, heatmap_format, intensity)
 
-        # Resize heatmap to match original image size
-        heatmap_resized = cv2.resize(heatmap.numpy(), (img_array.shape[1], img_array.shape[0]))
-        
-        # Convert to color map
-        heatmap_colored = np.uint8(255 * heatmap_resized)
-        heatmap_colored = cv2.applyColorMap(heatmap_colored, cv2.COLORMAP_JET)
-
-        # Create overlay with better blending
-        # Ensure img_array is in the right format
-        if img_array.max() <= 1.0:
-            img_array = (img_array * 255).astype(np.uint8)
-        
-        superimposed_img = cv2.addWeighted(img_array, 1-intensity, heatmap_colored, intensity, 0)
-
-        # Convert to Base64 string
-        pil_img = Image.fromarray(superimposed_img)
-        buffer = BytesIO()
-        pil_img.save(buffer, format="JPEG", quality=90)
-        gradcam_b64 = base64.b64encode(buffer.getvalue()).decode("utf-8")
-
-        print(f"✅ Generated heatmap for {model_type} (size: {len(gradcam_b64)} chars)")
-        return gradcam_b64
-        
+def encode_model_heatmap(heatmap, img_array, model_type, heatmap_format="jpeg", intensity=0.4):
+    """Encode a normalized Grad-CAM/CAM grid per heatmap_format; None if encoding fails"""
+    try:
+        with HEATMAP_ENCODE_LATENCY.time(model=model_type, format=heatmap_format), stage("heatmap_encode", model=model_type):
+            encoded = encode_heatmap(
+                heatmap,
+                img_array,
+                heatmap_format=heatmap_format,
+                intensity=intensity,
+                max_edge=HEATMAP_CONFIG["max_edge"],
+                quality=HEATMAP_CONFIG["webp_quality"] if heatmap_format == "webp" else HEATMAP_CONFIG["jpeg_quality"]
+            )
+        logger.debug("Generated heatmap", extra={"model": model_type, "format": heatmap_format, "bytes": len(encoded["data"])})
+        return encoded
     except Exception as e:
-        print(f"Error generating GradCAM for {model_type}: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.warning("Error encoding heatmap for %s: %s", model_type, e)
         return None
 
+@app.post("/jobs", status_code=202)
+async def submit_job(file: UploadFile = File(...), kind: str = "ensemble", model_name: str = "cnn",
+                     model_names: str = "cnn,effnet,vgg", threshold: float = 0.5, tile_stride: int = 0,
+                     max_tiles: int = 0, tile_aggregate: str = TILING_CONFIG["aggregate"],
+                     sample: str = VIDEO_CONFIG["sample"], fps: float = VIDEO_CONFIG["fps"],
+                     scene_threshold: float = VIDEO_CONFIG["scene_threshold"],
+                     max_frames: int = VIDEO_CONFIG["max_frames"]):
+    """Queue an analysis job (predict, ensemble, tiled, video or a zip archive of images).
+
+    Only the parameters relevant to `kind` are kept. Resubmitting the same content
+    with the same parameters returns the existing job instead of queueing a new one.
+    """
+    if not jobs_enabled():
+        raise HTTPException(status_code=503, detail="Jobs are disabled (no job workers or remote models in use)")
+    try:
+        params = job_params(kind, model_name=model_name, model_names=model_names, threshold=threshold,
+                            tile_stride=tile_stride, max_tiles=max_tiles, tile_aggregate=tile_aggregate,
+                            sample=sample, fps=fps, scene_threshold=scene_threshold, max_frames=max_frames)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    # Stream the upload into the input store without holding it in memory
+    os.makedirs(JOBS_CONFIG["data_dir"], exist_ok=True)
+    suffix = os.path.splitext(file.filename or "")[1][:10]
+    temp = tempfile.NamedTemporaryFile(prefix=".upload-", suffix=suffix, dir=JOBS_CONFIG["data_dir"], delete=False)
+    try:
+        with temp, stage("upload"):
+            size, digest = await read_upload_to_file(file, temp, JOBS_CONFIG["max_bytes"])
+        input_path = store_input(temp.name, digest, suffix)
+    except BaseException:
+        if os.path.exists(temp.name):
+            os.unlink(temp.name)
+        raise
+    row, deduplicated = await run_in_threadpool(get_job_store().submit, kind, params, digest, input_path)
+    return {"job_id": row["id"], "status": row["status"], "deduplicated": deduplicated, "sha256": digest,
+            "bytes": size}
+
+def find_job(job_id):
+    row = get_job_store().get(job_id)
+    if row is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return row
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    """Status and progress of a job"""
+    return job_status(find_job(job_id))
+
+@app.get("/jobs/{job_id}/result")
+def get_job_result(job_id: str):
+    """Result of a finished job; 409 while it is queued or running or if it failed"""
+    row = find_job(job_id)
+    if row["status"] == "failed":
+        raise HTTPException(status_code=409, detail=f"Job failed: {row['error']}")
+    if row["status"] != "done":
+        raise HTTPException(status_code=409, detail=f"Job is {row['status']} ({row['progress']:.0%})")
+    return Response(content=row["result"], media_type="application/json")
+
+@app.post("/similar")
+async def find_similar(request: Request, file: UploadFile = File(...), model_name: str = "effnet",
+                       k: int = EMBEDDING_CONFIG["default_k"], probe: int = EMBEDDING_CONFIG["index_probe"],
+                       threshold: float = 0.5):
+    """Previously analyzed uploads most similar to this one, by cosine similarity of the model's embeddings.
+
+    The upload goes through the model as usual (and is stored itself if the model captures
+    embeddings), then the k nearest stored embeddings of the same model version are returned,
+    best first, with the verdicts they got. probe > 0 searches that many lists of the IVF index
+    when one has been built (POST /admin/embeddings/{model}/index); probe=0 scans every vector.
+    """
+    if use_remote_models:
+        raise HTTPException(status_code=501, detail="Models are served by the remote model server")
+    model_name = "vgg" if model_name == "vgg16" else model_name
+    if model_name not in ("cnn", "effnet", "vgg"):
+        raise HTTPException(status_code=400, detail="Invalid model name. Use cnn, effnet, vgg, or vgg16")
+    if not 1 <= k <= EMBEDDING_CONFIG["max_k"]:
+        raise HTTPException(status_code=400, detail=f"k must be between 1 and {EMBEDDING_CONFIG['max_k']}")
+    if probe < 0:
+        raise HTTPException(status_code=400, detail="probe must be >= 0")
+    if not 0.1 <= threshold <= 0.9:
+        raise HTTPException(status_code=400, detail="Threshold must be between 0.1 and 0.9")
+    if model_name not in models:
+        raise HTTPException(status_code=503, detail=f"Model {model_name} is not loaded")
+
+    with stage("upload"):
+        upload = await read_upload(file)
+
+    async def admitted_search():
+        ticket = await admission.admit([model_name], upload_cost(upload.width, upload.height),
+                                       request_lane(request.headers))
+        async with ticket:
+            with ModelLease([model_name]) as lease:
+                return await run_in_threadpool(similar_local, model_name, lease.models[model_name], upload, k,
+                                               probe, threshold)
+
+    try:
+        return await cancel_on_disconnect(request, admitted_search())
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+def similar_local(name, model_obj, upload, k, probe, threshold):
+    """Embedding of the upload and its nearest stored neighbours; runs in a worker thread once admitted"""
+    img_array = preprocess_image(upload.contents)
+    features = {}
+    prediction = run_model(name, img_array, model_obj, features)
+    predicted_class, probabilities, fake_confidence = interpret_prediction(prediction, threshold)
+    version = model_version(model_obj)
+    with stage("search"):
+        # The upload itself is in the store if it was analyzed before; it isn't its own neighbour
+        matches, method = search_embeddings(name, version, features[name], k, probe, exclude=[upload.sha256])
+    if capturing(name):
+        capture_embedding(name, model_obj, features, upload.sha256, predicted_class, fake_confidence)
+    return {
+        "model": name,
+        "model_version": version,
+        "predicted_class": predicted_class,
+        "probability": fake_confidence,
+        "search": method,
+        "matches": matches[0]
+    }
+
 @app.get("/")
 def root():
     return {"message": "Backend is running. Use /predict/cnn, /predict/effnet, /predict/vgg, or /predict/vgg16"}
 
+@app.get("/metrics")
+def metrics_endpoint():
+    return Response(content=render_metrics(), media_type=METRICS_CONTENT_TYPE)
+
+@app.post("/admin/profile", dependencies=[Depends(require_admin)])
+def start_profile(requests: int = 0, seconds: float = 0):
+    """Profile the next `requests` requests and/or `seconds` seconds, whichever ends first"""
+    if requests < 0 or seconds < 0:
+        raise HTTPException(status_code=400, detail="requests and seconds must be non-negative")
+    started = start_profiling(requests=requests, seconds=seconds)
+    if started is None:
+        raise HTTPException(status_code=409, detail="A profiling session is already running")
+    return started
+
+@app.get("/admin/profile", dependencies=[Depends(require_admin)])
+def get_profile():
+    """Status of the running session, or the summary of the last one"""
+    return profiling_status()
+
+@app.delete("/admin/profile", dependencies=[Depends(require_admin)])
+def end_profile():
+    """Stop the running session early"""
+    return stop_profiling(reason="stopped by admin") or {"status": "idle"}
+
+@app.get("/admin/models", dependencies=[Depends(require_admin)])
+def list_model_versions():
+    """Registered model versions and the state of each model's latest reload"""
+    return {name: {"version": model_versions.get(name), "stub": is_stub(model), "reload": reloads.get(name),
+                   "replicas": len(replicas_of(model)),
+                   "replica_load": model.status() if isinstance(model, ReplicaPool) else None,
+                   "workers": [replica.worker_status() for replica in replicas_of(model)
+                               if hasattr(replica, "worker_status")] or None}
+            for name, model in models.items()}
+
+@app.post("/admin/models/{model_name}/reload", dependencies=[Depends(require_admin)], status_code=202)
+def reload_model_version(model_name: str, path: str = ""):
+    """Load `path` (relative to backend/models, default: the configured file) as the new version of a model.
+
+    The new version is loaded and warmed up in the background while the current one
+    keeps serving, then swapped in; requests already running finish on the old version.
+    Poll GET /admin/models for progress.
+    """
+    if use_remote_models:
+        raise HTTPException(status_code=501, detail="Models are served by the remote model server")
+    model_name = "vgg" if model_name == "vgg16" else model_name
+    if model_name not in ("cnn", "effnet", "vgg"):
+        raise HTTPException(status_code=400, detail="Invalid model name. Use cnn, effnet, vgg, or vgg16")
+    try:
+        status = start_reload(model_name, path or None)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if status is None:
+        raise HTTPException(status_code=409, detail=f"A reload of {model_name} is already in progress")
+    return status
+
+@app.get("/admin/embeddings", dependencies=[Depends(require_admin)])
+def list_embedding_stores():
+    """Embedding stores (per model version) with their size and index, and recent index builds"""
+    return {"stores": store_status(), "index_builds": index_builds()}
+
+@app.post("/admin/embeddings/{model_name}/index", dependencies=[Depends(require_admin)], status_code=202)
+def build_embedding_index(model_name: str):
+    """(Re)build the IVF index of the current version's embedding store in the background"""
+    if use_remote_models:
+        raise HTTPException(status_code=501, detail="Models are served by the remote model server")
+    model_name = "vgg" if model_name == "vgg16" else model_name
+    if model_name not in models:
+        raise HTTPException(status_code=400, detail=f"Model {model_name} is not loaded")
+    status = start_index_build(model_name, model_versions[model_name])
+    if status is None:
+        raise HTTPException(status_code=409, detail=f"An index build for {model_name} is already running")
+    return status
+
 @app.get("/health")
 def health_check():
     loaded_models = list(models.keys())
     return {
         "status": "ok",
         "loaded_models": loaded_models,
-        "available_models": ["cnn", "effnet", "vgg", "vgg16"]
+        "available_models": ["cnn", "effnet", "vgg", "vgg16"],
+        "model_versions": dict(model_versions),
+        "admission": admission.status()
     }
 
 if __name__ == "__main__":
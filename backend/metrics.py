@@ -0,0 +1,226 @@
+"""
+Minimal Prometheus-format metrics for the backend and model server.
+
+Counters, gauges and histograms are plain in-process objects guarded by a lock;
+an observation is a dict lookup plus a bisect, cheap enough to leave on in
+production. render_metrics() produces the text exposition format served at /metrics.
+"""
+import bisect
+import os
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_registry = []
+
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        super().__init__(name, documentation, labelnames)
+        # Optional callable returning the current value, evaluated at scrape time
+        self.callback = callback
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def render(self):
+        if self.callback is not None:
+            value = self.callback()
+            if value is not None:
+                self.set(value)
+        return super().render()
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # per-bucket (non-cumulative) counts + one overflow slot, then sum
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def time(self, **labels):
+        """Context manager observing the elapsed wall time of its block"""
+        return _Timer(self, labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = [(key, list(state[0]), state[1]) for key, state in self._values.items()]
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, ('le', bound))} {cumulative}")
+            cumulative += counts[-1]
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, ('le', '+Inf'))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+        return False
+
+
+def process_rss_bytes():
+    """Resident set size of this process"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except Exception:
+        try:
+            import resource
+            # ru_maxrss is peak, not current, RSS (KiB on Linux) - the best we have off /proc
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        except Exception:
+            return None
+
+
+def _dropped_log_records():
+    import logging_utils
+    return logging_utils.dropped_records
+
+
+REQUEST_LATENCY = Histogram(
+    "authnet_http_request_duration_seconds", "HTTP request latency by route and model",
+    ("route", "model", "method", "status")
+)
+REQUESTS_IN_FLIGHT = Gauge("authnet_http_requests_in_flight", "HTTP requests currently being handled")
+INFERENCE_LATENCY = Histogram("authnet_inference_seconds", "Model forward pass time", ("model",))
+GRADCAM_LATENCY = Histogram("authnet_gradcam_seconds", "GradCAM computation time", ("model",))
+HEATMAP_ENCODE_LATENCY = Histogram("authnet_heatmap_encode_seconds", "Heatmap rendering and encoding time",
+                                   ("model", "format"))
+MODEL_QUEUE_DEPTH = Gauge("authnet_model_queue_depth", "Requests waiting for or running on a model", ("model",))
+ADMISSION_QUEUE_DEPTH = Gauge("authnet_admission_queue_depth", "Admitted requests waiting for a model slot",
+                              ("model", "lane"))
+ADMISSION_ADMITTED = Gauge("authnet_admission_admitted_megapixels", "Admitted (queued + running) work per model",
+                           ("model", "lane"))
+ADMISSION_REJECTIONS = Counter("authnet_admission_rejections_total", "Requests rejected with 429 because a model queue was full",
+                               ("model", "lane"))
+DEADLINE_SKIPS = Counter("authnet_deadline_skips_total", "Stages skipped or requests dropped for their deadline",
+                         ("stage", "reason"))
+EMBEDDING_WRITES = Counter("authnet_embedding_writes_total", "Captured embeddings by outcome", ("model", "result"))
+SIMILARITY_SEARCH_LATENCY = Histogram("authnet_similarity_search_seconds", "Embedding top-k search time",
+                                      ("model", "index"))
+REPLICA_IN_FLIGHT = Gauge("authnet_replica_in_flight", "Calls running on each model replica", ("model", "replica"))
+INFERENCE_WORKER_RESTARTS = Counter("authnet_inference_worker_restarts_total",
+                                    "Inference worker processes restarted after exiting", ("model",))
+INFERENCE_WORKER_PIPE_TRANSFERS = Counter("authnet_inference_worker_pipe_transfers_total",
+                                          "Arrays too large for a shared-memory slot, sent through the pipe", ("model",))
+CACHE_REQUESTS = Counter("authnet_cache_requests_total", "Cache lookups by cache and result", ("cache", "result"))
+REMOTE_ERRORS = Counter("authnet_remote_errors_total", "Failed calls to the remote model server", ("endpoint", "kind"))
+TF_RETRACES = Counter("authnet_tf_function_traces_total", "tf.function (re)traces by function", ("function",))
+PROCESS_RSS = Gauge("authnet_process_resident_memory_bytes", "Resident memory of the process", callback=process_rss_bytes)
+LOG_RECORDS_DROPPED = Gauge("authnet_log_records_dropped", "Log records dropped because the log queue was full",
+                            callback=_dropped_log_records)
+
+
+def record_trace(function_name):
+    """Call from the Python body of a tf.function - it only runs when TF (re)traces"""
+    TF_RETRACES.inc(function=function_name)
+
+
+async def track_requests(request, call_next):
+    """HTTP middleware recording in-flight requests and latency per route and model"""
+    REQUESTS_IN_FLIGHT.inc()
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        REQUESTS_IN_FLIGHT.dec()
+        route = request.scope.get("route")
+        REQUEST_LATENCY.observe(
+            time.perf_counter() - started,
+            route=route.path if route is not None else "unmatched",
+            model=request.scope.get("path_params", {}).get("model_name", ""),
+            method=request.method,
+            status=status
+        )
+
+
+def render_metrics():
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+"""
+Component micro-benchmarks with a stored baseline and a regression gate.
+
+Times the hot functions of the serving path in isolation (preprocessing, decode,
+Grad-CAM, heatmap encoding, majority_pipeline and each model's forward pass at
+several batch sizes) and compares the median of each against
+benchmark_baseline.json. Any benchmark slower than the baseline by more than
+--max-slowdown fails the run with exit code 1.
+
+Benchmarks that need TensorFlow or model files are reported as skipped when those
+are unavailable, so the CPU-only components can be gated on any machine. Timings
+are hardware-specific: record the baseline on the machine that runs the gate.
+
+Examples:
+    python micro_benchmarks.py                      # compare against the baseline
+    python micro_benchmarks.py --max-slowdown 1.25  # stricter gate
+    python micro_benchmarks.py --update-baseline    # record new baseline numbers
+    python micro_benchmarks.py --only heatmap       # subset by name
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import re
+import statistics
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE = os.path.join(BASE_DIR, "benchmark_baseline.json")
+BATCH_SIZES = (1, 4, 16)
+
+
+class Skip(Exception):
+    """Raised by a benchmark setup when its requirements aren't available"""
+
+
+def _jpeg_bytes(width, height, seed=0):
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    img = np.stack([127 + 100 * np.sin(x / 97.0), 127 + 100 * np.cos(y / 61.0), 127 + 100 * np.sin((x + y) / 131.0)], -1)
+    img += rng.normal(0, 6, img.shape)
+    buffer = io.BytesIO()
+    Image.fromarray(np.clip(img, 0, 255).astype(np.uint8)).save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def _require_tf():
+    try:
+        import tensorflow  # noqa: F401
+    except Exception:
+        raise Skip("TensorFlow not installed")
+
+
+def _loaded_models():
+    """The backend's models dict, loaded in-process the same way the server does without inference workers"""
+    _require_tf()
+    import main
+    main.load_models()
+    real = {name: model for name, model in main.models.items() if not main.is_stub(model)}
+    if not real:
+        raise Skip("no real models loaded")
+    return main, real
+
+
+def build_benchmarks():
+    """Return {name: setup} where setup() returns the zero-argument callable to time"""
+    benchmarks = {}
+
+    for label, (width, height) in {"224": (224, 224), "1920x1080": (1920, 1080), "4032x3024": (4032, 3024)}.items():
+        def preprocess_setup(width=width, height=height):
+            from utilities import preprocess_image
+            data = _jpeg_bytes(width, height)
+            return lambda: preprocess_image(data)
+
+        def to_image_array_setup(width=width, height=height):
+            from utilities import toImageArray
+            data = _jpeg_bytes(width, height)
+            return lambda: toImageArray(io.BytesIO(data))
+
+        def to_image_array_bounded_setup(width=width, height=height):
+            from config import HEATMAP_CONFIG
+            from utilities import toImageArray
+            data = _jpeg_bytes(width, height)
+            return lambda: toImageArray(io.BytesIO(data), max_edge=HEATMAP_CONFIG["max_edge"])
+
+        benchmarks[f"preprocess_image/{label}"] = preprocess_setup
+        benchmarks[f"toImageArray/{label}"] = to_image_array_setup
+        benchmarks[f"toImageArray_bounded/{label}"] = to_image_array_bounded_setup
+
+    for heatmap_format in ("jpeg", "png", "webp", "grid_float16", "grid_uint8"):
+        def encode_setup(heatmap_format=heatmap_format):
+            from config import HEATMAP_CONFIG
+            from utilities import encode_heatmap, toImageArray
+            img = toImageArray(io.BytesIO(_jpeg_bytes(1920, 1080)), max_edge=HEATMAP_CONFIG["max_edge"])
+            grid = np.random.default_rng(0).random((14, 14)).astype(np.float32)
+            return lambda: encode_heatmap(grid, img, heatmap_format=heatmap_format, max_edge=HEATMAP_CONFIG["max_edge"])
+        benchmarks[f"heatmap_encode/{heatmap_format}"] = encode_setup
+
+    for name in ("cnn", "effnet", "vgg"):
+        for batch_size in BATCH_SIZES:
+            def forward_setup(name=name, batch_size=batch_size):
+                _, models = _loaded_models()
+                if name not in models:
+                    raise Skip(f"{name} not loaded")
+                x = np.random.default_rng(0).random((batch_size, 224, 224, 3), dtype=np.float32)
+                return lambda: models[name].predict(x)
+            benchmarks[f"forward/{name}/batch{batch_size}"] = forward_setup
+
+        def gradcam_setup(name=name):
+            main, models = _loaded_models()
+            if name not in models:
+                raise Skip(f"{name} not loaded")
+            img = main.toImageArray(io.BytesIO(_jpeg_bytes(1920, 1080)), max_edge=512)
+            return lambda: main.compute_gradcam_heatmap(models[name], img, model_type=name)
+        benchmarks[f"gradcam/{name}"] = gradcam_setup
+
+        def gradcam_batch_setup(name=name):
+            _, models = _loaded_models()
+            if name not in models:
+                raise Skip(f"{name} not loaded")
+            from gradcam import compute_gradcam_batch
+            images = np.random.default_rng(0).integers(0, 256, (16, 224, 224, 3), dtype=np.uint8)
+            return lambda: compute_gradcam_batch(models[name], images, model_type=name)
+        benchmarks[f"gradcam_batch/{name}/batch16"] = gradcam_batch_setup
+
+    def majority_setup():
+        _require_tf()
+        from model_registry import get_keras_model
+        from utilities import majority_pipeline
+        for name in ("cnn", "effnet", "vgg"):
+            if get_keras_model(name) is None:
+                raise Skip(f"{name} not loaded")
+        img = np.random.default_rng(0).random((224, 224, 3), dtype=np.float32)
+        return lambda: majority_pipeline(img)
+    benchmarks["majority_pipeline"] = majority_setup
+
+    def majority_batch_setup():
+        majority_setup()
+        from utilities import majority_pipeline_batch
+        images = np.random.default_rng(0).random((64, 224, 224, 3), dtype=np.float32)
+        return lambda: majority_pipeline_batch(images)
+    benchmarks["majority_pipeline_batch/64"] = majority_batch_setup
+
+    return benchmarks
+
+
+def measure(fn, repeats, warmup, min_time):
+    """Run fn warmup times, then at least `repeats` times and `min_time` seconds; returns per-call seconds"""
+    for _ in range(warmup):
+        fn()
+    samples = []
+    started = time.perf_counter()
+    while len(samples) < repeats or (time.perf_counter() - started) < min_time:
+        t0 = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - t0)
+        if len(samples) >= repeats * 20:
+            break
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description="AuthNet component micro-benchmarks")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--update-baseline", action="store_true", help="Write the results as the new baseline")
+    parser.add_argument("--max-slowdown", type=float, default=1.5,
+                        help="Fail if a median exceeds baseline median by this factor")
+    parser.add_argument("--min-delta-ms", type=float, default=0.05,
+                        help="Ignore slowdowns smaller than this many milliseconds (timer noise)")
+    parser.add_argument("--only", default=None, help="Regex selecting benchmark names")
+    parser.add_argument("--repeats", type=int, default=15)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--min-time", type=float, default=0.5, help="Minimum seconds spent timing each benchmark")
+    parser.add_argument("--output", default=None, help="Also write this run's results as JSON")
+    args = parser.parse_args()
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f).get("benchmarks", {})
+
+    results = {}
+    regressions = []
+    for name, setup in build_benchmarks().items():
+        if args.only and not re.search(args.only, name):
+            continue
+        try:
+            fn = setup()
+        except Skip as reason:
+            print(f"{name:40s} skipped ({reason})", file=sys.stderr)
+            continue
+        samples = measure(fn, args.repeats, args.warmup, args.min_time)
+        median = statistics.median(samples)
+        results[name] = {
+            "median_s": median,
+            "p90_s": sorted(samples)[int(0.9 * (len(samples) - 1))],
+            "samples": len(samples)
+        }
+
+        line = f"{name:40s} {median * 1000:10.3f} ms"
+        reference = baseline.get(name)
+        if reference and not args.update_baseline:
+            ratio = median / reference["median_s"]
+            results[name]["baseline_ratio"] = ratio
+            line += f"  x{ratio:.2f} vs baseline"
+            if ratio > args.max_slowdown and (median - reference["median_s"]) * 1000 > args.min_delta_ms:
+                regressions.append((name, ratio))
+                line += "  REGRESSION"
+        print(line, file=sys.stderr)
+
+    report = {
+        "host": {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()},
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "benchmarks": results
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.update_baseline:
+        # Keep entries for benchmarks not run here (e.g. TensorFlow ones recorded on another box)
+        merged = dict(baseline)
+        merged.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(dict(report, benchmarks=merged), f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Baseline written to {args.baseline} ({len(results)} benchmarks)", file=sys.stderr)
+        return 0
+
+    if regressions:
+        print(f"{len(regressions)} benchmark(s) slower than {args.max_slowdown}x baseline:", file=sys.stderr)
+        for name, ratio in regressions:
+            print(f"  {name}: x{ratio:.2f}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
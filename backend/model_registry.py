@@ -0,0 +1,632 @@
+"""
+Process-wide model registry.
+
+Models are loaded once per process and shared by the API (main.py), the utilities
+Grad-CAM/majority_pipeline helpers and offline tools. The Grad-CAM target layer of
+each model is resolved at load time and kept alongside it.
+
+With load_models(isolated=True) each replica is loaded in its own worker process
+instead and the registry holds inference_workers.WorkerReplica stand-ins.
+
+Every registered model carries a version (a hash of its file). reload_model()
+replaces a model without a restart: the new file is loaded and warmed up in the
+background, swapped into the registry in one assignment, and the old version is
+dropped once the requests holding a ModelLease on it have finished.
+"""
+import contextlib
+import hashlib
+import math
+import os
+import random
+import threading
+import time
+import numpy as np
+from config import MODEL_CONFIG, ADMIN_CONFIG, PREPROCESSING_CONFIG, STUB_CONFIG, REPLICA_CONFIG
+from logging_utils import get_logger
+from metrics import REPLICA_IN_FLIGHT
+
+try:
+    # TensorFlow is optional for development. Without it the registry holds stubs so the API can run.
+    from tensorflow.keras.models import load_model
+    TF_AVAILABLE = True
+except Exception:
+    load_model = None
+    TF_AVAILABLE = False
+
+logger = get_logger("authnet.models")
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Layers the models were trained and validated with for Grad-CAM; used when present,
+# otherwise the last convolutional layer is picked (see find_last_conv_layer)
+PREFERRED_GRADCAM_LAYERS = {"cnn": "conv2d_47", "effnet": "top_conv", "vgg": "top_conv"}
+
+# name -> model (a _ModelWrapper, or a _StubModel when a model could not be loaded)
+models = {}
+
+# name -> Grad-CAM conv layer name (None for stubs or models without conv layers)
+gradcam_layers = {}
+
+# name -> version of the registered model ("stub" for stubs)
+model_versions = {}
+
+# name -> status of the latest reload
+reloads = {}
+_reload_lock = threading.Lock()
+
+# model object -> number of requests holding a lease on it (the object itself is the key: an id()
+# could be reused by a new model once the old one is freed)
+_leases = {}
+_lease_cond = threading.Condition()
+# Replaced models that were still leased when their reload stopped waiting; dropped by the last release
+_retired = set()
+
+_load_lock = threading.Lock()
+_loaded = False
+# Whether the models run in inference worker processes (load_models(isolated=True))
+_isolated = False
+
+
+STUB_LATENCIES = ("none", "constant", "uniform", "normal", "lognormal", "exponential")
+
+
+class StubModelError(RuntimeError):
+    """A failure injected by a stub model (STUB_CONFIG["error_rate"])"""
+
+
+# Provide simple stub model to allow the API to operate in environments without TF installed.
+# STUB_CONFIG can make it behave like a real model under load: latency, batch cost, errors, memory.
+class _StubModel:
+    stub = True
+
+    def __init__(self, name=None, settings=None):
+        self.name = name
+        merged = {key: value for key, value in STUB_CONFIG.items() if key != "models"}
+        merged.update(STUB_CONFIG["models"].get(name, {}))
+        merged.update(settings or {})
+        if merged["latency"] not in STUB_LATENCIES:
+            raise ValueError(f"Unknown stub latency distribution: {merged['latency']}")
+        self.settings = merged
+        self._rng = random.Random(merged["seed"])
+        self._rng_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(merged["concurrency"]) if merged["concurrency"] else None
+        # Simulated weights, touched so they are actually resident
+        self._weights = np.ones(merged["resident_bytes"], dtype=np.uint8) if merged["resident_bytes"] else None
+
+    def _draw(self):
+        """(latency in seconds before the batch cost, whether this call fails)"""
+        settings = self.settings
+        base, spread = settings["latency_seconds"], settings["latency_spread"]
+        with self._rng_lock:
+            latency = settings["latency"]
+            if latency == "constant":
+                seconds = base
+            elif latency == "uniform":
+                seconds = self._rng.uniform(base - spread, base + spread)
+            elif latency == "normal":
+                seconds = self._rng.gauss(base, spread)
+            elif latency == "lognormal":
+                seconds = base * math.exp(self._rng.gauss(0.0, spread))
+            elif latency == "exponential":
+                seconds = self._rng.expovariate(1.0 / base) if base > 0 else 0.0
+            else:
+                seconds = 0.0
+            failed = settings["error_rate"] > 0 and self._rng.random() < settings["error_rate"]
+        return max(0.0, seconds), failed
+
+    def predict(self, x):
+        if self._slots is None:
+            return self._predict(x)
+        with self._slots:
+            return self._predict(x)
+
+    def _predict(self, x):
+        seconds, failed = self._draw()
+        seconds += self.settings["per_item_seconds"] * len(x)
+        # Activations live for the duration of the call
+        activations = (np.ones(self.settings["memory_per_item_bytes"] * len(x), dtype=np.uint8)
+                       if self.settings["memory_per_item_bytes"] else None)
+        if seconds > 0:
+            # Sleeping releases the GIL, as a TensorFlow forward pass does
+            time.sleep(seconds)
+        del activations
+        if failed:
+            raise StubModelError(f"Simulated failure of stub model {self.name or ''}".strip())
+        # return a deterministic 2-class softmax-like vector per input row
+        return np.tile(np.array([[0.8, 0.2]]), (len(x), 1))
+
+    def predict_with_features(self, x):
+        """predict() plus stand-in embeddings: each image average-pooled to an 8x8 RGB grid, centered on mid-gray"""
+        x = np.asarray(x, dtype=np.float32)
+        n, height, width = x.shape[:3]
+        cropped = x[:, :height // 8 * 8, :width // 8 * 8, :]
+        pooled = cropped.reshape(n, 8, height // 8, 8, width // 8, x.shape[-1]).mean(axis=(2, 4))
+        return self.predict(x), pooled.reshape(n, -1) - 0.5
+
+# Model wrapper to handle input shape conversion - now focuses on 3-channel RGB
+class _ModelWrapper:
+    def __init__(self, model, expects_grayscale=False):
+        self.model = model
+        self.expects_grayscale = expects_grayscale
+
+    def predict(self, x):
+        # Ensure input is 3-channel RGB for all our fixed models
+        if len(x.shape) == 4 and x.shape[-1] == 3:
+            # Input is already 3-channel, proceed normally
+            return self.model.predict(x)
+        elif len(x.shape) == 4 and x.shape[-1] == 1:
+            # Convert single channel to 3-channel
+            x_rgb = np.repeat(x, 3, axis=-1)
+            return self.model.predict(x_rgb)
+        else:
+            # Fallback - should not happen with our preprocessing
+            logger.warning("Unexpected input shape %s", x.shape)
+            return self.model.predict(x)
+
+class ReplicaPool:
+    """
+    Interchangeable copies of one model. Each call goes to the replica with the fewest
+    calls in flight (ties rotate), so concurrent requests run on separate copies.
+    Replicas reporting ready=False (inference workers being restarted) are passed over.
+    """
+
+    def __init__(self, name, replicas):
+        self.name = name
+        self.replicas = list(replicas)
+        self.in_flight = [0] * len(self.replicas)
+        self.served = [0] * len(self.replicas)
+        self._next = 0
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def replica(self):
+        """Hold the least busy replica for the duration of the block"""
+        count = len(self.replicas)
+        with self._lock:
+            # Replicas that are down (a restarting inference worker) only get calls if all are
+            index = min(range(count), key=lambda i: (not getattr(self.replicas[i], "ready", True), self.in_flight[i],
+                                                     (i - self._next) % count))
+            self._next = (index + 1) % count
+            self.in_flight[index] += 1
+            self.served[index] += 1
+            REPLICA_IN_FLIGHT.set(self.in_flight[index], model=self.name, replica=index)
+        try:
+            yield self.replicas[index]
+        finally:
+            with self._lock:
+                self.in_flight[index] -= 1
+                REPLICA_IN_FLIGHT.set(self.in_flight[index], model=self.name, replica=index)
+
+    def predict(self, x):
+        with self.replica() as replica:
+            return replica.predict(x)
+
+    def status(self):
+        with self._lock:
+            return [{"in_flight": in_flight, "served": served} for in_flight, served in zip(self.in_flight, self.served)]
+
+
+def replicas_of(model):
+    """The copies behind a registry entry (just the model itself unless it is a ReplicaPool)"""
+    return model.replicas if isinstance(model, ReplicaPool) else [model]
+
+
+@contextlib.contextmanager
+def replica_of(model):
+    """The least busy replica of a pool, held for the block, or the model itself"""
+    if isinstance(model, ReplicaPool):
+        with model.replica() as replica:
+            yield replica
+    else:
+        yield model
+
+
+def is_stub(model):
+    return getattr(replicas_of(model)[0], "stub", False)
+
+
+def replica_count(name):
+    return max(1, int(REPLICA_CONFIG["replicas"].get(name, 1)))
+
+
+def load_replicas(name, load):
+    """Registry entry for `name`: load() called once per configured replica, pooled if there are several; None if loading fails"""
+    replicas = []
+    for _ in range(replica_count(name)):
+        model = load()
+        if model is None:
+            break
+        replicas.append(model)
+    if not replicas:
+        return None
+    if len(replicas) < replica_count(name):
+        logger.warning("Loaded %d of %d replicas of %s", len(replicas), replica_count(name), name)
+    return replicas[0] if len(replicas) == 1 else ReplicaPool(name, replicas)
+
+
+def configure_threads():
+    """
+    Size TensorFlow's thread pools for the replicas. The pools are per process: every replica of
+    the busiest model can run a call at once (inter-op) and their ops share threads_per_replica
+    threads each (intra-op). Must run before TensorFlow executes anything.
+    """
+    replicas = max(replica_count(name) for name in MODEL_CONFIG["local"])
+    if replicas == 1 and REPLICA_CONFIG["threads_per_replica"] is None:
+        return
+    threads = REPLICA_CONFIG["threads_per_replica"] or max(1, (os.cpu_count() or 1) // replicas)
+    try:
+        import tensorflow as tf
+        tf.config.threading.set_inter_op_parallelism_threads(replicas)
+        tf.config.threading.set_intra_op_parallelism_threads(threads * replicas)
+        logger.info("TensorFlow thread pools sized for replicas",
+                    extra={"replicas": replicas, "threads_per_replica": threads})
+    except RuntimeError as e:
+        logger.warning("Could not size TensorFlow thread pools (already initialized): %s", e)
+
+# Function to safely load models with better error handling
+def safe_load_model(model_path, model_name):
+    """
+    Safely load a model with comprehensive error handling
+    """
+    try:
+        logger.info("Attempting to load %s model", model_name)
+
+        # First check if file exists and is readable
+        if not os.path.exists(model_path):
+            logger.error("Model file not found: %s", model_path)
+            return None
+
+        # Check file size
+        file_size = os.path.getsize(model_path)
+        if file_size == 0:
+            logger.error("Model file is empty: %s", model_path)
+            return None
+        logger.info("Model file size", extra={"model": model_name, "size_mb": round(file_size / (1024*1024), 1)})
+
+        # Try to load the model
+        model = load_model(model_path, compile=False)
+        logger.info("%s model loaded successfully", model_name)
+        return model
+
+    except Exception as e:
+        error_msg = str(e)
+        if "input shape" in error_msg.lower():
+            logger.warning("%s has input shape incompatibility: %s", model_name, error_msg)
+        elif "layer" in error_msg.lower():
+            logger.warning("%s has layer compatibility issues: %s", model_name, error_msg)
+        else:
+            logger.error("%s failed to load: %s", model_name, error_msg)
+
+        logger.warning("Using stub model for %s to maintain API functionality", model_name)
+        return None
+
+def find_last_conv_layer(keras_model, model_type="cnn"):
+    """Name of the last convolutional layer to use for GradCAM, or None"""
+    conv_layers = []
+    # Model-specific layer name mapping
+    if model_type == "cnn":
+        # For CNN, use conv2d layers
+        for layer in keras_model.layers:
+            if 'conv2d' in layer.name.lower():
+                conv_layers.append(layer.name)
+    elif model_type in ("vgg", "effnet"):
+        # For VGG block convs / EfficientNet expansion or top conv layers
+        for layer in keras_model.layers:
+            if 'conv' in layer.name.lower():
+                conv_layers.append(layer.name)
+    else:
+        # Generic approach
+        for layer in keras_model.layers:
+            if any(layer_type in layer.__class__.__name__.lower() for layer_type in ['conv2d', 'conv', 'convolution']):
+                conv_layers.append(layer.name)
+    # Use the last conv layer for all models
+    return conv_layers[-1] if conv_layers else None
+
+def resolve_gradcam_layer(keras_model, model_type="cnn"):
+    """The preferred Grad-CAM layer if the model has it, else its last conv layer"""
+    preferred = PREFERRED_GRADCAM_LAYERS.get(model_type)
+    if preferred and any(layer.name == preferred for layer in keras_model.layers):
+        return preferred
+    return find_last_conv_layer(keras_model, model_type)
+
+def file_version(path):
+    """Version label of a model file: the start of its SHA-256"""
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()[:12]
+
+def model_version(model):
+    """Version of a registered model object (None if unknown)"""
+    return getattr(model, "version", None)
+
+def register_model(name, model, version=None):
+    """Add (or replace) a model in the registry and resolve its Grad-CAM layer; returns the entry it replaced"""
+    # Replicas share an architecture, the first one gives the layer
+    keras_model = getattr(replicas_of(model)[0], "model", None)
+    layer = resolve_gradcam_layer(keras_model, name) if keras_model is not None else None
+    model.version = version or ("stub" if is_stub(model) else None)
+    gradcam_layers[name] = layer
+    model_versions[name] = model.version
+    # A single assignment, under the lease lock: requests see either the old or the new model, never a mix,
+    # and a lease taken from here on pins the new one
+    with _lease_cond:
+        previous = models.get(name)
+        models[name] = model
+    if keras_model is not None:
+        logger.info("Using conv layer %s for %s GradCAM", layer, name, extra={"version": model.version})
+    return previous
+
+def load_isolated(names_paths):
+    """
+    Registry entries of models served by inference worker processes, {name: path} -> {name: entry}.
+    Every worker is started before any is waited for, so the models load in parallel.
+    """
+    from inference_workers import WorkerReplica, InferenceWorkerError
+    entries = {name: load_replicas(name, lambda name=name, path=path: WorkerReplica(name, path))
+               for name, path in names_paths.items()}
+    for name, entry in entries.items():
+        for replica in replicas_of(entry):
+            try:
+                replica.wait_ready()
+            except InferenceWorkerError as e:
+                logger.error("%s; requests will wait for it", e)
+    return entries
+
+def load_models(isolated=False):
+    """
+    Load the local models into the registry (once per process), in inference worker
+    processes if `isolated`
+    """
+    global _loaded, _isolated
+    with _load_lock:
+        if _loaded:
+            return models
+        _loaded = True
+
+        if isolated:
+            _isolated = True
+            paths = {name: resolve_model_path(name) for name in ("cnn", "effnet", "vgg")}
+            logger.info("Loading models in inference worker processes", extra={"replicas": {
+                name: replica_count(name) for name in paths}})
+            for name, entry in load_isolated(paths).items():
+                register_model(name, entry, None if is_stub(entry) else file_version(paths[name]))
+            return models
+
+        if not TF_AVAILABLE:
+            logger.warning("TensorFlow not available - using stub models for development")
+            for name in ("cnn", "effnet", "vgg"):
+                register_model(name, load_replicas(name, lambda name=name: _StubModel(name)))
+            return models
+
+        logger.info("Starting model loading process", extra={"cwd": os.getcwd()})
+        configure_threads()
+        try:
+
+            # Get absolute paths to model files
+            cnn_path = os.path.join(BASE_DIR, MODEL_CONFIG["local"]["cnn"])
+            vgg_path = os.path.join(BASE_DIR, MODEL_CONFIG["local"]["vgg"])
+            effnet_path = os.path.join(BASE_DIR, MODEL_CONFIG["local"]["effnet"])
+
+            logger.info("Model paths", extra={"cnn": cnn_path, "vgg": vgg_path, "effnet": effnet_path})
+
+            # Load CNN model
+            if os.path.exists(cnn_path):
+                cnn_model = load_replicas("cnn", lambda: load_local_model("cnn", cnn_path))
+                if cnn_model is not None:
+                    register_model("cnn", cnn_model, file_version(cnn_path))
+                else:
+                    register_model("cnn", _StubModel("cnn"))
+            else:
+                logger.error("CNN model file not found: %s", cnn_path)
+                register_model("cnn", _StubModel("cnn"))
+
+            # Load VGG model using fixed loader
+            vgg_model = load_replicas("vgg", lambda: load_local_model("vgg", vgg_path))
+            if vgg_model is not None:
+                register_model("vgg", vgg_model, file_version(vgg_path))
+            else:
+                register_model("vgg", _StubModel("vgg"))
+
+            # Load EffNet model using fixed loader
+            effnet_model = load_replicas("effnet", lambda: load_local_model("effnet", effnet_path))
+            if effnet_model is not None:
+                register_model("effnet", effnet_model, file_version(effnet_path))
+            else:
+                register_model("effnet", _StubModel("effnet"))
+
+            if not models:
+                logger.warning("No local models loaded - consider using a remote model server or placing model files in the backend/models directory")
+
+            logger.info("Model loading complete", extra={"models": list(models.keys())})
+        except Exception as e:
+            logger.exception("Error loading local models: %s", e)
+            # Continue without models - they might be loaded later or we'll use remote
+        return models
+
+def get_model(name):
+    """Registry entry for `name`, loading the models on first use"""
+    if not _loaded:
+        load_models()
+    return models.get(name)
+
+def get_keras_model(name):
+    """
+    The underlying Keras model for `name` (of its first replica), or None if it is a stub, not loaded
+    or served by inference workers. For offline helpers; API calls go through replica_of for dispatch.
+    """
+    model = get_model(name)
+    return getattr(replicas_of(model)[0], "model", None) if model is not None else None
+
+
+class ModelLease:
+    """
+    Pins the currently registered version of some models for one request, so a
+    reload swapping them meanwhile doesn't change models halfway through it and
+    waits for the request before dropping the old version. release() is idempotent.
+    """
+
+    def __init__(self, names):
+        if not _loaded:
+            load_models()
+        self.models = {}
+        # Looked up and counted in one step: register_model swaps under the same lock, so a reload
+        # either sees this lease or this lease sees the new version, never a dropped one
+        with _lease_cond:
+            for name in names:
+                model = models.get(name)
+                if model is not None:
+                    self.models[name] = model
+                    _leases[model] = _leases.get(model, 0) + 1
+        self._released = False
+
+    def release(self):
+        drop = []
+        with _lease_cond:
+            if self._released:
+                return
+            self._released = True
+            for model in self.models.values():
+                count = _leases[model] - 1
+                if count:
+                    _leases[model] = count
+                else:
+                    del _leases[model]
+                    if model in _retired:
+                        _retired.discard(model)
+                        drop.append(model)
+            _lease_cond.notify_all()
+        for model in drop:
+            # Stopping workers blocks; release() may run on the event loop
+            threading.Thread(target=_drop_model, args=(model,), name="authnet-model-drop", daemon=True).start()
+
+    def versions(self):
+        return {name: model_version(model) for name, model in self.models.items()}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+def resolve_model_path(name, path=None):
+    """Absolute path of a model file: the configured one, or `path` relative to the models directory"""
+    if not path:
+        return os.path.join(BASE_DIR, MODEL_CONFIG["local"][name])
+    models_dir = os.path.realpath(os.path.join(BASE_DIR, "models"))
+    resolved = os.path.realpath(os.path.join(models_dir, path))
+    if os.path.commonpath([models_dir, resolved]) != models_dir:
+        raise ValueError("Model path must be inside the models directory")
+    return resolved
+
+def load_local_model(name, path):
+    """Load one model file into a registry wrapper; None if it could not be loaded"""
+    if name == "cnn":
+        model = safe_load_model(path, "CNN")
+    else:
+        from fixed_model_loader import load_fixed_model
+        model = load_fixed_model(name, path)
+    return _ModelWrapper(model, expects_grayscale=False) if model is not None else None
+
+def warm_up(name, model):
+    """Run a forward pass (and build the heatmap function) so the first real request doesn't pay for tracing"""
+    size = tuple(PREPROCESSING_CONFIG["image_size"])
+    x = np.zeros((1, size[1], size[0], 3), dtype=np.float32)
+    for replica in replicas_of(model):
+        replica.predict(x)
+        try:
+            from gradcam import resolve_heatmap_mode, get_gradcam_fn
+            if resolve_heatmap_mode(replica, name, "auto") == "gradcam":
+                get_gradcam_fn(replica.model, name)(x)
+        except Exception as e:
+            logger.warning("Heatmap warm-up failed for %s: %s", name, e)
+
+def close_workers(model):
+    """Stop the inference worker processes behind a registry entry (nothing for in-process models)"""
+    for replica in replicas_of(model):
+        if hasattr(replica, "close"):
+            replica.close()
+
+def _drained(model, timeout):
+    """Wait until no request holds a lease on `model`; False if still in use after `timeout` seconds"""
+    with _lease_cond:
+        return _lease_cond.wait_for(lambda: model not in _leases, timeout)
+
+def _drop_model(model):
+    """Release what a replaced model holds: its traced Grad-CAM/feature functions and worker processes"""
+    from gradcam import forget_model
+    from embeddings import forget_model as forget_feature_model
+    for replica in replicas_of(model):
+        forget_model(getattr(replica, "model", replica))
+        forget_feature_model(getattr(replica, "model", replica))
+    close_workers(model)
+
+def retire_model(model, timeout):
+    """
+    Drop a replaced model once no request holds a lease on it. Waits up to `timeout`
+    seconds; if it is still in use then, the last lease released drops it instead.
+    Returns whether it drained in time.
+    """
+    with _lease_cond:
+        drained = _lease_cond.wait_for(lambda: model not in _leases, timeout)
+        if not drained:
+            _retired.add(model)
+    if drained:
+        _drop_model(model)
+    return drained
+
+def reload_model(name, path):
+    """Load, warm up and swap in a new version of `name`, then drain the old one (blocking)"""
+    status = reloads[name]
+    try:
+        if not TF_AVAILABLE:
+            raise RuntimeError("TensorFlow is not available")
+        if not os.path.exists(path):
+            raise RuntimeError(f"Model file not found: {path}")
+        version = file_version(path)
+        if _isolated:
+            # The workers warm up before reporting ready
+            model = load_isolated({name: path})[name]
+            if is_stub(model):
+                close_workers(model)
+                raise RuntimeError(f"Could not load {path}")
+        else:
+            model = load_replicas(name, lambda: load_local_model(name, path))
+            if model is None:
+                raise RuntimeError(f"Could not load {path}")
+            status.update(state="warming", version=version)
+            warm_up(name, model)
+
+        previous = register_model(name, model, version)
+        status["state"] = "draining"
+        logger.info("Swapped in new model version", extra={"model": name, "version": version,
+                                                          "previous": status["previous_version"]})
+        drained = previous is None or retire_model(previous, ADMIN_CONFIG["reload_drain_timeout"])
+        status.update(state="done", drained=drained, finished=time.time())
+        logger.info("Model reload finished", extra={"model": name, "version": version, "drained": drained})
+    except Exception as e:
+        status.update(state="failed", error=str(e), finished=time.time())
+        logger.exception("Model reload failed for %s", name)
+
+def start_reload(name, path=None):
+    """
+    Reload `name` in a background thread. Returns the reload status, or None if a
+    reload of that model is already in progress. Raises ValueError for a bad path.
+    """
+    path = resolve_model_path(name, path)
+    with _reload_lock:
+        current = reloads.get(name)
+        if current is not None and current["state"] not in ("done", "failed"):
+            return None
+        status = reloads[name] = {
+            "model": name,
+            "state": "loading",
+            "path": path,
+            "previous_version": model_versions.get(name),
+            "version": None,
+            "started": time.time()
+        }
+    threading.Thread(target=reload_model, args=(name, path), name=f"authnet-reload-{name}", daemon=True).start()
+    return dict(status)
+
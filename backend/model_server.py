@@ -1,8 +1,9 @@
 # Model Server for AuthNet
 # This script runs a dedicated model server that the main application can connect to
 
-from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi import FastAPI, UploadFile, File, HTTPException, Depends
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response
 from tensorflow.keras.models import load_model
 from tensorflow.keras.preprocessing import image
 import numpy as np
@@ -12,9 +13,21 @@ import uvicorn
 import os
 from original_model_loader import load_original_model_with_fallback
 from config import MODEL_CONFIG
+from uploads import read_upload, UploadSizeLimit
+from logging_utils import get_logger, begin_request
+from metrics import track_requests, render_metrics, METRICS_CONTENT_TYPE, INFERENCE_LATENCY, MODEL_QUEUE_DEPTH
+from timing import stage, server_timing
+from admin import require_admin
+from profiling import profile_requests, start_profiling, stop_profiling, profiling_status
+
+logger = get_logger("authnet.model_server")
 
 app = FastAPI(title="AuthNet Model Server")
 
+# Refuse bodies over the upload limit while they are received, before the multipart parser spools them
+# (innermost middleware, see main.py)
+app.add_middleware(UploadSizeLimit)
+
 # Configure CORS
 app.add_middleware(
     CORSMiddleware,
@@ -24,6 +37,19 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+app.middleware("http")(track_requests)
+app.middleware("http")(server_timing)
+app.middleware("http")(profile_requests)
+
+@app.middleware("http")
+async def request_context(request, call_next):
+    """Attach a request id (and the per-request log sampling decision) to everything logged"""
+    request_id = begin_request(request.headers.get("x-request-id"))
+    response = await call_next(request)
+    response.headers["X-Request-ID"] = request_id
+    return response
+
+
 # Model paths - can be customized by your friend
 MODEL_PATHS = MODEL_CONFIG["local"]
 
@@ -54,20 +80,20 @@ def preprocess_image(file):
 async def startup_event():
     """Load models on startup"""
     try:
-        print("Loading models...")
+        logger.info("Loading models")
         # Only load the working CNN model
         if os.path.exists(MODEL_PATHS["cnn"]):
             models["cnn"] = load_model(MODEL_PATHS["cnn"])
-            print(f"Loaded model: cnn")
+            logger.info("Loaded model: cnn")
             # Use CNN for all model types since other models have loading issues
             models["effnet"] = models["cnn"]
             models["vgg"] = models["cnn"]
-            print("Using CNN model for all predictions (effnet and vgg)")
+            logger.info("Using CNN model for all predictions (effnet and vgg)")
         else:
-            print(f"Warning: CNN model file not found: {MODEL_PATHS['cnn']}")
-        print("Model loading complete")
+            logger.warning("CNN model file not found: %s", MODEL_PATHS["cnn"])
+        logger.info("Model loading complete")
     except Exception as e:
-        print(f"Error loading models: {e}")
+        logger.exception("Error loading models: %s", e)
 
 @app.post("/predict/{model_name}")
 async def predict(model_name: str, file: UploadFile = File(...)):
@@ -78,13 +104,21 @@ async def predict(model_name: str, file: UploadFile = File(...)):
     if model_name not in models:
         raise HTTPException(status_code=503, detail=f"Model {model_name} is not loaded")
     
+    with stage("upload"):
+        upload = await read_upload(file)
     try:
-        contents = await file.read()
-        img_array = preprocess_image(contents)
+        contents = upload.contents
+        with stage("preprocess"):
+            img_array = preprocess_image(contents)
         
         # All models use the same CNN backend
         actual_model = "cnn"
-        prediction = models[actual_model].predict(img_array)
+        MODEL_QUEUE_DEPTH.inc(model=model_name)
+        try:
+            with INFERENCE_LATENCY.time(model=model_name), stage("inference", model=model_name):
+                prediction = models[actual_model].predict(img_array)
+        finally:
+            MODEL_QUEUE_DEPTH.dec(model=model_name)
         predicted_class = int(np.argmax(prediction, axis=1)[0])
         probabilities = prediction.tolist()[0]
         
@@ -97,6 +131,31 @@ async def predict(model_name: str, file: UploadFile = File(...)):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing image: {str(e)}")
 
+@app.get("/metrics")
+def metrics_endpoint():
+    """Prometheus metrics endpoint"""
+    return Response(content=render_metrics(), media_type=METRICS_CONTENT_TYPE)
+
+@app.post("/admin/profile", dependencies=[Depends(require_admin)])
+def start_profile(requests: int = 0, seconds: float = 0):
+    """Profile the next `requests` requests and/or `seconds` seconds, whichever ends first"""
+    if requests < 0 or seconds < 0:
+        raise HTTPException(status_code=400, detail="requests and seconds must be non-negative")
+    started = start_profiling(requests=requests, seconds=seconds)
+    if started is None:
+        raise HTTPException(status_code=409, detail="A profiling session is already running")
+    return started
+
+@app.get("/admin/profile", dependencies=[Depends(require_admin)])
+def get_profile():
+    """Status of the running session, or the summary of the last one"""
+    return profiling_status()
+
+@app.delete("/admin/profile", dependencies=[Depends(require_admin)])
+def end_profile():
+    """Stop the running session early"""
+    return stop_profiling(reason="stopped by admin") or {"status": "idle"}
+
 @app.get("/health")
 def health_check():
     """Health check endpoint"""
@@ -115,6 +174,7 @@ def root():
         "message": "AuthNet Model Server is running",
         "endpoints": {
             "health": "/health",
+            "metrics": "/metrics",
             "predict": "/predict/{model_name}"
         },
         "loaded_models": list(models.keys())
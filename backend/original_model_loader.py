@@ -7,6 +7,9 @@ import numpy as np
 from tensorflow.keras.utils import img_to_array
 from PIL import Image
 import cv2
+from logging_utils import get_logger
+
+logger = get_logger("authnet.loader")
 
 class OriginalModelLoader:
     """Special loader for handling original model quirks"""
@@ -22,30 +25,30 @@ class OriginalModelLoader:
         try:
             # First try direct loading with compile=False to avoid input shape errors during loading
             self.model = tf.keras.models.load_model(self.model_path, compile=False)
-            print(f"✅ {self.model_name} loaded directly (no compile)")
+            logger.info("%s loaded directly (no compile)", self.model_name)
             
             # Check input shape and handle potential mismatches
             if len(self.model.input_shape) == 4:
                 expected_channels = self.model.input_shape[-1]
-                print(f"🔍 {self.model_name} expects {expected_channels} channels")
+                logger.info("%s expects %s channels", self.model_name, expected_channels)
                 
                 if expected_channels == 1:
                     self.requires_special_input = True
-                    print(f"🔧 {self.model_name} expects grayscale input, will convert")
+                    logger.info("%s expects grayscale input, will convert", self.model_name)
                 elif expected_channels == 3:
-                    print(f"✅ {self.model_name} expects RGB input - good")
+                    logger.info("%s expects RGB input - good", self.model_name)
                 else:
-                    print(f"⚠️ {self.model_name} expects {expected_channels} channels - unusual")
+                    logger.warning("%s expects %s channels - unusual", self.model_name, expected_channels)
             
             return True
             
         except Exception as e:
             error_str = str(e).lower()
             if "input shape" in error_str or "stem_conv" in error_str or "expected axis" in error_str:
-                print(f"🔧 {self.model_name} has input shape issue during loading - trying wrapper approach")
+                logger.info("%s has input shape issue during loading - trying wrapper approach", self.model_name)
                 return self._create_input_wrapper()
             else:
-                print(f"❌ {self.model_name} loading failed: {e}")
+                logger.error("%s loading failed: %s", self.model_name, e)
                 return False
     
     def _create_input_wrapper(self):
@@ -53,16 +56,16 @@ class OriginalModelLoader:
         try:
             # The issue is that models fail to load due to input shape mismatches
             # Let's try to bypass this by creating a functional model with correct input
-            print(f"🔧 Attempting to fix input shape for {self.model_name}")
+            logger.info("Attempting to fix input shape for %s", self.model_name)
             
             # Try loading with compile=False first
             try:
                 temp_model = tf.keras.models.load_model(self.model_path, compile=False)
-                print(f"✅ {self.model_name} loaded with compile=False")
+                logger.info("%s loaded with compile=False", self.model_name)
                 
                 # Check if we need to fix the input shape
                 if len(temp_model.input_shape) == 4 and temp_model.input_shape[-1] == 1:
-                    print(f"🔧 {self.model_name} has 1-channel input, creating RGB wrapper")
+                    logger.info("%s has 1-channel input, creating RGB wrapper", self.model_name)
                     
                     # Create a new input layer with 3 channels
                     new_input = tf.keras.layers.Input(shape=(225, 225, 3))
@@ -75,18 +78,18 @@ class OriginalModelLoader:
                     
                     # Create new model
                     self.model = tf.keras.Model(inputs=new_input, outputs=original_output)
-                    print(f"✅ Created RGB wrapper for {self.model_name}")
+                    logger.info("Created RGB wrapper for %s", self.model_name)
                     return True
                 else:
                     self.model = temp_model
                     return True
                     
             except Exception as e:
-                print(f"❌ Even compile=False failed: {e}")
+                logger.error("Even compile=False failed: %s", e)
                 
                 # Try a different approach - load model architecture and weights separately
                 try:
-                    print(f"🔄 Trying alternative loading for {self.model_name}")
+                    logger.info("Trying alternative loading for %s", self.model_name)
                     # For now, use CNN as fallback since it works
                     import os
                     base_dir = os.path.dirname(os.path.abspath(__file__))
@@ -95,15 +98,15 @@ class OriginalModelLoader:
                     if os.path.exists(cnn_path):
                         self.model = tf.keras.models.load_model(cnn_path, compile=False)
                         self.requires_special_input = True
-                        print(f"🔄 Using CNN fallback for {self.model_name}")
+                        logger.info("Using CNN fallback for %s", self.model_name)
                         return True
                 except Exception as e2:
-                    print(f"❌ Fallback also failed: {e2}")
+                    logger.error("Fallback also failed: %s", e2)
                     
                 return False
                 
         except Exception as e:
-            print(f"❌ Could not create wrapper for {self.model_name}: {e}")
+            logger.error("Could not create wrapper for %s: %s", self.model_name, e)
             return False
     
     def predict(self, input_data):
@@ -122,19 +125,19 @@ class OriginalModelLoader:
 def load_original_model_with_fallback(primary_path, fallback_path, model_name):
     """Try to load original model, fallback to extracted weights version"""
     
-    print(f"🎯 Attempting to load ORIGINAL {model_name}")
+    logger.info("Attempting to load ORIGINAL %s", model_name)
     
     # Try a more direct approach first - check if the models are actually working
     try:
         # For VGG and EfficientNet, let's try loading them directly without the complex wrapper
         if model_name in ["VGG", "EffNet"]:
-            print(f"🔄 Trying direct load approach for {model_name}")
+            logger.info("Trying direct load approach for %s", model_name)
             model = tf.keras.models.load_model(primary_path, compile=False)
-            print(f"✅ Direct load successful for {model_name}")
+            logger.info("Direct load successful for %s", model_name)
             return model
             
     except Exception as e:
-        print(f"❌ Direct load failed for {model_name}: {e}")
+        logger.error("Direct load failed for %s: %s", model_name, e)
     
     # Try original model loader approach
     loader = OriginalModelLoader(primary_path, model_name)
@@ -142,13 +145,13 @@ def load_original_model_with_fallback(primary_path, fallback_path, model_name):
         return loader.model
     
     # Fallback to extracted weights version
-    print(f"🔄 Falling back to extracted weights version for {model_name}")
+    logger.info("Falling back to extracted weights version for %s", model_name)
     try:
         fallback_model = tf.keras.models.load_model(fallback_path)
-        print(f"✅ Loaded fallback {model_name} successfully")
+        logger.info("Loaded fallback %s successfully", model_name)
         return fallback_model
     except Exception as e:
-        print(f"❌ Fallback {model_name} also failed: {e}")
+        logger.error("Fallback %s also failed: %s", model_name, e)
         return None
 
 if __name__ == "__main__":
@@ -0,0 +1,231 @@
+"""
+On-demand profiling of a live worker.
+
+An admin starts a session covering the next N requests and/or the next T seconds.
+While it runs, a background thread samples every thread's Python stack and, if
+TensorFlow is available, the TF profiler records op-level activity. When the
+session ends the results are written under ADMIN_CONFIG["profile_dir"] and a
+summary of the hottest Python functions and TF ops is kept for GET requests.
+
+When no session is active the request middleware does a single None check, so
+profiling costs nothing while idle.
+"""
+import collections
+import json
+import os
+import sys
+import threading
+import time
+from config import ADMIN_CONFIG
+from logging_utils import get_logger
+
+try:
+    import tensorflow as tf
+    TF_AVAILABLE = True
+except Exception:
+    tf = None
+    TF_AVAILABLE = False
+
+logger = get_logger("authnet.profiling")
+
+_lock = threading.Lock()
+_session = None
+_last_summary = None
+
+
+class StackSampler(threading.Thread):
+    """Samples the Python stacks of all other threads at a fixed interval"""
+
+    def __init__(self, interval):
+        super().__init__(name="authnet-stack-sampler", daemon=True)
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.stacks = collections.Counter()
+        self.samples = 0
+
+    def run(self):
+        own_id = threading.get_ident()
+        while not self.stop_event.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                self.stacks[tuple(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self):
+        self.stop_event.set()
+        self.join(timeout=5)
+
+    def top_functions(self, limit=25):
+        self_counts = collections.Counter()
+        total_counts = collections.Counter()
+        for stack, count in self.stacks.items():
+            self_counts[stack[-1]] += count
+            for function in set(stack):
+                total_counts[function] += count
+        total = sum(self.stacks.values()) or 1
+        return {
+            "self": [{"function": f, "samples": c, "fraction": round(c / total, 4)} for f, c in self_counts.most_common(limit)],
+            "cumulative": [{"function": f, "samples": c, "fraction": round(c / total, 4)} for f, c in total_counts.most_common(limit)]
+        }
+
+    def write_collapsed(self, path):
+        """Brendan Gregg collapsed-stack format, ready for flamegraph.pl / speedscope"""
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(";".join(stack) + f" {count}\n")
+
+
+def _top_tf_ops(logdir, limit=25):
+    """Aggregate op durations from the TF profiler's XPlane dumps (best effort)"""
+    xplane_pb2 = None
+    for module in ("tsl.profiler.protobuf.xplane_pb2", "tensorflow.tsl.profiler.protobuf.xplane_pb2",
+                   "tensorflow.core.profiler.protobuf.xplane_pb2"):
+        try:
+            xplane_pb2 = __import__(module, fromlist=["XSpace"])
+            break
+        except Exception:
+            continue
+    if xplane_pb2 is None:
+        return None
+
+    durations = collections.Counter()
+    counts = collections.Counter()
+    for root, _, files in os.walk(logdir):
+        for filename in files:
+            if not filename.endswith(".xplane.pb"):
+                continue
+            space = xplane_pb2.XSpace()
+            with open(os.path.join(root, filename), "rb") as f:
+                space.ParseFromString(f.read())
+            for plane in space.planes:
+                for line in plane.lines:
+                    # Python tracer lines are already covered by the stack sampler
+                    if "python" in line.name.lower():
+                        continue
+                    for event in line.events:
+                        name = plane.event_metadata[event.metadata_id].name
+                        durations[name] += event.duration_ps
+                        counts[name] += 1
+    return [
+        {"op": name, "total_ms": round(ps / 1e9, 3), "count": counts[name]}
+        for name, ps in durations.most_common(limit)
+    ]
+
+
+class ProfileSession:
+    def __init__(self, max_requests, max_seconds):
+        self.max_requests = max_requests
+        self.max_seconds = max_seconds
+        self.requests_seen = 0
+        self.started = time.time()
+        self.output_dir = os.path.join(ADMIN_CONFIG["profile_dir"], time.strftime("%Y%m%d-%H%M%S"))
+        self.sampler = StackSampler(ADMIN_CONFIG["sample_interval"])
+        self.tf_logdir = os.path.join(self.output_dir, "tensorflow") if TF_AVAILABLE else None
+        self.timer = None
+
+    def start(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        if self.tf_logdir:
+            try:
+                tf.profiler.experimental.start(self.tf_logdir)
+            except Exception as e:
+                logger.warning("TensorFlow profiler could not start: %s", e)
+                self.tf_logdir = None
+        self.sampler.start()
+        if self.max_seconds:
+            self.timer = threading.Timer(self.max_seconds, stop_profiling, kwargs={"reason": "time limit"})
+            self.timer.daemon = True
+            self.timer.start()
+
+    def finish(self, reason):
+        self.sampler.stop()
+        if self.timer is not None:
+            self.timer.cancel()
+        tf_ops = None
+        if self.tf_logdir:
+            try:
+                tf.profiler.experimental.stop()
+                tf_ops = _top_tf_ops(self.tf_logdir)
+            except Exception as e:
+                logger.warning("TensorFlow profiler could not stop cleanly: %s", e)
+
+        collapsed_path = os.path.join(self.output_dir, "python.collapsed")
+        self.sampler.write_collapsed(collapsed_path)
+        summary = {
+            "status": "finished",
+            "reason": reason,
+            "started": self.started,
+            "duration_s": round(time.time() - self.started, 3),
+            "requests": self.requests_seen,
+            "samples": self.sampler.samples,
+            "output_dir": os.path.abspath(self.output_dir),
+            "python_stacks": os.path.abspath(collapsed_path),
+            "tensorflow_logdir": os.path.abspath(self.tf_logdir) if self.tf_logdir else None,
+            "top_functions": self.sampler.top_functions(),
+            "top_tf_ops": tf_ops
+        }
+        with open(os.path.join(self.output_dir, "summary.json"), "w") as f:
+            json.dump(summary, f, indent=2)
+        return summary
+
+
+def start_profiling(requests=None, seconds=None):
+    """Begin a session for the next `requests` requests and/or `seconds` seconds"""
+    global _session
+    requests = min(requests, ADMIN_CONFIG["max_profile_requests"]) if requests else None
+    seconds = min(seconds, ADMIN_CONFIG["max_profile_seconds"]) if seconds else None
+    if requests is None and seconds is None:
+        seconds = min(30, ADMIN_CONFIG["max_profile_seconds"])
+    with _lock:
+        if _session is not None:
+            return None
+        session = ProfileSession(requests, seconds)
+        session.start()
+        _session = session
+    logger.info("Profiling started", extra={"requests": requests, "seconds": seconds, "output_dir": session.output_dir})
+    return {"status": "running", "requests": requests, "seconds": seconds, "output_dir": os.path.abspath(session.output_dir)}
+
+
+def stop_profiling(reason="stopped"):
+    """End the active session (if any) and return its summary"""
+    global _session, _last_summary
+    with _lock:
+        session, _session = _session, None
+    if session is None:
+        return _last_summary
+    _last_summary = session.finish(reason)
+    logger.info("Profiling finished", extra={"reason": reason, "output_dir": session.output_dir})
+    return _last_summary
+
+
+def profiling_status():
+    session = _session
+    if session is not None:
+        return {
+            "status": "running",
+            "requests": session.requests_seen,
+            "max_requests": session.max_requests,
+            "elapsed_s": round(time.time() - session.started, 3),
+            "max_seconds": session.max_seconds
+        }
+    return _last_summary or {"status": "idle"}
+
+
+async def profile_requests(request, call_next):
+    """HTTP middleware counting requests toward an active session's request limit"""
+    session = _session
+    if session is None or request.url.path.startswith("/admin/"):
+        return await call_next(request)
+    try:
+        return await call_next(request)
+    finally:
+        session.requests_seen += 1
+        if session.max_requests and session.requests_seen >= session.max_requests and session is _session:
+            # Writing the results is blocking work - keep it off the event loop
+            threading.Thread(target=stop_profiling, kwargs={"reason": "request limit"}, daemon=True).start()
@@ -0,0 +1,93 @@
+"""
+Response encoders for prediction payloads.
+
+Heatmaps travel through the endpoints as raw bytes (see utilities.encode_heatmap).
+These helpers turn a payload into JSON with base64 heatmaps, msgpack with binary
+heatmaps, or multipart/mixed with a JSON part followed by one binary part per heatmap.
+"""
+import base64
+import json
+import uuid
+from fastapi.responses import Response
+try:
+    # msgpack is optional - only needed for response_format=msgpack
+    import msgpack
+    MSGPACK_AVAILABLE = True
+except Exception:
+    msgpack = None
+    MSGPACK_AVAILABLE = False
+
+RESPONSE_FORMATS = ("json", "msgpack", "multipart")
+
+
+def _map_heatmaps(payload, fn):
+    """Apply fn(model_name, heatmap) to every heatmap in a single-model (incl. tile map) or ensemble payload"""
+    payload = dict(payload)
+    if "heatmap" in payload:
+        payload["heatmap"] = fn(payload.get("model"), payload["heatmap"])
+    if "models" in payload:
+        payload["models"] = [_map_heatmaps(m, fn) for m in payload["models"]]
+    if payload.get("tiles") and "heatmap" in payload["tiles"]:
+        tiles = dict(payload["tiles"])
+        tiles["heatmap"] = fn(f"{payload.get('model')}-tiles", tiles["heatmap"])
+        payload["tiles"] = tiles
+    return payload
+
+
+def _heatmap_for_json(model_name, heatmap):
+    if heatmap is None:
+        return None
+    if heatmap["format"] == "jpeg":
+        # Legacy shape: a bare base64 JPEG string
+        return base64.b64encode(heatmap["data"]).decode("utf-8")
+    encoded = dict(heatmap)
+    encoded["data"] = base64.b64encode(heatmap["data"]).decode("utf-8")
+    return encoded
+
+
+def _multipart_body(payload, boundary):
+    parts = []
+
+    def detach(model_name, heatmap):
+        if heatmap is None:
+            return None
+        part_id = f"heatmap-{model_name}-{len(parts)}"
+        parts.append((part_id, heatmap["media_type"], heatmap["data"]))
+        ref = {k: v for k, v in heatmap.items() if k != "data"}
+        ref["part"] = part_id
+        return ref
+
+    document = _map_heatmaps(payload, detach)
+    chunks = [
+        f"--{boundary}\r\nContent-Type: application/json\r\nContent-ID: <payload>\r\n\r\n".encode("utf-8"),
+        json.dumps(document).encode("utf-8"),
+        b"\r\n"
+    ]
+    for part_id, media_type, data in parts:
+        chunks.append(f"--{boundary}\r\nContent-Type: {media_type}\r\nContent-ID: <{part_id}>\r\n\r\n".encode("utf-8"))
+        chunks.append(data)
+        chunks.append(b"\r\n")
+    chunks.append(f"--{boundary}--\r\n".encode("utf-8"))
+    return b"".join(chunks)
+
+
+def encode_prediction_response(payload, response_format="json"):
+    """
+    Serialize a prediction payload in the requested response format.
+
+    JSON payloads are returned as plain dicts so FastAPI handles them as before.
+    """
+    if response_format == "json":
+        return _map_heatmaps(payload, _heatmap_for_json)
+    if response_format == "msgpack":
+        if not MSGPACK_AVAILABLE:
+            raise RuntimeError("msgpack is not installed")
+        body = msgpack.packb(payload, use_bin_type=True)
+        return Response(content=body, media_type="application/msgpack")
+    if response_format == "multipart":
+        boundary = uuid.uuid4().hex
+        return Response(
+            content=_multipart_body(payload, boundary),
+            media_type=f"multipart/mixed; boundary={boundary}"
+        )
+    raise ValueError(f"Unknown response format: {response_format}")
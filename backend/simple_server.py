@@ -1,5 +1,30 @@
-from fastapi import FastAPI
+"""
+Stand-in model server for load testing without TensorFlow.
+
+Serves the model server API (/predict/{model_name}, /predict/ensemble, /health)
+with stub models whose latency distribution, per-image cost, error rate and memory
+footprint come from STUB_CONFIG, so the backend's remote path (AUTHNET_REMOTE_SERVER_URL)
+can be exercised end to end on any machine. With the default STUB_CONFIG it answers
+instantly, as before.
+
+    python simple_server.py --port 8001 --latency lognormal --latency-seconds 0.05 \\
+        --latency-spread 0.5 --per-item-seconds 0.002 --error-rate 0.01
+"""
+import argparse
+from fastapi import FastAPI, UploadFile, File, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response
+from starlette.concurrency import run_in_threadpool
+import numpy as np
+from config import STUB_CONFIG, PREPROCESSING_CONFIG
+from model_registry import _StubModel, StubModelError, STUB_LATENCIES
+from verdicts import interpret_prediction, ensemble_decision, ENSEMBLE_MODELS
+from uploads import read_upload
+from utilities import preprocess_image
+from logging_utils import get_logger
+from metrics import track_requests, render_metrics, METRICS_CONTENT_TYPE, INFERENCE_LATENCY
+
+logger = get_logger("authnet.simple_server")
 
 app = FastAPI()
 
@@ -10,28 +35,120 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"]
 )
+app.middleware("http")(track_requests)
+
+# Built at startup so command line settings apply
+models = {}
+
+
+@app.on_event("startup")
+def create_models():
+    for name in ENSEMBLE_MODELS:
+        models[name] = _StubModel(name)
+    logger.info("Stub models ready", extra={"models": list(models), "latency": STUB_CONFIG["latency"],
+                                            "latency_seconds": STUB_CONFIG["latency_seconds"],
+                                            "error_rate": STUB_CONFIG["error_rate"]})
+
+
+async def model_input(file):
+    """Preprocessed upload, or a blank image when the request carries no file"""
+    if file is None:
+        return np.zeros((1, *PREPROCESSING_CONFIG["image_size"], 3), dtype=np.float32)
+    upload = await read_upload(file)
+    return await run_in_threadpool(preprocess_image, upload.contents)
+
+
+def run_stub(name, img_array, threshold):
+    """Per-model response entry; StubModelError propagates"""
+    with INFERENCE_LATENCY.time(model=name):
+        prediction = models[name].predict(img_array)
+    predicted_class, probabilities, fake_confidence = interpret_prediction(prediction, threshold)
+    return {
+        "model": name,
+        "model_version": "stub",
+        "predicted_class": predicted_class,
+        "probabilities": probabilities,
+        "probability": fake_confidence,
+        "heatmap": None,
+        "heatmap_mode": "none",
+        "stub": True
+    }
+
 
 @app.get("/")
 def root():
     return {"message": "AuthNet Backend Running"}
 
+
 @app.get("/health")
 def health_check():
     return {
         "status": "ok",
-        "loaded_models": ["cnn", "vgg"],
-        "available_models": ["cnn", "vgg"]
+        "loaded_models": list(models),
+        "available_models": list(models),
+        "stub_config": STUB_CONFIG
     }
 
+
+@app.get("/metrics")
+def metrics_endpoint():
+    return Response(content=render_metrics(), media_type=METRICS_CONTENT_TYPE)
+
+
+# Must come before the generic predict route
+@app.post("/predict/ensemble")
+async def predict_ensemble(file: UploadFile = File(None), threshold: float = 0.5):
+    img_array = await model_input(file)
+
+    def run_all():
+        per_model = []
+        for name in ENSEMBLE_MODELS:
+            try:
+                per_model.append(run_stub(name, img_array, threshold))
+            except StubModelError as e:
+                per_model.append({"model": name, "error": str(e), "stub": True})
+        return per_model
+
+    per_model = await run_in_threadpool(run_all)
+    return {"models": per_model, "ensemble": ensemble_decision(per_model, threshold)}
+
+
 @app.post("/predict/{model_name}")
-async def predict(model_name: str):
-    return {
-        "model": model_name,
-        "predicted_class": 0,
-        "probabilities": [0.8, 0.2],
-        "heatmap": None
-    }
+async def predict(model_name: str, file: UploadFile = File(None), threshold: float = 0.5):
+    name = "vgg" if model_name == "vgg16" else model_name
+    if name not in models:
+        raise HTTPException(status_code=400, detail="Invalid model name. Use cnn, effnet, vgg, or vgg16")
+    img_array = await model_input(file)
+    try:
+        result = await run_in_threadpool(run_stub, name, img_array, threshold)
+    except StubModelError as e:
+        raise HTTPException(status_code=500, detail=f"Error processing image: {str(e)}")
+    result["model"] = model_name
+    return result
+
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8001)
+    parser = argparse.ArgumentParser(description="Stand-in AuthNet model server with simulated latency")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency", choices=STUB_LATENCIES, default=STUB_CONFIG["latency"])
+    parser.add_argument("--latency-seconds", type=float, default=STUB_CONFIG["latency_seconds"])
+    parser.add_argument("--latency-spread", type=float, default=STUB_CONFIG["latency_spread"])
+    parser.add_argument("--per-item-seconds", type=float, default=STUB_CONFIG["per_item_seconds"])
+    parser.add_argument("--error-rate", type=float, default=STUB_CONFIG["error_rate"])
+    parser.add_argument("--memory-per-item-mb", type=float, default=STUB_CONFIG["memory_per_item_bytes"] / 2 ** 20)
+    parser.add_argument("--resident-mb", type=float, default=STUB_CONFIG["resident_bytes"] / 2 ** 20)
+    parser.add_argument("--seed", type=int, default=STUB_CONFIG["seed"])
+    args = parser.parse_args()
+    STUB_CONFIG.update({
+        "latency": args.latency,
+        "latency_seconds": args.latency_seconds,
+        "latency_spread": args.latency_spread,
+        "per_item_seconds": args.per_item_seconds,
+        "error_rate": args.error_rate,
+        "memory_per_item_bytes": int(args.memory_per_item_mb * 2 ** 20),
+        "resident_bytes": int(args.resident_mb * 2 ** 20),
+        "seed": args.seed
+    })
+    uvicorn.run(app, host=args.host, port=args.port)
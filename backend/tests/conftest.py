@@ -0,0 +1,51 @@
+"""
+Shared fixtures. The suite runs against the stub models (no TensorFlow needed), with
+the backend's runtime data in a temporary directory and the optional subsystems off.
+"""
+import atexit
+import io
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Read by config.py at import, so set before any backend module is imported
+DATA_DIR = tempfile.mkdtemp(prefix="authnet-tests-")
+atexit.register(shutil.rmtree, DATA_DIR, True)
+os.environ["AUTHNET_DATA_DIR"] = DATA_DIR
+for variable in ("AUTHNET_REMOTE_SERVER_URL", "AUTHNET_JOB_WORKERS", "AUTHNET_EMBEDDINGS", "AUTHNET_INFERENCE_WORKERS",
+                 "AUTHNET_REPLICAS", "AUTHNET_STUB_CONFIG", "AUTHNET_ADMIN_KEY"):
+    os.environ.pop(variable, None)
+
+
+def image_bytes(size=(64, 64), color=(120, 80, 40), image_format="PNG"):
+    """An encoded solid-color test image"""
+    buffer = io.BytesIO()
+    Image.new("RGB", size, color).save(buffer, format=image_format)
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def make_image():
+    return image_bytes
+
+
+@pytest.fixture
+def upload():
+    """`files` argument for posting a small PNG"""
+    return {"file": ("image.png", image_bytes(), "image/png")}
+
+
+@pytest.fixture(scope="module")
+def client():
+    """The API with its startup hooks run (stub models loaded)"""
+    from fastapi.testclient import TestClient
+    import main
+
+    with TestClient(main.app) as test_client:
+        yield test_client
@@ -0,0 +1,88 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+import main
+from admission import AdmissionController, request_lane, upload_cost
+from config import ADMISSION_CONFIG
+
+
+@pytest.fixture
+def config(monkeypatch):
+    """A small budget (10 MP, half of it for bulk) and one slot per model"""
+    for key, value in (("enabled", True), ("capacity_megapixels", 10), ("bulk_share", 0.5), ("concurrency", 1)):
+        monkeypatch.setitem(ADMISSION_CONFIG, key, value)
+
+
+def test_lane_and_cost():
+    assert request_lane({"x-priority": "Bulk"}) == "bulk"
+    assert request_lane({}) == "interactive"
+    assert upload_cost(4000, 3000) == pytest.approx(12.0)
+    assert upload_cost(10, 10) == ADMISSION_CONFIG["min_cost_megapixels"]
+
+
+def test_full_budget_is_rejected_with_retry_after(config):
+    async def scenario():
+        controller = AdmissionController()
+        held = await controller.admit(["cnn"], 8.0)
+        with pytest.raises(HTTPException) as error:
+            await controller.admit(["cnn", "vgg"], 4.0)
+        # Other models are unaffected
+        other = await controller.admit(["vgg"], 4.0)
+        other.release()
+        held.release()
+        # An idle model admits a single request of any size
+        (await controller.admit(["cnn"], 50.0)).release()
+        return error.value
+
+    error = asyncio.run(scenario())
+    assert error.status_code == 429
+    assert int(error.headers["Retry-After"]) >= 1
+
+
+def test_bulk_is_capped_at_its_share(config):
+    async def scenario():
+        controller = AdmissionController()
+        first = await controller.admit(["cnn"], 1.0, "bulk")
+        with pytest.raises(HTTPException):
+            await controller.admit(["cnn"], 5.0, "bulk")
+        interactive = asyncio.ensure_future(controller.admit(["cnn"], 5.0))
+        await asyncio.sleep(0)
+        first.release()
+        (await interactive).release()
+
+    asyncio.run(scenario())
+
+
+def test_freed_slot_goes_to_interactive_first(config):
+    async def scenario():
+        controller = AdmissionController()
+        running = await controller.admit(["cnn"], 1.0)
+        order = []
+
+        async def wait(lane):
+            ticket = await controller.admit(["cnn"], 1.0, lane)
+            order.append(lane)
+            ticket.release()
+
+        waiting = [asyncio.ensure_future(wait("bulk")), asyncio.ensure_future(wait("interactive"))]
+        await asyncio.sleep(0.01)
+        assert not order
+        running.release()
+        await asyncio.gather(*waiting)
+        return order
+
+    assert asyncio.run(scenario()) == ["interactive", "bulk"]
+
+
+def test_api_answers_429_when_the_model_queue_is_full(client, make_image, config):
+    queue = main.admission._queue("cnn")
+    queue.admitted["interactive"] += 9.0
+    try:
+        response = client.post("/predict/cnn", files={"file": ("big.png", make_image((2000, 1000)), "image/png")})
+    finally:
+        queue.admitted["interactive"] -= 9.0
+    assert response.status_code == 429
+    assert "Retry-After" in response.headers
+    assert client.post("/predict/cnn", files={"file": ("big.png", make_image((2000, 1000)), "image/png")}).status_code == 200
@@ -0,0 +1,80 @@
+import time
+
+import pytest
+
+import deadlines
+from deadlines import Deadline, DeadlineExceeded, observe, timeout_for
+
+
+@pytest.fixture
+def estimates():
+    """Stage duration estimates set by the test, restored afterwards"""
+    saved = dict(deadlines._estimates)
+    yield observe
+    deadlines._estimates.clear()
+    deadlines._estimates.update(saved)
+
+
+def test_expired_deadline_stops_the_next_stage():
+    deadline = Deadline(0.01)
+    deadline.check("preprocess")
+    time.sleep(0.02)
+    with pytest.raises(DeadlineExceeded) as error:
+        deadline.check("inference")
+    assert error.value.status_code == 504
+
+
+def test_cancelled_deadline_reports_499():
+    deadline = Deadline()
+    assert deadline.remaining() is None and deadline.affordable("heatmap_gradcam")
+    deadline.cancel("client disconnected")
+    with pytest.raises(DeadlineExceeded) as error:
+        deadline.check("inference")
+    assert error.value.status_code == 499
+
+
+def test_stage_is_affordable_only_with_room_to_spare(estimates):
+    estimates("test_stage", "cnn", 1.0)
+    assert Deadline(2.0).affordable("test_stage", "cnn")
+    assert not Deadline(1.2).affordable("test_stage", "cnn")
+    # Unmeasured stages are always attempted
+    assert Deadline(0.5).affordable("test_stage", "vgg")
+
+
+def test_outbound_timeouts_are_capped_by_the_deadline():
+    assert timeout_for(30) == 30
+    token = deadlines._current_deadline.set(Deadline(2.0))
+    try:
+        assert timeout_for(30) <= 2.0
+        assert timeout_for(1) == 1
+    finally:
+        deadlines._current_deadline.reset(token)
+
+
+def test_invalid_timeout_is_rejected(client, upload):
+    assert client.post("/predict/cnn", files=upload, params={"timeout": "-1"}).status_code == 400
+    assert client.post("/predict/cnn", files=upload, headers={"X-Request-Timeout": "soon"}).status_code == 400
+
+
+def test_exhausted_budget_answers_504(client, upload):
+    response = client.post("/predict/cnn", files=upload, params={"timeout": "0.000001"})
+    assert response.status_code == 504
+
+
+def test_tiles_that_no_longer_fit_are_skipped(client, upload, estimates):
+    estimates("tiles", "cnn", 100.0)
+    response = client.post("/predict/cnn", files=upload, params={"analysis": "tiled", "timeout": "30"})
+    assert response.status_code == 200
+    body = response.json()
+    assert "tiles" not in body
+    assert {"stage": "tiles", "model": "cnn", "reason": "deadline"} in body["skipped"]
+
+
+def test_slow_ensemble_members_are_skipped(client, upload, estimates):
+    estimates("inference", "vgg", 100.0)
+    response = client.post("/predict/ensemble", files=upload, params={"timeout": "30"})
+    assert response.status_code == 200
+    body = response.json()
+    assert {"stage": "inference", "model": "vgg", "reason": "deadline"} in body["skipped"]
+    assert [m for m in body["models"] if m["model"] == "vgg"][0]["skipped"] is True
+    assert body["ensemble"]["total_models"] == 2
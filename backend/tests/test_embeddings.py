@@ -0,0 +1,95 @@
+import hashlib
+import time
+
+import numpy as np
+import pytest
+
+import embeddings
+from config import EMBEDDING_CONFIG
+from embeddings import EmbeddingStore, capturing, embedding_store, search
+
+
+def _vectors(count, dim=16, seed=0):
+    return np.random.default_rng(seed).normal(size=(count, dim)).astype(np.float32)
+
+
+def _metadata(count, prefix="upload"):
+    return [{"sha256": f"{prefix}-{i}", "predicted_class": i % 2, "probability": 0.5} for i in range(count)]
+
+
+def test_capture_is_off_by_default():
+    assert not EMBEDDING_CONFIG["enabled"]
+    assert not capturing("effnet")
+
+
+def test_exact_search_ranks_the_closest_vectors_first(tmp_path):
+    store = EmbeddingStore(str(tmp_path / "store"))
+    vectors = _vectors(50)
+    assert store.append(vectors, _metadata(50)) == 50
+    results, method = store.search(vectors[[7, 21]], k=3)
+    assert method == "exact"
+    assert [matches[0][1] for matches in results] == [7, 21]
+    assert results[0][0][0] == pytest.approx(1.0, abs=1e-3)
+    assert [score for score, _ in results[0]] == sorted((score for score, _ in results[0]), reverse=True)
+
+
+def test_duplicates_and_wrong_dimensions_are_refused(tmp_path):
+    store = EmbeddingStore(str(tmp_path / "store"))
+    store.append(_vectors(3), _metadata(3))
+    assert store.append(_vectors(3, seed=1), _metadata(3)) == 0
+    with pytest.raises(ValueError):
+        store.append(_vectors(1, dim=8), _metadata(1, "other"))
+
+
+def test_index_probing_every_list_matches_the_exact_scan(tmp_path):
+    store = EmbeddingStore(str(tmp_path / "store"))
+    vectors = _vectors(400)
+    store.append(vectors, _metadata(400))
+    store.build_index(lists=8, iterations=5)
+    # Appended after the build: scanned exactly alongside the index
+    store.append(_vectors(20, seed=3), _metadata(20, "late"))
+    queries = _vectors(5, seed=4)
+    exact, _ = store.search(queries, k=10)
+    indexed, method = store.search(queries, k=10, nprobe=8)
+    assert method == "ivf"
+    assert [[i for _, i in matches] for matches in indexed] == [[i for _, i in matches] for matches in exact]
+
+
+def test_search_leaves_out_excluded_uploads(monkeypatch, tmp_path):
+    monkeypatch.setitem(EMBEDDING_CONFIG, "store_dir", str(tmp_path))
+    monkeypatch.setattr(embeddings, "_stores", {})
+    vectors = _vectors(10)
+    embedding_store("cnn", "excludetest").append(vectors, _metadata(10))
+    matches, _ = search("cnn", "excludetest", vectors[:1], k=3, exclude=["upload-0"])
+    assert len(matches[0]) == 3
+    assert "upload-0" not in [match["sha256"] for match in matches[0]]
+
+
+def test_similar_without_stored_embeddings_creates_nothing(client, upload, monkeypatch, tmp_path):
+    store_dir = tmp_path / "embeddings"
+    monkeypatch.setitem(EMBEDDING_CONFIG, "store_dir", str(store_dir))
+    monkeypatch.setattr(embeddings, "_stores", {})
+    response = client.post("/similar", files=upload, params={"model_name": "cnn"})
+    assert response.status_code == 200
+    assert response.json()["matches"] == []
+    assert not store_dir.exists()
+
+
+def test_similar_never_returns_the_query_itself(client, make_image, monkeypatch):
+    monkeypatch.setitem(EMBEDDING_CONFIG, "enabled", True)
+    original, near_copy, different = (make_image(color=c) for c in ((230, 20, 20), (225, 25, 25), (20, 230, 20)))
+    for contents in (original, near_copy, different):
+        assert client.post("/predict/effnet", files={"file": ("image.png", contents, "image/png")}).status_code == 200
+    store = embedding_store("effnet", "stub")
+    for _ in range(100):
+        if store.count >= 3:
+            break
+        time.sleep(0.05)
+
+    response = client.post("/similar", files={"file": ("image.png", original, "image/png")},
+                           params={"model_name": "effnet", "k": 2, "probe": 0})
+    assert response.status_code == 200
+    matches = response.json()["matches"]
+    assert hashlib.sha256(original).hexdigest() not in [match["sha256"] for match in matches]
+    assert matches[0]["sha256"] == hashlib.sha256(near_copy).hexdigest()
+    assert matches[0]["similarity"] > matches[1]["similarity"]
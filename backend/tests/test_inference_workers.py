@@ -0,0 +1,87 @@
+import os
+import signal
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+import pytest
+
+from config import INFERENCE_WORKER_CONFIG
+from inference_workers import InferenceWorkerError, WorkerReplica, _pack, _unpack
+
+
+def _wait_for(condition, timeout=60):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("condition not met in time")
+        time.sleep(0.05)
+
+
+@pytest.fixture
+def replica(monkeypatch):
+    monkeypatch.setitem(INFERENCE_WORKER_CONFIG, "slot_bytes", 1 << 20)
+    monkeypatch.setitem(INFERENCE_WORKER_CONFIG, "restart_delay", 0.05)
+    worker = WorkerReplica("cnn", "missing.keras")
+    try:
+        worker.wait_ready(60)
+        yield worker
+    finally:
+        worker.close()
+
+
+def test_pack_round_trip_falls_back_to_the_pipe():
+    shm = shared_memory.SharedMemory(create=True, size=1024)
+    try:
+        small = np.arange(12, dtype=np.float32).reshape(3, 4)
+        large = np.ones(1024, dtype=np.float64)
+        descriptors = _pack(shm.buf, 0, 1024, [small, large, "auto"])
+        assert [descriptor[0] for descriptor in descriptors] == ["shm", "pipe", "value"]
+        values = _unpack(shm.buf, descriptors, copy=True)
+        np.testing.assert_array_equal(values[0], small)
+        np.testing.assert_array_equal(values[1], large)
+        assert values[2] == "auto"
+        del values
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def test_worker_serves_the_stub_model(replica):
+    batch = np.zeros((2, 224, 224, 3), dtype=np.float32)
+    assert replica.predict(batch).shape == (2, 2)
+    prediction, features = replica.predict_with_features(batch)
+    assert prediction.shape == (2, 2)
+    assert features.shape[0] == 2
+    status = replica.worker_status()
+    assert status["stub"] is True
+    assert status["alive"] and status["restarts"] == 0
+    assert status["pid"] != os.getpid()
+
+
+def test_worker_is_restarted_after_it_dies(replica):
+    first_pid = replica.pid
+    os.kill(first_pid, signal.SIGKILL)
+    _wait_for(lambda: replica.restarts == 1 and replica.ready and replica.pid != first_pid)
+    assert replica.worker_status()["alive"]
+    assert replica.predict(np.zeros((1, 224, 224, 3), dtype=np.float32)).shape == (1, 2)
+
+
+def test_hung_call_kills_the_worker(replica, monkeypatch):
+    monkeypatch.setitem(INFERENCE_WORKER_CONFIG, "call_timeout", 0.5)
+    first_pid = replica.pid
+    os.kill(first_pid, signal.SIGSTOP)
+    with pytest.raises(InferenceWorkerError, match="timed out"):
+        replica.predict(np.zeros((1, 224, 224, 3), dtype=np.float32))
+    _wait_for(lambda: replica.restarts == 1 and replica.ready and replica.pid != first_pid)
+    monkeypatch.setitem(INFERENCE_WORKER_CONFIG, "call_timeout", 30)
+    assert replica.predict(np.zeros((1, 224, 224, 3), dtype=np.float32)).shape == (1, 2)
+
+
+def test_closed_worker_is_not_restarted(replica):
+    process = replica._process
+    replica.close()
+    assert not process.is_alive()
+    time.sleep(0.3)
+    assert replica.restarts == 0
+    assert not replica.ready
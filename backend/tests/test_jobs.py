@@ -0,0 +1,119 @@
+import os
+import time
+import zipfile
+
+import pytest
+
+import main
+from config import JOBS_CONFIG, UPLOAD_CONFIG
+from jobs import JobError, JobStore, WorkerPool, job_params, run_archive, run_job, run_tiled
+
+
+@pytest.fixture
+def store(tmp_path):
+    return JobStore(str(tmp_path / "jobs.sqlite3"))
+
+
+def test_same_input_and_parameters_deduplicate(store):
+    params = job_params("predict", model_name="vgg16")
+    first, deduplicated = store.submit("predict", params, "a" * 64, "/inputs/a")
+    assert not deduplicated and params["model"] == "vgg"
+    again, deduplicated = store.submit("predict", job_params("predict", model_name="vgg"), "a" * 64, "/inputs/a")
+    assert deduplicated and again["id"] == first["id"]
+    other, deduplicated = store.submit("predict", job_params("predict", threshold=0.7), "a" * 64, "/inputs/a")
+    assert not deduplicated and other["id"] != first["id"]
+
+
+def test_failed_job_is_retried_when_submitted_again(store):
+    row, _ = store.submit("ensemble", job_params("ensemble"), "b" * 64, "/inputs/b")
+    store.fail(row["id"], "boom")
+    again, deduplicated = store.submit("ensemble", job_params("ensemble"), "b" * 64, "/inputs/b")
+    assert not deduplicated and again["id"] == row["id"] and again["status"] == "queued"
+
+
+def test_jobs_are_claimed_oldest_first(store):
+    first, _ = store.submit("predict", job_params("predict"), "c" * 64, "/inputs/c")
+    second, _ = store.submit("predict", job_params("predict"), "d" * 64, "/inputs/d")
+    assert store.claim(1)["id"] == first["id"]
+    assert store.claim(2)["id"] == second["id"]
+    assert store.claim(3) is None
+    assert store.counts()["running"] == 2
+
+
+def test_interrupted_jobs_are_requeued_until_out_of_attempts(store, monkeypatch):
+    monkeypatch.setitem(JOBS_CONFIG, "max_attempts", 2)
+    row, _ = store.submit("predict", job_params("predict"), "e" * 64, "/inputs/e")
+    store.claim(1)
+    assert store.requeue(worker=1) == 1
+    assert store.claim(1)["attempts"] == 2
+    assert store.requeue(worker=1) == 0
+    assert store.get(row["id"])["status"] == "failed"
+
+
+def test_invalid_parameters_are_rejected():
+    with pytest.raises(ValueError):
+        job_params("resize")
+    with pytest.raises(ValueError):
+        job_params("ensemble", model_names="cnn,resnet")
+
+
+def test_jobs_are_disabled_by_default(client, upload):
+    assert client.post("/jobs", files=upload).status_code == 503
+
+
+def test_submitted_job_runs_and_returns_its_result(client, make_image, monkeypatch):
+    monkeypatch.setitem(JOBS_CONFIG, "workers", 1)
+    files = {"file": ("image.png", make_image(color=(10, 20, 30)), "image/png")}
+    response = client.post("/jobs", files=files, params={"kind": "predict", "model_name": "effnet"})
+    assert response.status_code == 202
+    job_id = response.json()["job_id"]
+    assert client.get(f"/jobs/{job_id}/result").status_code == 409
+
+    # Run it here, as a worker would
+    store = main.get_job_store()
+    run_job(store, store.claim(os.getpid()))
+    assert client.get(f"/jobs/{job_id}").json()["status"] == "done"
+    result = client.get(f"/jobs/{job_id}/result").json()
+    assert result["model"] == "effnet" and result["predicted_class"] in (0, 1)
+    assert client.post("/jobs", files=files, params={"kind": "predict", "model_name": "effnet"}).json()["deduplicated"]
+
+
+def test_worker_process_completes_queued_jobs(make_image, tmp_path):
+    store = JobStore()
+    path = tmp_path / "input.png"
+    path.write_bytes(make_image(color=(90, 20, 30)))
+    row, _ = store.submit("ensemble", job_params("ensemble"), "f" * 64, str(path))
+    pool = WorkerPool(store, workers=1)
+    pool.start()
+    try:
+        deadline = time.monotonic() + 60
+        while store.get(row["id"])["status"] not in ("done", "failed") and time.monotonic() < deadline:
+            time.sleep(0.2)
+    finally:
+        pool.stop()
+    assert store.get(row["id"])["status"] == "done"
+
+
+def test_archive_members_get_the_upload_guards(client, make_image, tmp_path, monkeypatch):
+    monkeypatch.setitem(UPLOAD_CONFIG, "max_bytes", 1024 * 1024)
+    path = tmp_path / "archive.zip"
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("ok.png", make_image())
+        archive.writestr("wide.png", make_image(size=(UPLOAD_CONFIG["max_edge"] + 1, 2)))
+        # A few kilobytes compressed, over the upload limit inflated
+        archive.writestr("bomb.png", bytes(4 * 1024 * 1024))
+    assert path.stat().st_size < 64 * 1024
+
+    result = run_archive(str(path), job_params("archive", model_names="cnn"), lambda *args: None)
+    items = {item["name"]: item for item in result["items"]}
+    assert "verdict" in items["ok.png"]
+    assert "16384px per edge" in items["wide.png"]["error"]
+    assert "exceeds" in items["bomb.png"]["error"]
+    assert result["summary"]["scored"] == 1 and result["summary"]["errors"] == 2
+
+
+def test_oversized_tiled_input_fails_the_job(client, make_image, tmp_path):
+    path = tmp_path / "wide.png"
+    path.write_bytes(make_image(size=(UPLOAD_CONFIG["max_edge"] + 1, 2)))
+    with pytest.raises(JobError, match="per edge"):
+        run_tiled(str(path), job_params("tiled"), lambda *args: None)
@@ -0,0 +1,121 @@
+import threading
+import time
+
+import pytest
+
+import model_registry
+from config import ADMIN_CONFIG
+from model_registry import ModelLease, _drained, register_model, retire_model
+
+
+class _Version:
+    def __init__(self, number):
+        self.number = number
+        self.dropped = False
+        self.closed = threading.Event()
+
+    def predict(self, x):
+        return x
+
+    def close(self):
+        self.closed.set()
+
+
+@pytest.fixture
+def swappable():
+    """Registers versions of a test-only model name; removed from the registry afterwards"""
+    model_registry.load_models()
+    yield lambda version: register_model("swaptest", version, f"v{version.number}")
+    for registry in (model_registry.models, model_registry.model_versions, model_registry.gradcam_layers):
+        registry.pop("swaptest", None)
+
+
+def test_lease_keeps_its_version_across_a_swap(swappable):
+    swappable(_Version(1))
+    with ModelLease(["swaptest"]) as lease:
+        previous = swappable(_Version(2))
+        assert lease.models["swaptest"] is previous and lease.versions() == {"swaptest": "v1"}
+        assert not _drained(previous, 0.05)
+        with ModelLease(["swaptest"]) as later:
+            assert later.models["swaptest"].number == 2
+    assert _drained(previous, 0.05)
+
+
+def test_drain_waits_for_the_last_lease(swappable):
+    swappable(_Version(1))
+    lease = ModelLease(["swaptest"])
+    previous = swappable(_Version(2))
+    threading.Timer(0.1, lease.release).start()
+    assert _drained(previous, 5)
+    lease.release()  # idempotent
+
+
+def test_version_still_leased_after_the_drain_timeout_is_closed_by_its_last_lease(swappable):
+    swappable(_Version(1))
+    first, second = ModelLease(["swaptest"]), ModelLease(["swaptest"])
+    previous = swappable(_Version(2))
+    assert not retire_model(previous, 0.05)
+    first.release()
+    assert not previous.closed.wait(0.2)
+    second.release()
+    assert previous.closed.wait(5)
+    assert previous not in model_registry._retired
+
+
+def test_drained_version_is_closed_by_the_reload(swappable):
+    swappable(_Version(1))
+    previous = swappable(_Version(2))
+    assert retire_model(previous, 0.05)
+    assert previous.closed.is_set()
+
+
+def test_no_lease_is_taken_on_a_drained_version(swappable):
+    swappable(_Version(0))
+    stop = threading.Event()
+    violations = []
+
+    def lease_repeatedly():
+        while not stop.is_set():
+            with ModelLease(["swaptest"]) as lease:
+                if lease.models["swaptest"].dropped:
+                    violations.append(lease.models["swaptest"].number)
+
+    leasers = [threading.Thread(target=lease_repeatedly) for _ in range(2)]
+    for thread in leasers:
+        thread.start()
+    try:
+        for number in range(1, 300):
+            previous = swappable(_Version(number))
+            assert _drained(previous, 5)
+            previous.dropped = True
+    finally:
+        stop.set()
+        for thread in leasers:
+            thread.join()
+    assert not violations
+
+
+def test_reload_endpoint_validates_its_input(client, monkeypatch):
+    monkeypatch.setitem(ADMIN_CONFIG, "api_key", "secret")
+    assert client.post("/admin/models/cnn/reload").status_code == 401
+    headers = {"X-Admin-Key": "secret"}
+    assert client.post("/admin/models/resnet/reload", headers=headers).status_code == 400
+    assert client.post("/admin/models/cnn/reload", params={"path": "../../etc/passwd"}, headers=headers).status_code == 400
+    listing = client.get("/admin/models", headers=headers).json()
+    assert set(listing) >= {"cnn", "effnet", "vgg"}
+    assert listing["cnn"]["replicas"] >= 1
+
+
+@pytest.mark.skipif(model_registry.TF_AVAILABLE, reason="reloads a real model file when TensorFlow is installed")
+def test_failed_reload_keeps_the_current_version(client, monkeypatch):
+    monkeypatch.setitem(ADMIN_CONFIG, "api_key", "secret")
+    before = model_registry.models["cnn"]
+    response = client.post("/admin/models/cnn/reload", headers={"X-Admin-Key": "secret"})
+    assert response.status_code == 202
+    for _ in range(100):
+        status = client.get("/admin/models", headers={"X-Admin-Key": "secret"}).json()["cnn"]["reload"]
+        if status["state"] in ("done", "failed"):
+            break
+        time.sleep(0.05)
+    assert status["state"] == "failed"
+    assert model_registry.models["cnn"] is before
@@ -0,0 +1,96 @@
+import threading
+
+import numpy as np
+
+from config import REPLICA_CONFIG
+from gradcam import compute_gradcam_heatmap
+from model_registry import ReplicaPool, is_stub, load_replicas, replica_of, replicas_of
+
+
+class _Replica:
+    def __init__(self, number, ready=True):
+        self.number = number
+        self.ready = ready
+        self.calls = []
+
+    def predict(self, x):
+        self.calls.append("predict")
+        return np.array([[self.number]])
+
+    def gradcam_heatmap(self, img_array, target_size):
+        self.calls.append("gradcam")
+        return np.full((7, 7), 0.5, dtype=np.float32)
+
+
+def test_idle_replicas_take_turns():
+    pool = ReplicaPool("test", [_Replica(i) for i in range(3)])
+    assert [int(pool.predict(None)[0, 0]) for _ in range(6)] == [0, 1, 2, 0, 1, 2]
+    assert [entry["served"] for entry in pool.status()] == [2, 2, 2]
+
+
+def test_calls_go_to_the_least_busy_replica():
+    pool = ReplicaPool("test", [_Replica(i) for i in range(3)])
+    with pool.replica() as first, pool.replica() as second:
+        assert {first.number, second.number} == {0, 1}
+        with pool.replica() as third:
+            assert third.number == 2
+        # Replica 2 is free again, the others are still busy
+        with pool.replica() as fourth:
+            assert fourth.number == 2
+    assert all(entry["in_flight"] == 0 for entry in pool.status())
+
+
+def test_replicas_that_are_down_are_passed_over():
+    replicas = [_Replica(0, ready=False), _Replica(1)]
+    pool = ReplicaPool("test", replicas)
+    assert [int(pool.predict(None)[0, 0]) for _ in range(3)] == [1, 1, 1]
+    replicas[1].ready = False
+    # With every replica down, calls still go somewhere (and wait there)
+    assert int(pool.predict(None)[0, 0]) in (0, 1)
+
+
+def test_concurrent_calls_spread_over_the_replicas():
+    replicas = [_Replica(i) for i in range(4)]
+    pool = ReplicaPool("test", replicas)
+    inside = threading.Barrier(4)
+
+    def call():
+        with pool.replica():
+            inside.wait(timeout=5)
+
+    threads = [threading.Thread(target=call) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert [entry["served"] for entry in pool.status()] == [1, 1, 1, 1]
+
+
+def test_gradcam_is_dispatched_like_predictions():
+    replicas = [_Replica(i) for i in range(3)]
+    pool = ReplicaPool("test", replicas)
+    for _ in range(6):
+        heatmap = compute_gradcam_heatmap(pool, np.zeros((32, 32, 3), dtype=np.uint8), model_type="cnn")
+        assert heatmap.shape == (7, 7)
+    assert [replica.calls for replica in replicas] == [["gradcam", "gradcam"]] * 3
+
+
+def test_configured_replica_count_builds_a_pool(monkeypatch):
+    monkeypatch.setitem(REPLICA_CONFIG, "replicas", {"cnn": 3})
+    loaded = iter(range(10))
+    pool = load_replicas("cnn", lambda: _Replica(next(loaded)))
+    assert isinstance(pool, ReplicaPool)
+    assert [replica.number for replica in replicas_of(pool)] == [0, 1, 2]
+    monkeypatch.setitem(REPLICA_CONFIG, "replicas", {"cnn": 1})
+    single = load_replicas("cnn", lambda: _Replica(9))
+    assert not isinstance(single, ReplicaPool)
+    with replica_of(single) as replica:
+        assert replica is single
+    assert load_replicas("cnn", lambda: None) is None
+
+
+def test_api_models_are_served_through_their_replicas(client):
+    import main
+    assert all(is_stub(model) for model in main.models.values())
+    with replica_of(main.models["cnn"]) as replica:
+        assert replica.predict(np.zeros((2, 224, 224, 3), dtype=np.float32)).shape == (2, 2)
@@ -0,0 +1,119 @@
+import json
+
+import numpy as np
+import pytest
+
+import main
+from config import MODEL_CONFIG
+from responses import encode_prediction_response
+from utilities import encode_heatmap
+
+
+def test_json_is_the_default(client, upload):
+    response = client.post("/predict/cnn", files=upload)
+    assert response.status_code == 200
+    body = response.json()
+    assert body["model"] == "cnn"
+    assert body["predicted_class"] in (0, 1)
+    assert len(body["probabilities"]) == 2
+    # Stub models produce no heatmaps
+    assert body["heatmap"] is None and body["heatmap_mode"] == "none"
+
+
+def test_msgpack_response_matches_json(client, upload):
+    msgpack = pytest.importorskip("msgpack")
+    as_json = client.post("/predict/cnn", files=upload).json()
+    response = client.post("/predict/cnn", files=upload, params={"response_format": "msgpack"})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/msgpack"
+    decoded = msgpack.unpackb(response.content, raw=False)
+    assert decoded["probabilities"] == as_json["probabilities"]
+    assert decoded["predicted_class"] == as_json["predicted_class"]
+
+
+def test_multipart_response_starts_with_the_json_document(client, upload):
+    response = client.post("/predict/ensemble", files=upload, params={"response_format": "multipart"})
+    assert response.status_code == 200
+    media_type, boundary = response.headers["content-type"].split("; boundary=")
+    assert media_type == "multipart/mixed"
+    first_part = response.content.split(f"--{boundary}".encode())[1]
+    headers, document = first_part.split(b"\r\n\r\n", 1)
+    assert b"application/json" in headers
+    assert [m["model"] for m in json.loads(document)["models"]] == ["cnn", "effnet", "vgg"]
+
+
+@pytest.mark.parametrize("params", [{"heatmap_format": "gif"}, {"response_format": "xml"}, {"heatmap_mode": "magic"}])
+def test_unknown_formats_are_rejected(client, upload, params):
+    assert client.post("/predict/cnn", files=upload, params=params).status_code == 400
+
+
+def test_grid_formats_carry_the_raw_grid():
+    grid = np.linspace(0, 1, 12, dtype=np.float32).reshape(3, 4)
+    as_uint8 = encode_heatmap(grid, heatmap_format="grid_uint8")
+    assert as_uint8["shape"] == [3, 4]
+    assert np.frombuffer(as_uint8["data"], dtype=as_uint8["dtype"]).reshape(3, 4)[2, 3] == 255
+    as_float16 = encode_heatmap(grid, heatmap_format="grid_float16")
+    restored = np.frombuffer(as_float16["data"], dtype=as_float16["dtype"]).reshape(3, 4)
+    assert np.allclose(restored, grid, atol=1e-3)
+
+
+def test_multipart_detaches_heatmaps_into_binary_parts():
+    heatmap = encode_heatmap(np.ones((7, 7), dtype=np.float32), heatmap_format="png", max_edge=32)
+    response = encode_prediction_response({"model": "cnn", "heatmap": heatmap}, "multipart")
+    boundary = response.media_type.split("boundary=")[1]
+    parts = response.body.split(f"--{boundary}".encode())[1:-1]
+    document = json.loads(parts[0].split(b"\r\n\r\n", 1)[1])
+    assert "data" not in document["heatmap"]
+    assert document["heatmap"]["part"].encode() in parts[1]
+    assert parts[1].split(b"\r\n\r\n", 1)[1].rstrip(b"\r\n") == heatmap["data"]
+
+
+class _RemoteAnswer:
+    status_code = 200
+
+    def __init__(self, probabilities):
+        self._probabilities = probabilities
+
+    def json(self):
+        return {"model": "cnn", "actual_model": "cnn", "predicted_class": 0, "probabilities": self._probabilities}
+
+
+@pytest.fixture
+def remote(monkeypatch):
+    """Forward to a fake model server answering every model with a sigmoid output of 0.7; yields the URLs called"""
+    called = []
+
+    def post(url, **kwargs):
+        called.append(url)
+        return _RemoteAnswer([0.7])
+
+    monkeypatch.setattr(main, "use_remote_models", True)
+    monkeypatch.setitem(MODEL_CONFIG["remote"], "server_url", "http://model-server")
+    monkeypatch.setattr(main.requests, "post", post)
+    return called
+
+
+def test_remote_prediction_is_thresholded_and_encoded_locally(client, upload, remote):
+    msgpack = pytest.importorskip("msgpack")
+    response = client.post("/predict/cnn", files=upload, params={"threshold": 0.8, "response_format": "msgpack"})
+    assert response.status_code == 200
+    body = msgpack.unpackb(response.content, raw=False)
+    assert body["remote"] is True
+    assert body["predicted_class"] == 0  # 0.7 is under the threshold
+    assert body["skipped"] == [{"stage": "heatmap", "model": "cnn", "reason": "remote"}]
+
+
+def test_remote_ensemble_votes_over_the_per_model_endpoints(client, upload, remote):
+    response = client.post("/predict/ensemble", files=upload, params={"include_heatmaps": False})
+    assert response.status_code == 200
+    body = response.json()
+    assert sorted(remote) == sorted(f"http://model-server{MODEL_CONFIG['remote']['endpoints'][name]}"
+                                    for name in ("cnn", "effnet", "vgg"))
+    assert body["ensemble"]["majority_label"] == "fake"
+    assert "skipped" not in body
+
+
+def test_remote_tiled_analysis_is_refused(client, upload, remote):
+    response = client.post("/predict/cnn", files=upload, params={"analysis": "tiled"})
+    assert response.status_code == 501
+    assert not remote
@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+from tiling import analyze_tiles, axis_positions, scaled_size, tile_layout
+
+
+def _covers(positions, length, tile_size):
+    return positions[0] == 0 and positions[-1] + tile_size == length and all(
+        later - earlier <= tile_size for earlier, later in zip(positions, positions[1:]))
+
+
+def test_last_tile_is_aligned_to_the_edge():
+    assert axis_positions(500, 224, 224) == [0, 224, 276]
+    assert axis_positions(200, 224, 224) == [0]
+
+
+@pytest.mark.parametrize("width, height, stride, max_tiles", [
+    (6000, 4000, 224, 64),
+    (3000, 1000, 100, 8),
+    (224, 5000, 224, 3),
+    (1000, 1000, 50, 1),
+    (900, 700, 500, 64)
+])
+def test_layout_covers_the_image_within_max_tiles(width, height, stride, max_tiles):
+    xs, ys, used_stride, scale = tile_layout(width, height, 224, stride, max_tiles)
+    assert used_stride <= 224
+    assert len(xs) * len(ys) <= max_tiles
+    analyzed_width, analyzed_height = scaled_size(width, height, scale, 224)
+    assert _covers(xs, analyzed_width, 224) and _covers(ys, analyzed_height, 224)
+
+
+def test_native_resolution_when_the_tiles_fit():
+    xs, ys, stride, scale = tile_layout(896, 448, 224, 112, 64)
+    assert scale == 1.0 and stride == 112
+    assert len(xs) == 7 and len(ys) == 3
+
+
+def test_analysis_reports_the_downscale(make_image):
+    batches = []
+
+    def predict(batch):
+        batches.append(len(batch))
+        # Red channel of the (normalized) tile as its fake score
+        return np.column_stack([1 - batch[:, 0, 0, 0], batch[:, 0, 0, 0]])
+
+    tiles = analyze_tiles(make_image((3000, 1000), color=(51, 0, 0)), predict, max_tiles=8, batch_size=3)
+    assert tiles["count"] == 8 and tiles["grid"] == [2, 4]
+    assert tiles["stride"] == 224 and tiles["scale"] < 1.0
+    assert batches == [3, 3, 2]
+    assert tiles["score"] == pytest.approx(0.2, abs=1e-3)
+    assert tiles["score_map"].shape == (2, 4)
@@ -0,0 +1,89 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from config import UPLOAD_CONFIG
+from uploads import MULTIPART_OVERHEAD_BYTES, UploadSizeLimit, inspect_image_header
+
+
+def _multipart(contents, boundary="testboundary"):
+    head = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"image.png\"\r\n"
+            f"Content-Type: image/png\r\n\r\n").encode()
+    return head + contents + f"\r\n--{boundary}--\r\n".encode(), f"multipart/form-data; boundary={boundary}"
+
+
+def _run_limited(headers, chunks, max_bytes):
+    """Drive UploadSizeLimit around an app that reads the whole body; returns (app_called, sent messages)"""
+    messages = [{"type": "http.request", "body": chunk, "more_body": True} for chunk in chunks]
+    messages.append({"type": "http.request", "body": b"", "more_body": False})
+    sent = []
+    app_called = []
+
+    async def app(scope, receive, send):
+        app_called.append(True)
+        while (await receive()).get("more_body"):
+            pass
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "path": "/predict/cnn", "headers": headers}
+    asyncio.run(UploadSizeLimit(app, limit_for=lambda path: max_bytes)(scope, receive, send))
+    return app_called, sent
+
+
+def test_declared_oversized_body_is_refused_before_the_app_runs():
+    too_long = str(1000 + MULTIPART_OVERHEAD_BYTES + 1).encode()
+    app_called, sent = _run_limited([(b"content-length", too_long)], [], max_bytes=1000)
+    assert not app_called
+    assert sent[0]["status"] == 413
+
+
+def test_body_without_a_length_is_cut_off_at_the_limit():
+    chunks = [b"x" * 32 * 1024] * 8
+    with pytest.raises(HTTPException) as error:
+        _run_limited([(b"transfer-encoding", b"chunked")], chunks, max_bytes=1000)
+    assert error.value.status_code == 413
+
+
+def test_body_within_the_limit_passes():
+    app_called, sent = _run_limited([(b"transfer-encoding", b"chunked")], [b"x" * 1000], max_bytes=1000)
+    assert app_called and not sent
+
+
+def test_chunked_upload_over_the_limit_gets_413(client, make_image, monkeypatch):
+    monkeypatch.setitem(UPLOAD_CONFIG, "max_bytes", 1024)
+    body, content_type = _multipart(make_image() + b"\0" * (2 * MULTIPART_OVERHEAD_BYTES))
+
+    def chunked():
+        for start in range(0, len(body), 16 * 1024):
+            yield body[start:start + 16 * 1024]
+
+    response = client.post("/predict/cnn", content=chunked(), headers={"content-type": content_type})
+    assert response.status_code == 413
+
+
+def test_upload_over_the_limit_gets_413(client, make_image, monkeypatch):
+    monkeypatch.setitem(UPLOAD_CONFIG, "max_bytes", 1024)
+    response = client.post("/predict/cnn", files={"file": ("image.png", make_image((512, 512)), "image/png")})
+    assert response.status_code == 413
+
+
+def test_unreadable_and_empty_uploads_are_rejected(client):
+    assert client.post("/predict/cnn", files={"file": ("a.png", b"not an image", "image/png")}).status_code == 400
+    assert client.post("/predict/cnn", files={"file": ("a.png", b"", "image/png")}).status_code == 400
+
+
+def test_dimensions_are_checked_from_the_header(make_image):
+    width, height, image_format = inspect_image_header(make_image((300, 200)))
+    assert (width, height, image_format) == (300, 200, "PNG")
+    with pytest.raises(HTTPException) as error:
+        inspect_image_header(make_image((300, 200)), max_pixels=10_000)
+    assert error.value.status_code == 413
+    with pytest.raises(HTTPException) as error:
+        inspect_image_header(make_image((300, 200)), max_edge=256)
+    assert error.value.status_code == 413
@@ -0,0 +1,152 @@
+"""
+Tiled high-resolution analysis.
+
+preprocess_image squeezes a whole upload into one model input, which averages
+away local manipulation artifacts in large photos. Tiled analysis instead scores
+model-sized crops of the image at native resolution and aggregates the per-tile
+fake scores; the tile score map doubles as a coarse heatmap. The tiles always cover
+the whole image: an image too large for max_tiles tiles is downscaled just enough.
+
+Tiles are cut straight into a reusable batch buffer and sent through the model
+one batch at a time, so peak memory is one batch of tiles however many there are.
+"""
+import cv2
+import numpy as np
+from PIL import Image
+import io
+from config import PREPROCESSING_CONFIG, TILING_CONFIG
+from timing import stage
+
+AGGREGATIONS = ("max", "mean")
+
+
+def axis_positions(length, tile_size, stride):
+    """Tile offsets along one axis; the last tile is aligned to the edge so nothing is skipped"""
+    if length <= tile_size:
+        return [0]
+    positions = list(range(0, length - tile_size + 1, stride))
+    if positions[-1] != length - tile_size:
+        positions.append(length - tile_size)
+    return positions
+
+
+def fitting_scale(width, height, tile_size, max_tiles):
+    """Largest downscale factor (at most 1) at which non-overlapping tiles cover the image in max_tiles tiles"""
+    return max(min(1.0, cols * tile_size / width, (max_tiles // cols) * tile_size / height)
+               for cols in range(1, max(1, max_tiles) + 1))
+
+
+def scaled_size(width, height, scale, tile_size):
+    """Image size after downscaling by `scale`, never below one tile"""
+    if scale >= 1.0:
+        return width, height
+    return max(tile_size, int(width * scale)), max(tile_size, int(height * scale))
+
+
+def tile_layout(width, height, tile_size, stride, max_tiles):
+    """
+    (xs, ys, stride, scale) for a grid of at most max_tiles tiles that covers the whole image.
+    The stride is widened up to the tile size (no overlap left) but never past it, so no
+    pixels fall between tiles. If that is still too many tiles, the image is to be downscaled
+    by `scale` instead (see scaled_size); xs and ys are then offsets in the downscaled image.
+    """
+    stride = max(1, min(stride, tile_size))
+    while True:
+        xs = axis_positions(width, tile_size, stride)
+        ys = axis_positions(height, tile_size, stride)
+        if len(xs) * len(ys) <= max_tiles:
+            return xs, ys, stride, 1.0
+        if stride == tile_size:
+            break
+        stride = min(tile_size, max(stride + 1, int(stride * 1.25)))
+    scale = fitting_scale(width, height, tile_size, max_tiles)
+    width, height = scaled_size(width, height, scale, tile_size)
+    return axis_positions(width, tile_size, stride), axis_positions(height, tile_size, stride), stride, scale
+
+
+def decode_for_tiling(contents, tile_size):
+    """Decode an upload at native resolution (upscaled only if smaller than one tile)"""
+    with stage("decode"):
+        img = Image.open(io.BytesIO(contents)).convert("RGB")
+    if min(img.size) < tile_size:
+        scale = tile_size / min(img.size)
+        img = img.resize((max(tile_size, round(img.width * scale)), max(tile_size, round(img.height * scale))))
+    return np.asarray(img)
+
+
+def iter_tile_batches(img, xs, ys, tile_size, model_size, batch_size):
+    """Yield (batch, count) with batch a reused float32 buffer whose first `count` rows are tiles"""
+    batch = np.empty((batch_size, model_size[1], model_size[0], 3), dtype=np.float32)
+    count = 0
+    for y in ys:
+        for x in xs:
+            tile = img[y:y + tile_size, x:x + tile_size]
+            if tile_size != model_size[0] or tile_size != model_size[1]:
+                tile = cv2.resize(tile, model_size, interpolation=cv2.INTER_AREA)
+            batch[count] = tile
+            count += 1
+            if count == batch_size:
+                yield batch, count
+                count = 0
+    if count:
+        yield batch, count
+
+
+def fake_scores(prediction):
+    """Per-row fake probability from sigmoid (n, 1) or softmax (n, 2) outputs"""
+    prediction = np.asarray(prediction, dtype=np.float32)
+    if prediction.ndim == 1 or prediction.shape[-1] == 1:
+        return prediction.reshape(-1)
+    return prediction[:, 1]
+
+
+def analyze_tiles(contents, predict_fn, tile_size=None, stride=None, max_tiles=None, batch_size=None,
+                  aggregate=None):
+    """
+    Score an upload tile by tile with predict_fn(batch) -> model output.
+
+    Returns the per-tile fake score map (rows x cols, float32) together with the
+    layout and the aggregated score ("max" flags an image if any region looks
+    fake, "mean" averages over the whole image).
+    """
+    tile_size = tile_size or TILING_CONFIG["tile_size"]
+    stride = stride or TILING_CONFIG["stride"] or tile_size
+    max_tiles = max_tiles or TILING_CONFIG["max_tiles"]
+    batch_size = batch_size or TILING_CONFIG["batch_size"]
+    aggregate = aggregate or TILING_CONFIG["aggregate"]
+    if aggregate not in AGGREGATIONS:
+        raise ValueError(f"Unknown tile aggregation: {aggregate}")
+    model_size = tuple(PREPROCESSING_CONFIG["image_size"])
+
+    img = decode_for_tiling(contents, tile_size)
+    height, width = img.shape[:2]
+    xs, ys, stride, scale = tile_layout(width, height, tile_size, stride, max_tiles)
+    if scale < 1.0:
+        # Too large to cover at native resolution within max_tiles: tile a downscaled copy instead
+        with stage("resize"):
+            img = cv2.resize(img, scaled_size(width, height, scale, tile_size), interpolation=cv2.INTER_AREA)
+
+    scores = np.empty(len(xs) * len(ys), dtype=np.float32)
+    done = 0
+    for batch, count in iter_tile_batches(img, xs, ys, tile_size, model_size, batch_size):
+        x = batch[:count]
+        if PREPROCESSING_CONFIG["normalize"]:
+            x /= PREPROCESSING_CONFIG["normalization_factor"]
+        scores[done:done + count] = fake_scores(predict_fn(x))[:count]
+        done += count
+    score_map = scores.reshape(len(ys), len(xs))
+
+    return {
+        "score_map": score_map,
+        "score": float(score_map.max() if aggregate == "max" else score_map.mean()),
+        "aggregate": aggregate,
+        "max_score": float(score_map.max()),
+        "mean_score": float(score_map.mean()),
+        "count": int(scores.size),
+        "grid": [len(ys), len(xs)],
+        "tile_size": tile_size,
+        "stride": stride,
+        "image_size": [width, height],
+        # Factor the image was downscaled by to stay within max_tiles (1.0: native resolution)
+        "scale": round(scale, 4)
+    }
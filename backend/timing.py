@@ -0,0 +1,162 @@
+"""
+Per-request stage timing.
+
+Code wraps its stages in `with stage("name", model=...)`. While a request trace is
+active (set up by the HTTP middleware for /predict/* routes) the spans are
+collected and reported as a Server-Timing header, as a breakdown in trace=true
+response bodies, and optionally as a Chrome trace-event file. Outside a traced
+request stage() is a shared no-op.
+"""
+import contextvars
+import json
+import os
+import threading
+import time
+from config import TRACE_CONFIG
+from logging_utils import get_logger, current_request_id
+
+logger = get_logger("authnet.timing")
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+class RequestTrace:
+    """Spans recorded for a single request"""
+
+    def __init__(self, request_id=None):
+        self.request_id = request_id
+        self.origin = time.perf_counter()
+        self.wall_origin = time.time()
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, name, start, end, model=None):
+        with self._lock:
+            self.spans.append((name, model, start - self.origin, end - start, threading.get_ident()))
+
+    def stage_totals(self):
+        """Total seconds per (stage, model), in first-seen order"""
+        totals = {}
+        with self._lock:
+            spans = list(self.spans)
+        for name, model, _, duration, _ in spans:
+            totals[(name, model)] = totals.get((name, model), 0.0) + duration
+        return totals
+
+    def server_timing_header(self):
+        entries = []
+        for (name, model), duration in self.stage_totals().items():
+            metric = f"{name}-{model}" if model else name
+            entries.append(f"{metric};dur={duration * 1000:.2f}")
+        entries.append(f"total;dur={(time.perf_counter() - self.origin) * 1000:.2f}")
+        return ", ".join(entries)
+
+    def summary(self):
+        """Per-stage breakdown plus each model's share of the model-attributed time"""
+        with self._lock:
+            spans = list(self.spans)
+        per_model = {}
+        for _, model, _, duration, _ in spans:
+            if model:
+                per_model[model] = per_model.get(model, 0.0) + duration
+        model_total = sum(per_model.values())
+        return {
+            "total_ms": round((time.perf_counter() - self.origin) * 1000, 3),
+            "stages": [
+                {"stage": name, "model": model, "start_ms": round(start * 1000, 3), "duration_ms": round(duration * 1000, 3)}
+                for name, model, start, duration, _ in spans
+            ],
+            "models": {
+                model: {"duration_ms": round(duration * 1000, 3), "share": round(duration / model_total, 4) if model_total else 0.0}
+                for model, duration in per_model.items()
+            }
+        }
+
+    def to_trace_events(self):
+        """Chrome trace-event format (complete events, microseconds)"""
+        with self._lock:
+            spans = list(self.spans)
+        pid = os.getpid()
+        base_us = self.wall_origin * 1e6
+        events = []
+        for name, model, start, duration, tid in spans:
+            events.append({
+                "name": f"{name}:{model}" if model else name,
+                "cat": "authnet",
+                "ph": "X",
+                "ts": base_us + start * 1e6,
+                "dur": duration * 1e6,
+                "pid": pid,
+                "tid": tid,
+                "args": {"request_id": self.request_id, "model": model}
+            })
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write(self, output_dir):
+        os.makedirs(output_dir, exist_ok=True)
+        path = os.path.join(output_dir, f"trace-{self.request_id or int(self.wall_origin * 1000)}.json")
+        with open(path, "w") as f:
+            json.dump(self.to_trace_events(), f)
+        return path
+
+
+class _Stage:
+    __slots__ = ("trace", "name", "model", "started")
+
+    def __init__(self, trace, name, model):
+        self.trace = trace
+        self.name = name
+        self.model = model
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.trace.add(self.name, self.started, time.perf_counter(), self.model)
+        return False
+
+
+class _NullStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+def stage(name, model=None):
+    """Time a block as a named stage of the current request (no-op outside a traced request)"""
+    trace = _current_trace.get()
+    if trace is None:
+        return _NULL_STAGE
+    return _Stage(trace, name, model)
+
+
+def begin_trace(request_id=None):
+    trace = RequestTrace(request_id)
+    _current_trace.set(trace)
+    return trace
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+async def server_timing(request, call_next):
+    """HTTP middleware collecting stage timings for /predict/* into a Server-Timing header"""
+    if not request.url.path.startswith("/predict/"):
+        return await call_next(request)
+    trace = begin_trace(current_request_id())
+    response = await call_next(request)
+    response.headers["Server-Timing"] = trace.server_timing_header()
+    if TRACE_CONFIG["output_dir"] and request.query_params.get("trace", "").lower() in ("true", "1"):
+        try:
+            trace.write(TRACE_CONFIG["output_dir"])
+        except OSError as e:
+            logger.warning("Could not write trace file: %s", e)
+    return response
@@ -0,0 +1,164 @@
+"""
+Upload ingestion helpers.
+
+Request bodies are counted as they are received (UploadSizeLimit), so the multipart
+parser never spools more than the upload limit, whether or not a Content-Length was
+sent. Uploads are then read in chunks with a byte limit and hashed while reading, and
+the image header is parsed to reject oversized dimensions before anything is decoded.
+"""
+import hashlib
+import io
+from collections import namedtuple
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+from PIL import Image
+from starlette.datastructures import Headers
+from config import UPLOAD_CONFIG
+
+# Make any decode that slips past inspect_upload fail instead of allocating gigabytes
+Image.MAX_IMAGE_PIXELS = UPLOAD_CONFIG["max_pixels"]
+
+Upload = namedtuple("Upload", ["contents", "sha256", "width", "height", "format"])
+
+# Allowance for multipart boundaries and form fields on top of the file itself
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+
+
+def declared_body_too_large(headers, max_bytes=None):
+    """True if the request's Content-Length already exceeds the upload limit"""
+    if max_bytes is None:
+        max_bytes = UPLOAD_CONFIG["max_bytes"]
+    content_length = headers.get("content-length")
+    if not content_length or not content_length.isdigit():
+        return False
+    return int(content_length) > max_bytes + MULTIPART_OVERHEAD_BYTES
+
+
+class UploadSizeLimit:
+    """
+    ASGI middleware enforcing the upload limit on the request body as it is received.
+    A declared Content-Length over the limit is refused outright. Otherwise, including for
+    chunked bodies without a length, the bytes are counted as the app reads them. Once
+    they pass the limit, the read raises a 413 before any more of the body is spooled.
+    `limit_for(path)` gives the limit in bytes for a request path (UPLOAD_CONFIG by default).
+    """
+
+    def __init__(self, app, limit_for=None):
+        self.app = app
+        self.limit_for = limit_for or (lambda path: UPLOAD_CONFIG["max_bytes"])
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        max_bytes = self.limit_for(scope["path"])
+        if declared_body_too_large(Headers(scope=scope), max_bytes):
+            response = JSONResponse(status_code=413, content={"detail": f"Upload exceeds {max_bytes} bytes"})
+            await response(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > max_bytes + MULTIPART_OVERHEAD_BYTES:
+                    raise HTTPException(status_code=413, detail=f"Upload exceeds {max_bytes} bytes")
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+async def read_upload_bytes(file, max_bytes=None, chunk_size=None):
+    """
+    Read an UploadFile in chunks, enforcing max_bytes and hashing as it goes.
+    Returns (contents, sha256 hexdigest).
+    """
+    if max_bytes is None:
+        max_bytes = UPLOAD_CONFIG["max_bytes"]
+    if chunk_size is None:
+        chunk_size = UPLOAD_CONFIG["chunk_size"]
+
+    declared_size = getattr(file, "size", None)
+    if declared_size is not None and declared_size > max_bytes:
+        raise HTTPException(status_code=413, detail=f"Upload exceeds {max_bytes} bytes")
+
+    hasher = hashlib.sha256()
+    buffer = bytearray()
+    while True:
+        chunk = await file.read(chunk_size)
+        if not chunk:
+            break
+        if len(buffer) + len(chunk) > max_bytes:
+            raise HTTPException(status_code=413, detail=f"Upload exceeds {max_bytes} bytes")
+        hasher.update(chunk)
+        buffer += chunk
+    if not buffer:
+        raise HTTPException(status_code=400, detail="Empty upload")
+    return bytes(buffer), hasher.hexdigest()
+
+
+async def read_upload_to_file(file, out, max_bytes, chunk_size=None):
+    """
+    Copy an UploadFile into the writable binary file `out` chunk by chunk, enforcing max_bytes.
+    The multipart parser has already spooled the body (bounded by UploadSizeLimit, in a temporary
+    file past 1 MB), so this only avoids a second full copy in memory. Returns (size, sha256 hexdigest).
+    """
+    if chunk_size is None:
+        chunk_size = UPLOAD_CONFIG["chunk_size"]
+
+    declared_size = getattr(file, "size", None)
+    if declared_size is not None and declared_size > max_bytes:
+        raise HTTPException(status_code=413, detail=f"Upload exceeds {max_bytes} bytes")
+
+    hasher = hashlib.sha256()
+    size = 0
+    while True:
+        chunk = await file.read(chunk_size)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > max_bytes:
+            raise HTTPException(status_code=413, detail=f"Upload exceeds {max_bytes} bytes")
+        hasher.update(chunk)
+        out.write(chunk)
+    if not size:
+        raise HTTPException(status_code=400, detail="Empty upload")
+    out.flush()
+    return size, hasher.hexdigest()
+
+
+def inspect_image_header(contents, max_pixels=None, max_edge=None):
+    """
+    Parse only the image header and reject dimensions that would be unsafe to decode.
+    Returns (width, height, format).
+    """
+    if max_pixels is None:
+        max_pixels = UPLOAD_CONFIG["max_pixels"]
+    if max_edge is None:
+        max_edge = UPLOAD_CONFIG["max_edge"]
+    try:
+        # Image.open is lazy - it reads the header but decodes no pixel data
+        with Image.open(io.BytesIO(contents)) as img:
+            width, height = img.size
+            image_format = img.format
+    except Image.DecompressionBombError:
+        raise HTTPException(status_code=413, detail="Image dimensions are too large")
+    except Exception:
+        raise HTTPException(status_code=400, detail="Upload is not a readable image")
+
+    if width * height > max_pixels or max(width, height) > max_edge:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Image is {width}x{height}; limit is {max_pixels} pixels and {max_edge}px per edge"
+        )
+    return width, height, image_format
+
+
+async def read_upload(file):
+    """Stream an image upload with size and dimension guards applied"""
+    contents, digest = await read_upload_bytes(file)
+    width, height, image_format = inspect_image_header(contents)
+    return Upload(contents, digest, width, height, image_format)
@@ -7,187 +7,63 @@ except Exception:
     TF_AVAILABLE = False
 import cv2
 import base64
+import threading
+import io
 from io import BytesIO
 from PIL import Image
 import matplotlib.pyplot as plt
+from timing import stage
+from config import PREPROCESSING_CONFIG, BATCH_CONFIG
+from model_registry import get_model, get_keras_model, is_stub
+from gradcam import compute_gradcam_heatmap
+from logging_utils import get_logger
 
+logger = get_logger("authnet.utilities")
 
 
-def generate_gradcam_vgg16(img_array, target_size=(224, 224), intensity=0.4):
-    import os
-    # If TensorFlow is not available, return None to indicate heatmap generation isn't possible
-    if not TF_AVAILABLE:
-        return {'gradcam_vgg16': None}
-    base_dir = os.path.dirname(os.path.abspath(__file__))
-    model_path = os.path.join(base_dir, "models", "vgg16_standalone_authnet.keras")
-    model = tf.keras.models.load_model(model_path)
-    
-    # Resize + preprocess for VGG16
-    img_resized = cv2.resize(img_array, target_size)
-    x = np.expand_dims(img_resized, axis=0)
-
-    # Build grad model
-    grad_model = tf.keras.models.Model(
-        [model.inputs],
-        [model.get_layer('top_conv').output, model.output]
-    )
-
-    # Forward + backward pass
-    with tf.GradientTape() as tape:
-        conv_outputs, predictions = grad_model(x)
-        class_idx = tf.argmax(predictions[0])
-        loss = predictions[:, class_idx]
-
-    grads = tape.gradient(loss, conv_outputs)
-    pooled_grads = tf.reduce_mean(grads, axis=(0, 1, 2))
-
-    # Generate heatmap
-    conv_outputs = conv_outputs[0]
-    heatmap = conv_outputs @ pooled_grads[..., tf.newaxis]
-    heatmap = tf.squeeze(heatmap)
-    heatmap = tf.maximum(heatmap, 0) / tf.math.reduce_max(heatmap)
-
-    # Resize heatmap to match original image
-    heatmap = cv2.resize(heatmap.numpy(), (img_array.shape[1], img_array.shape[0]))
-    heatmap = np.uint8(255 * heatmap)
-    heatmap = cv2.applyColorMap(heatmap, cv2.COLORMAP_JET)
-
-    # Overlay
-    superimposed_img = heatmap * intensity + img_array
-    superimposed_img = np.clip(superimposed_img, 0, 255).astype(np.uint8)
-
-    # Convert to Base64 string
-    pil_img = Image.fromarray(superimposed_img)
-    buffer = BytesIO()
-    pil_img.save(buffer, format="JPEG")
-    gradcam_vgg16 = base64.b64encode(buffer.getvalue()).decode("utf-8")
 
-    return {'gradcam_vgg16': gradcam_vgg16}
+def _gradcam_overlay(name, img_array, target_size=(224, 224), intensity=0.4):
+    """
+    Base64 JPEG of the Grad-CAM heatmap of registry model `name` blended over img_array, at its size.
+    Computed like the API's heatmaps (gradcam.compute_gradcam_heatmap on the least busy replica, then
+    encode_heatmap), so reloads and the colormap behave the same. None for stubs or without a conv layer.
+    """
+    model = get_model(name)
+    if model is None or is_stub(model):
+        return None
+    heatmap = compute_gradcam_heatmap(model, img_array, model_type=name, target_size=target_size)
+    if heatmap is None:
+        return None
+    encoded = encode_heatmap(heatmap, img_array, heatmap_format="jpeg", intensity=intensity,
+                             max_edge=max(img_array.shape[:2]))
+    return base64.b64encode(encoded["data"]).decode("utf-8")
 
 
-
-def generate_gradcam_cnn(img_array, target_size=(224, 224), intensity=0.4):
-    import os
-    if not TF_AVAILABLE:
-        return {'gradcam_cnn': None}
-    base_dir = os.path.dirname(os.path.abspath(__file__))
-    model_path = os.path.join(base_dir, "models", "cnn_standalone.keras")
-    model = tf.keras.models.load_model(model_path)
-    
-    # Resize + preprocess for VGG16
-    img_resized = cv2.resize(img_array, target_size)
-    x = np.expand_dims(img_resized, axis=0)
-
-    # Build grad model
-    grad_model = tf.keras.models.Model(
-        [model.inputs],
-        [model.get_layer('conv2d_47').output, model.output]
-    )
-
-    # Forward + backward pass
-    with tf.GradientTape() as tape:
-        conv_outputs, predictions = grad_model(x)
-        class_idx = tf.argmax(predictions[0])
-        loss = predictions[:, class_idx]
-
-    grads = tape.gradient(loss, conv_outputs)
-    pooled_grads = tf.reduce_mean(grads, axis=(0, 1, 2))
-
-    # Generate heatmap
-    conv_outputs = conv_outputs[0]
-    heatmap = conv_outputs @ pooled_grads[..., tf.newaxis]
-    heatmap = tf.squeeze(heatmap)
-    heatmap = tf.maximum(heatmap, 0) / tf.math.reduce_max(heatmap)
-
-    # Resize heatmap to match original image
-    heatmap = cv2.resize(heatmap.numpy(), (img_array.shape[1], img_array.shape[0]))
-    heatmap = np.uint8(255 * heatmap)
-    heatmap = cv2.applyColorMap(heatmap, cv2.COLORMAP_JET)
-
-    # Overlay
-    superimposed_img = heatmap * intensity + img_array
-    superimposed_img = np.clip(superimposed_img, 0, 255).astype(np.uint8)
-
-    # Convert to Base64 string
-    pil_img = Image.fromarray(superimposed_img)
-    buffer = BytesIO()
-    pil_img.save(buffer, format="JPEG")
-    gradcam_cnn = base64.b64encode(buffer.getvalue()).decode("utf-8")
-
-    return {'gradcam_cnn':gradcam_cnn}
+def generate_gradcam_vgg16(img_array, target_size=(224, 224), intensity=0.4):
+    # Returns None for the heatmap when TensorFlow or the model isn't available
+    return {'gradcam_vgg16': _gradcam_overlay("vgg", img_array, target_size, intensity)}
 
 
+def generate_gradcam_cnn(img_array, target_size=(224, 224), intensity=0.4):
+    return {'gradcam_cnn': _gradcam_overlay("cnn", img_array, target_size, intensity)}
 
 
 def generate_gradcam_effnet(img_array, target_size=(224, 224), intensity=0.4):
-    import os
-    if not TF_AVAILABLE:
-        return {'effnet_gradcam': None}
-    base_dir = os.path.dirname(os.path.abspath(__file__))
-    model_path = os.path.join(base_dir, "models", "effnet_standalone_authnet.keras")
-    model = tf.keras.models.load_model(model_path)
-    
-    # Resize + preprocess for VGG16
-    img_resized = cv2.resize(img_array, target_size)
-    x = np.expand_dims(img_resized, axis=0)
-
-    # Build grad model
-    grad_model = tf.keras.models.Model(
-        [model.inputs],
-        [model.get_layer('top_conv').output, model.output]
-    )
-
-    # Forward + backward pass
-    with tf.GradientTape() as tape:
-        conv_outputs, predictions = grad_model(x)
-        class_idx = tf.argmax(predictions[0])
-        loss = predictions[:, class_idx]
-
-    grads = tape.gradient(loss, conv_outputs)
-    pooled_grads = tf.reduce_mean(grads, axis=(0, 1, 2))
-
-    # Generate heatmap
-    conv_outputs = conv_outputs[0]
-    heatmap = conv_outputs @ pooled_grads[..., tf.newaxis]
-    heatmap = tf.squeeze(heatmap)
-    heatmap = tf.maximum(heatmap, 0) / tf.math.reduce_max(heatmap)
-
-    # Resize heatmap to match original image
-    heatmap = cv2.resize(heatmap.numpy(), (img_array.shape[1], img_array.shape[0]))
-    heatmap = np.uint8(255 * heatmap)
-    heatmap = cv2.applyColorMap(heatmap, cv2.COLORMAP_JET)
-
-    # Overlay
-    superimposed_img = heatmap * intensity + img_array
-    superimposed_img = np.clip(superimposed_img, 0, 255).astype(np.uint8)
-
-    # Convert to Base64 string
-    pil_img = Image.fromarray(superimposed_img)
-    buffer = BytesIO()
-    pil_img.save(buffer, format="JPEG")
-    gradcam_effnet = base64.b64encode(buffer.getvalue()).decode("utf-8")
-
-    return {'effnet_gradcam': gradcam_effnet}
+    return {'effnet_gradcam': _gradcam_overlay("effnet", img_array, target_size, intensity)}
 
 
-import numpy as np
 from scipy import stats
 
 
 
 def majority_pipeline(img_array, IMAGE_SIZE = (224, 224)):
-    import os
-    base_dir = os.path.dirname(os.path.abspath(__file__))
-    
-    vgg16_path = os.path.join(base_dir, "models", "vgg16_standalone_authnet.keras")
-    cnn_path = os.path.join(base_dir, "models", "cnn_standalone.keras")
-    effnet_path = os.path.join(base_dir, "models", "effnet_standalone_authnet.keras")
-    
     if not TF_AVAILABLE:
         raise RuntimeError("TensorFlow is required for majority_pipeline")
-    vgg16 = tf.keras.models.load_model(vgg16_path)
-    cnn = tf.keras.models.load_model(cnn_path)
-    effnet = tf.keras.models.load_model(effnet_path)
+    vgg16 = get_keras_model("vgg")
+    cnn = get_keras_model("cnn")
+    effnet = get_keras_model("effnet")
+    if vgg16 is None or cnn is None or effnet is None:
+        raise RuntimeError("majority_pipeline needs the cnn, effnet and vgg models loaded")
     
     img = tf.expand_dims(img_array, axis=0)
 
@@ -229,7 +105,231 @@ def majority_pipeline(img_array, IMAGE_SIZE = (224, 224)):
 
     return result
 
-def toImageArray(uploaded_file):
-    img = Image.open(uploaded_file).convert("RGB")
+# Model order of the per-model columns returned by majority_pipeline_batch
+MAJORITY_MODELS = ("effnet", "cnn", "vgg16")
+MAJORITY_CLASSES = np.array(['real', 'fake'])
+
+
+def _iter_chunks(images, chunk_size, image_size):
+    """Yield float32 (n, H, W, 3) chunks from an array or an iterable of images"""
+    if isinstance(images, np.ndarray) and images.ndim == 4:
+        for start in range(0, len(images), chunk_size):
+            yield np.asarray(images[start:start + chunk_size], dtype=np.float32)
+        return
+    chunk = []
+    for img in images:
+        if img.shape[:2] != (image_size[1], image_size[0]):
+            img = cv2.resize(img, image_size)
+        chunk.append(img)
+        if len(chunk) == chunk_size:
+            yield np.stack(chunk).astype(np.float32, copy=False)
+            chunk = []
+    if chunk:
+        yield np.stack(chunk).astype(np.float32, copy=False)
+
+
+def majority_pipeline_batch(images, IMAGE_SIZE=(224, 224), chunk_size=None, threshold=0.5):
+    """
+    Batch version of majority_pipeline.
+
+    images is an (N, H, W, 3) array or an iterable of (H, W, 3) arrays (resized to
+    IMAGE_SIZE if needed). Each model runs once per chunk of `chunk_size` images.
+    Returns columnar arrays: the fake confidence per model (N,), per-model labels
+    (N, 3) in MAJORITY_MODELS order, and the majority label and class (N,).
+    """
+    if not TF_AVAILABLE:
+        raise RuntimeError("TensorFlow is required for majority_pipeline_batch")
+    keras_models = [get_keras_model("effnet"), get_keras_model("cnn"), get_keras_model("vgg")]
+    if any(model is None for model in keras_models):
+        raise RuntimeError("majority_pipeline_batch needs the cnn, effnet and vgg models loaded")
+    chunk_size = chunk_size or BATCH_CONFIG["chunk_size"]
+
+    scores = []
+    for chunk in _iter_chunks(images, chunk_size, IMAGE_SIZE):
+        with stage("majority_batch"):
+            scores.append(np.stack(
+                [np.asarray(model.predict_on_batch(chunk))[:, 0] for model in keras_models], axis=1
+            ).astype(np.float32, copy=False))
+    scores = np.concatenate(scores) if scores else np.zeros((0, len(keras_models)), dtype=np.float32)
+
+    labels = (scores > threshold).astype(np.int8)
+    # Strict majority of "fake" votes; ties resolve to "real" as scipy.stats.mode does
+    majority = (2 * labels.sum(axis=1, dtype=np.int32) > labels.shape[1]).astype(np.int8)
+
+    result = {name: scores[:, i] for i, name in enumerate(MAJORITY_MODELS)}
+    result.update({
+        'labels': labels,
+        'majority_label': majority,
+        'majority_vote': MAJORITY_CLASSES[majority]
+    })
+    return result
+
+# Heatmap encodings understood by the API (see HEATMAP_CONFIG in config.py)
+HEATMAP_FORMATS = ("jpeg", "png", "webp", "grid_float16", "grid_uint8")
+
+
+def _build_colormap_lut(colormap=cv2.COLORMAP_JET):
+    """Precompute a 256-entry RGB lookup table for a cv2 colormap"""
+    ramp = np.arange(256, dtype=np.uint8).reshape(256, 1)
+    return cv2.cvtColor(cv2.applyColorMap(ramp, colormap), cv2.COLOR_BGR2RGB).reshape(256, 3)
+
+
+JET_LUT = _build_colormap_lut()
+
+# Per-thread scratch buffers for heatmap rendering, keyed by role
+_render_buffers = threading.local()
+
+
+def _reusable_buffer(name, shape, dtype=np.uint8):
+    """Return a per-thread scratch buffer, reallocated only when the shape changes"""
+    buffers = getattr(_render_buffers, "buffers", None)
+    if buffers is None:
+        buffers = _render_buffers.buffers = {}
+    buf = buffers.get(name)
+    if buf is None or buf.shape != shape or buf.dtype != dtype:
+        buf = np.empty(shape, dtype=dtype)
+        buffers[name] = buf
+    return buf
+
+
+def bounded_size(height, width, max_edge):
+    """(width, height) scaled down so the longest edge is at most max_edge"""
+    scale = min(1.0, max_edge / float(max(height, width)))
+    return max(1, int(round(width * scale))), max(1, int(round(height * scale)))
+
+
+def render_heatmap(heatmap, out_size, img_array=None, intensity=0.4):
+    """
+    Colormap a [0, 1] heatmap grid and upsample it to out_size (width, height).
+
+    The colormap is applied through JET_LUT on the small grid before upsampling, so
+    the cost stays proportional to out_size rather than the upload. If img_array is
+    given it is downscaled to out_size and blended underneath. The result is a view
+    into a reused per-thread buffer: encode or copy it before the next call.
+    """
+    width, height = out_size
+    with stage("colormap"):
+        heatmap_colored = JET_LUT[np.uint8(np.round(255 * np.clip(heatmap, 0.0, 1.0)))]
+        colored = _reusable_buffer("colored", (height, width, 3))
+        cv2.resize(heatmap_colored, out_size, dst=colored, interpolation=cv2.INTER_LINEAR)
+    if img_array is None:
+        return colored
+
+    with stage("overlay"):
+        background = _reusable_buffer("background", (height, width, 3))
+        if img_array.dtype != np.uint8:
+            img_array = np.uint8(np.clip(img_array * 255 if img_array.max() <= 1.0 else img_array, 0, 255))
+        cv2.resize(img_array, out_size, dst=background, interpolation=cv2.INTER_AREA)
+
+        blended = _reusable_buffer("blended", (height, width, 3))
+        cv2.addWeighted(background, 1 - intensity, colored, intensity, 0, dst=blended)
+    return blended
+
+
+def encode_heatmap(heatmap, img_array=None, heatmap_format="jpeg", intensity=0.4, max_edge=512, quality=90):
+    """
+    Encode a normalized [0, 1] Grad-CAM grid for transport.
+
+    "jpeg" blends the colormapped heatmap over the original image (the legacy
+    response), "png"/"webp" return only the colormapped heatmap, and the "grid_*"
+    formats return the raw low-resolution activation grid so the client can
+    composite it itself. Rendered images keep the upload's aspect ratio with the
+    longest edge capped at max_edge. Returns a dict with the encoded bytes under "data".
+    """
+    if heatmap_format not in HEATMAP_FORMATS:
+        raise ValueError(f"Unknown heatmap format: {heatmap_format}")
+
+    heatmap = np.asarray(heatmap, dtype=np.float32)
+
+    if heatmap_format == "grid_float16":
+        return {
+            "format": heatmap_format,
+            "media_type": "application/octet-stream",
+            "shape": list(heatmap.shape),
+            "dtype": "<f2",
+            "data": heatmap.astype("<f2").tobytes()
+        }
+    if heatmap_format == "grid_uint8":
+        return {
+            "format": heatmap_format,
+            "media_type": "application/octet-stream",
+            "shape": list(heatmap.shape),
+            "dtype": "u1",
+            "data": np.uint8(np.round(255 * heatmap)).tobytes()
+        }
+
+    if img_array is not None:
+        out_size = bounded_size(img_array.shape[0], img_array.shape[1], max_edge)
+    else:
+        out_size = bounded_size(max_edge, max_edge, max_edge)
+
+    if heatmap_format == "jpeg":
+        rendered = render_heatmap(heatmap, out_size, img_array=img_array, intensity=intensity)
+    else:
+        rendered = render_heatmap(heatmap, out_size)
+
+    buffer = BytesIO()
+    with stage(f"{heatmap_format}_encode"):
+        if heatmap_format == "jpeg":
+            Image.fromarray(rendered).save(buffer, format="JPEG", quality=quality)
+            media_type = "image/jpeg"
+        elif heatmap_format == "png":
+            Image.fromarray(rendered).save(buffer, format="PNG", optimize=False)
+            media_type = "image/png"
+        else:
+            Image.fromarray(rendered).save(buffer, format="WEBP", quality=quality)
+            media_type = "image/webp"
+    return {
+        "format": heatmap_format,
+        "media_type": media_type,
+        "shape": [out_size[1], out_size[0]],
+        "data": buffer.getvalue()
+    }
+
+# Preprocess uploaded image - ensures 3-channel RGB input for all models
+def preprocess_image(file, target_size=None):
+    if target_size is None:
+        target_size = PREPROCESSING_CONFIG["image_size"]
+    
+    # Always convert to RGB to ensure 3 channels
+    with stage("decode"):
+        img = Image.open(io.BytesIO(file)).convert("RGB")
+    with stage("resize"):
+        img = img.resize(target_size)
+
+        # Convert to numpy array ensuring 3 channels
+        img_array = np.array(img, dtype=np.float32)
+    
+    # Ensure we have 3 channels (should be guaranteed by RGB conversion)
+    if len(img_array.shape) == 2:
+        # Grayscale - convert to 3 channels
+        img_array = np.stack([img_array] * 3, axis=-1)
+    elif img_array.shape[-1] == 1:
+        # Single channel - convert to 3 channels  
+        img_array = np.repeat(img_array, 3, axis=-1)
+    elif img_array.shape[-1] == 4:
+        # RGBA - keep only RGB channels
+        img_array = img_array[:, :, :3]
+    
+    # Ensure exactly 3 channels
+    assert img_array.shape[-1] == 3, f"Expected 3 channels, got {img_array.shape[-1]}"
+    
+    img_array = np.expand_dims(img_array, axis=0)
+    
+    if PREPROCESSING_CONFIG["normalize"]:
+        img_array /= PREPROCESSING_CONFIG["normalization_factor"]
+        
+    logger.debug("Preprocessed image shape %s", img_array.shape)
+    return img_array
+
+def toImageArray(uploaded_file, max_edge=None):
+    img = Image.open(uploaded_file)
+    if max_edge is not None:
+        # Let the decoder skip detail we would throw away (JPEG DCT scaling), then cap the size
+        img.draft("RGB", (max_edge, max_edge))
+        img = img.convert("RGB")
+        img.thumbnail((max_edge, max_edge))
+    else:
+        img = img.convert("RGB")
     img_array = np.array(img)
     return img_array
\ No newline at end of file
@@ -0,0 +1,53 @@
+"""
+Turning raw model outputs into verdicts, shared by the API endpoints and the job workers.
+"""
+import numpy as np
+from fastapi import HTTPException
+
+# Ensemble members, in response order
+ENSEMBLE_MODELS = ("cnn", "effnet", "vgg")
+
+
+def interpret_prediction(prediction, threshold):
+    """(predicted_class, probabilities, fake_confidence) from a sigmoid or softmax model output"""
+    # Handle both single output (sigmoid) and dual output (softmax) models
+    prediction_flat = prediction.flatten()
+    if len(prediction_flat) == 1:
+        # Single output sigmoid model (like original CNN)
+        sigmoid_prob = float(prediction_flat[0])
+        probabilities = [1.0 - sigmoid_prob, sigmoid_prob]  # [real_prob, fake_prob]
+        predicted_class = 1 if sigmoid_prob > threshold else 0  # Use custom threshold
+        fake_confidence = sigmoid_prob
+    else:
+        # Dual output softmax model (like VGG, EffNet binary)
+        probabilities = prediction.tolist()[0]
+        predicted_class = int(np.argmax(prediction, axis=1)[0])
+        fake_confidence = probabilities[1] if len(probabilities) > 1 else 0.5
+    return predicted_class, probabilities, fake_confidence
+
+
+def ensemble_decision(per_model, threshold):
+    """Majority vote and mean fake confidence over the members that produced a prediction"""
+    total_models = sum(1 for m in per_model if 'predicted_class' in m)
+    if total_models == 0:
+        raise HTTPException(status_code=500, detail="All model predictions failed")
+    fake_votes = sum(1 for m in per_model if m.get('predicted_class') == 1)
+
+    # Majority vote decision (ties -> real)
+    majority_fake = fake_votes > (total_models / 2)
+
+    # Ensemble confidence: average of fake probabilities (for models that produced probabilities)
+    fake_probs = [m.get('probabilities', [None, None])[1] for m in per_model if m.get('probabilities') and len(m['probabilities']) > 1]
+    if not fake_probs:
+        # Fallback: use single-output probabilities if available
+        fake_probs = [m.get('probability') for m in per_model if m.get('probability') is not None]
+    ensemble_confidence = float(np.mean(fake_probs)) if fake_probs else 0.5
+
+    return {
+        "majority_label": "fake" if majority_fake else "real",
+        "majority_class": 1 if majority_fake else 0,
+        "fake_votes": fake_votes,
+        "total_models": total_models,
+        "ensemble_confidence": ensemble_confidence,
+        "threshold": threshold
+    }
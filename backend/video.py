@@ -0,0 +1,191 @@
+"""
+Video and animated-image analysis.
+
+Frames are decoded locally (OpenCV for video containers, Pillow for animated
+GIF/WebP/PNG that OpenCV can't open), sampled either at a fixed rate or on scene
+changes, and near-identical consecutive frames are dropped. The sampled frames
+go through the models in batches and results are yielded batch by batch so the
+endpoint can stream them as they are produced.
+"""
+import cv2
+import numpy as np
+from PIL import Image, ImageSequence
+from config import PREPROCESSING_CONFIG, VIDEO_CONFIG, UPLOAD_CONFIG
+from logging_utils import get_logger
+from timing import stage
+from tiling import fake_scores
+
+logger = get_logger("authnet.video")
+
+SAMPLING_MODES = ("rate", "scene")
+
+# Frames are compared on a small grayscale thumbnail; cheap and robust to encoder noise
+_SIGNATURE_SIZE = (64, 36)
+
+
+class VideoDecodeError(Exception):
+    """The upload could not be decoded as a video or animated image"""
+
+
+def _opencv_frames(path, fps=None):
+    """
+    Yield (index, timestamp_s, rgb_frame) from a video container; raises VideoDecodeError if unreadable.
+    With fps set, frames between samples are only grabbed, never decoded to pixels.
+    """
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise VideoDecodeError("not a video OpenCV can open")
+    try:
+        video_fps = capture.get(cv2.CAP_PROP_FPS) or 0.0
+        width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        if width * height > UPLOAD_CONFIG["max_pixels"] or max(width, height) > UPLOAD_CONFIG["max_edge"]:
+            raise VideoDecodeError(f"frames are {width}x{height}, over the upload limits")
+        index = 0
+        next_due = 0.0
+        while capture.grab():
+            timestamp = index / video_fps if video_fps > 0 else capture.get(cv2.CAP_PROP_POS_MSEC) / 1000.0
+            index += 1
+            if fps and timestamp + 1e-6 < next_due:
+                continue
+            ok, frame = capture.retrieve()
+            if not ok:
+                continue
+            next_due = timestamp + 1.0 / fps if fps else 0.0
+            yield index - 1, timestamp, cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        if index == 0:
+            raise VideoDecodeError("no frames could be decoded")
+    finally:
+        capture.release()
+
+
+def _pillow_frames(path, fps=None):
+    """Yield (index, timestamp_s, rgb_frame) from an animated GIF/WebP/PNG"""
+    try:
+        img = Image.open(path)
+    except Exception:
+        raise VideoDecodeError("not a video or animated image")
+    with img:
+        timestamp = 0.0
+        next_due = 0.0
+        for index, frame in enumerate(ImageSequence.Iterator(img)):
+            if not fps or timestamp + 1e-6 >= next_due:
+                next_due = timestamp + 1.0 / fps if fps else 0.0
+                yield index, timestamp, np.asarray(frame.convert("RGB"))
+            timestamp += frame.info.get("duration", 100) / 1000.0
+
+
+def decode_frames(path, fps=None):
+    """
+    Frames of a video or animated image, OpenCV first and Pillow as the fallback.
+    fps (rate sampling) lets the decoders skip converting frames that would be dropped.
+    """
+    try:
+        yield from _opencv_frames(path, fps)
+        return
+    except VideoDecodeError as e:
+        logger.debug("OpenCV could not decode upload (%s), trying Pillow", e)
+    yield from _pillow_frames(path, fps)
+
+
+def _signature(frame):
+    gray = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+    return cv2.resize(gray, _SIGNATURE_SIZE, interpolation=cv2.INTER_AREA).astype(np.float32) / 255.0
+
+
+def sample_frames(frames, sample="rate", fps=None, scene_threshold=None, dedupe_threshold=None, max_frames=None):
+    """
+    Select frames to analyze from (index, timestamp, frame) tuples.
+
+    "rate" keeps at most `fps` frames per second of video; "scene" keeps a frame
+    whenever it differs from the last kept one by more than scene_threshold (mean
+    absolute difference of grayscale thumbnails, 0-1). In both modes a frame
+    within dedupe_threshold of the last kept frame is skipped as a near-duplicate.
+    Yields (index, timestamp, frame) for at most max_frames frames.
+    """
+    fps = fps or VIDEO_CONFIG["fps"]
+    scene_threshold = scene_threshold if scene_threshold is not None else VIDEO_CONFIG["scene_threshold"]
+    dedupe_threshold = dedupe_threshold if dedupe_threshold is not None else VIDEO_CONFIG["dedupe_threshold"]
+    max_frames = max_frames or VIDEO_CONFIG["max_frames"]
+
+    last_signature = None
+    next_time = 0.0
+    kept = 0
+    for index, timestamp, frame in frames:
+        if sample == "rate" and timestamp + 1e-6 < next_time:
+            continue
+        signature = _signature(frame)
+        if last_signature is not None:
+            difference = float(np.mean(np.abs(signature - last_signature)))
+            if difference <= dedupe_threshold:
+                continue
+            if sample == "scene" and difference < scene_threshold:
+                continue
+        last_signature = signature
+        next_time = timestamp + 1.0 / fps
+        yield index, timestamp, frame
+        kept += 1
+        if kept >= max_frames:
+            return
+
+
+def _model_input(frame):
+    img = cv2.resize(frame, tuple(PREPROCESSING_CONFIG["image_size"]), interpolation=cv2.INTER_AREA)
+    img = img.astype(np.float32)
+    if PREPROCESSING_CONFIG["normalize"]:
+        img /= PREPROCESSING_CONFIG["normalization_factor"]
+    return img
+
+
+def score_frames(frames, predict_fns, batch_size=None):
+    """
+    Run sampled frames through each model in batches.
+
+    predict_fns maps model name -> predict(batch). Yields one list per batch of
+    {"index", "timestamp", "scores": {model: fake score}, "score": mean over models}.
+    """
+    batch_size = batch_size or VIDEO_CONFIG["batch_size"]
+    buffer = np.empty((batch_size,) + tuple(PREPROCESSING_CONFIG["image_size"])[::-1] + (3,), dtype=np.float32)
+    meta = []
+
+    def flush():
+        x = buffer[:len(meta)]
+        per_model = {name: fake_scores(predict(x))[:len(meta)] for name, predict in predict_fns.items()}
+        results = []
+        for i, (index, timestamp) in enumerate(meta):
+            scores = {name: round(float(values[i]), 4) for name, values in per_model.items()}
+            results.append({
+                "index": index,
+                "timestamp": round(timestamp, 3),
+                "scores": scores,
+                "score": round(float(np.mean(list(scores.values()))), 4)
+            })
+        meta.clear()
+        return results
+
+    for index, timestamp, frame in frames:
+        with stage("frame_preprocess"):
+            buffer[len(meta)] = _model_input(frame)
+        meta.append((index, timestamp))
+        if len(meta) == batch_size:
+            yield flush()
+    if meta:
+        yield flush()
+
+
+def summarize(frame_results, threshold=0.5):
+    """Aggregate verdict over all scored frames"""
+    if not frame_results:
+        return {"frames": 0, "verdict": None}
+    scores = np.array([f["score"] for f in frame_results], dtype=np.float32)
+    fake_frames = int((scores > threshold).sum())
+    mean_score = float(scores.mean())
+    return {
+        "frames": len(frame_results),
+        "mean_score": round(mean_score, 4),
+        "max_score": round(float(scores.max()), 4),
+        "fake_frames": fake_frames,
+        "fake_fraction": round(fake_frames / len(frame_results), 4),
+        "threshold": threshold,
+        "verdict": "fake" if mean_score > threshold else "real"
+    }